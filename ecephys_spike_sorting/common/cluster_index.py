@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class ClusterIndex():
+
+    """
+    Groups spike indices by cluster ID, so that the spikes of each cluster can be
+    accessed as a contiguous block instead of through a boolean mask
+
+    The layout is the same as a compressed sparse row (CSR) matrix: a stable argsort
+    of the cluster IDs, plus per-cluster offsets into that sorted order. Because the
+    sort is stable, spikes within each cluster keep their original (time) order.
+
+    """
+
+    def __init__(self, spike_clusters, total_units = 0):
+
+        """
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike
+        total_units : int (optional)
+            Minimum number of clusters to index (IDs without spikes get empty blocks)
+        """
+
+        spike_clusters = np.squeeze(spike_clusters)
+
+        if spike_clusters.size > 0:
+            num_clusters = np.max([total_units, np.max(spike_clusters) + 1])
+        else:
+            num_clusters = total_units
+
+        self.order = np.argsort(spike_clusters, kind = 'stable')
+        self.counts = np.bincount(spike_clusters, minlength = num_clusters)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.cluster_ids = np.where(self.counts > 0)[0] # same as np.unique(spike_clusters)
+
+    def group(self, values):
+
+        """ Reorder a per-spike array so that each cluster occupies a contiguous block
+
+        Input:
+        ------
+        values : numpy.ndarray (num_spikes x ...)
+            Any array indexed by spike along its first axis
+
+        Output:
+        -------
+        grouped_values : numpy.ndarray (num_spikes x ...)
+            Copy of values, sorted by cluster (use with ClusterIndex.slice)
+
+        """
+
+        return values[self.order]
+
+    def slice(self, cluster_id):
+
+        """ Returns the slice of a grouped array that belongs to one cluster """
+
+        return slice(self.offsets[cluster_id], self.offsets[cluster_id + 1])
+
+    def indices(self, cluster_id):
+
+        """ Returns the original spike indices of one cluster, in time order """
+
+        return self.order[self.slice(cluster_id)]
+
+    def select(self, first, last, offset = 0):
+
+        """ Index of a subset of spikes that is one contiguous run within each cluster's block
+
+        The subset is taken without sorting again (e.g. the spikes of one epoch,
+        when spike times are sorted).
+
+        Input:
+        ------
+        first : numpy.ndarray (num_clusters x 0)
+            Position (in grouped order) of the first selected spike of each cluster
+        last : numpy.ndarray (num_clusters x 0)
+            Position (in grouped order) after the last selected spike of each cluster
+        offset : int (optional)
+            Subtracted from the spike indices (e.g. start of the slice the new index refers to)
+
+        Output:
+        -------
+        cluster_index : ClusterIndex
+            Index of the selected spikes
+
+        """
+
+        counts = last - first
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        positions = np.arange(np.sum(counts)) + np.repeat(first - starts, counts)
+
+        return ClusterIndex.from_counts(self.order[positions] - offset, counts)
+
+    @classmethod
+    def from_counts(cls, order, counts):
+
+        """ Build an index from spike indices already grouped by cluster, and the size of each group """
+
+        cluster_index = cls.__new__(cls)
+
+        cluster_index.order = order
+        cluster_index.counts = counts
+        cluster_index.offsets = np.concatenate(([0], np.cumsum(counts)))
+        cluster_index.cluster_ids = np.where(counts > 0)[0]
+
+        return cluster_index
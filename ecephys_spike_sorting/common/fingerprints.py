@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from .cluster_index import ClusterIndex
+
+
+def get_cluster_fingerprints(spike_clusters, params = None):
+
+    """
+    Summarizes the spikes assigned to each cluster, so that clusters changed by
+    manual curation (merges, splits, deletions) can be detected between runs
+
+    Input:
+    ------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    params : dict (optional)
+        Module parameters; a change in parameters invalidates every fingerprint
+        (the 'incremental' flag itself is ignored)
+
+    Output:
+    -------
+    fingerprints : pandas.DataFrame
+        One row per cluster with spikes: cluster_id, spike_count, spike_hash
+        (hash of the spike indices), params_hash
+
+    """
+
+    cluster_index = ClusterIndex(spike_clusters)
+
+    cluster_ids = cluster_index.cluster_ids
+
+    spike_hashes = [hashlib.sha1(cluster_index.indices(cluster_id).astype('int64').tobytes()).hexdigest()
+                    for cluster_id in cluster_ids]
+
+    return pd.DataFrame({'cluster_id' : cluster_ids,
+                         'spike_count' : cluster_index.counts[cluster_ids],
+                         'spike_hash' : spike_hashes,
+                         'params_hash' : get_params_hash(params)})
+
+
+def get_params_hash(params):
+
+    """ Hash of a parameter dictionary, excluding the 'incremental' flag """
+
+    if params is None:
+        params = {}
+
+    params = {key : value for key, value in params.items() if key != 'incremental'}
+
+    return hashlib.sha1(json.dumps(params, sort_keys = True, default = str).encode()).hexdigest()
+
+
+def get_fingerprint_file(output_file):
+
+    """ Location of the fingerprints stored next to an output file (e.g. metrics.csv -> metrics_fingerprints.csv) """
+
+    return os.path.splitext(output_file)[0] + '_fingerprints.csv'
+
+
+def save_fingerprints(fingerprints, output_file):
+
+    fingerprints.to_csv(get_fingerprint_file(output_file), index = False)
+
+
+def load_fingerprints(output_file):
+
+    """ Returns the fingerprints stored next to output_file, or None if there are none """
+
+    fingerprint_file = get_fingerprint_file(output_file)
+
+    if os.path.exists(output_file) and os.path.exists(fingerprint_file):
+        return pd.read_csv(fingerprint_file, dtype = {'spike_hash' : str, 'params_hash' : str})
+    else:
+        return None
+
+
+def compare_fingerprints(previous, current):
+
+    """
+    Finds the clusters that differ between two sets of fingerprints
+
+    Input:
+    ------
+    previous : pandas.DataFrame or None
+        Fingerprints stored with the existing outputs
+    current : pandas.DataFrame
+        Fingerprints of the current spike_clusters
+
+    Output:
+    -------
+    changed_ids : numpy.ndarray or None
+        IDs of clusters that are new, changed or deleted; None if everything
+        has to be recomputed (no previous fingerprints, or different parameters)
+
+    """
+
+    if previous is None or previous.shape[0] == 0 or current.shape[0] == 0:
+        return None
+
+    if not np.all(previous['params_hash'].values == current['params_hash'].values[0]):
+        return None
+
+    merged = previous.merge(current, on = 'cluster_id', how = 'outer', suffixes = ('_previous', '_current'))
+
+    changed = (merged['spike_count_previous'] != merged['spike_count_current']) | \
+              (merged['spike_hash_previous'] != merged['spike_hash_current'])
+
+    return np.sort(merged['cluster_id'].values[changed.values]).astype('int')
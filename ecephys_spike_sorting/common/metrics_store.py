@@ -0,0 +1,298 @@
+import os
+import glob
+
+import pandas as pd
+
+KEY_COLUMNS = ['cluster_id', 'epoch_name']
+
+FILE_EXTENSIONS = {'parquet' : '.parquet',
+                   'feather' : '.feather',
+                   'pickle' : '.pkl'}
+
+
+def get_metrics_store_directory(cluster_metrics_args):
+
+    """ Location of the metrics store, given the 'cluster_metrics' section of the module arguments """
+
+    if cluster_metrics_args.get('metrics_store_directory') is not None:
+        return cluster_metrics_args['metrics_store_directory']
+    else:
+        return os.path.join(os.path.dirname(os.path.abspath(cluster_metrics_args['cluster_metrics_file'])),
+                            'metrics_store')
+
+
+def get_store_format(store_format):
+
+    """ Falls back to pickle if the parquet/feather engine (pyarrow) is not installed """
+
+    if store_format in ('parquet', 'feather'):
+        try:
+            import pyarrow
+        except ModuleNotFoundError:
+            print('pyarrow not available; saving metrics as pickle instead of ' + store_format)
+            return 'pickle'
+
+    if store_format not in FILE_EXTENSIONS:
+        raise ValueError('Unknown metrics store format: ' + store_format)
+
+    return store_format
+
+
+def write_metrics_group(metrics, group, store_directory, store_format = 'parquet'):
+
+    """
+    Saves the metrics computed by one module as a separate column group
+
+    Only the file for this group is rewritten; groups written by other modules
+    are left untouched. The new file is written next to the old one and then
+    replaces it, so the stored metrics are kept if writing fails.
+
+    Inputs:
+    -------
+    metrics : pandas.DataFrame
+        Must contain 'cluster_id' and 'epoch_name' columns
+    group : str
+        Name of the column group (e.g. 'quality_metrics', 'waveform_metrics')
+    store_directory : str
+        Location of the metrics store
+    store_format : str
+        'parquet', 'feather' or 'pickle'
+
+    Outputs:
+    --------
+    group_file : str
+        Path to the saved file
+
+    """
+
+    store_format = get_store_format(store_format)
+
+    if not os.path.exists(store_directory):
+        os.makedirs(store_directory)
+
+    group_file = os.path.join(store_directory, group + FILE_EXTENSIONS[store_format])
+
+    # not matched by list_metrics_groups if it is left behind
+    temp_file = group_file + '.tmp'
+
+    metrics = metrics.reset_index(drop = True)
+
+    try:
+        if store_format == 'parquet':
+            metrics.to_parquet(temp_file, index = False)
+        elif store_format == 'feather':
+            metrics.to_feather(temp_file)
+        else:
+            metrics.to_pickle(temp_file, compression = None)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    os.replace(temp_file, group_file)
+
+    # files for this group saved in other formats
+    for existing_file in get_group_files(group, store_directory):
+        if existing_file != group_file:
+            os.remove(existing_file)
+
+    return group_file
+
+
+def get_group_files(group, store_directory):
+
+    return [os.path.join(store_directory, group + extension) for extension in FILE_EXTENSIONS.values()
+            if os.path.exists(os.path.join(store_directory, group + extension))]
+
+
+def list_metrics_groups(store_directory):
+
+    """ Names of all column groups in the metrics store """
+
+    groups = []
+
+    for extension in FILE_EXTENSIONS.values():
+        groups += [os.path.basename(f)[:-len(extension)]
+                   for f in glob.glob(os.path.join(store_directory, '*' + extension))]
+
+    return sorted(groups)
+
+
+def read_metrics_group(group, store_directory, columns = None):
+
+    """
+    Loads one column group from the metrics store
+
+    Inputs:
+    -------
+    group : str
+        Name of the column group
+    store_directory : str
+        Location of the metrics store
+    columns : list of str (optional)
+        Metrics to load (the key columns are always included); for parquet and
+        feather, other columns are not read from disk
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame, or None if the group does not exist
+
+    """
+
+    group_files = get_group_files(group, store_directory)
+
+    if len(group_files) == 0:
+        return None
+
+    group_file = group_files[0]
+
+    if columns is not None:
+        columns = KEY_COLUMNS + [column for column in columns if column not in KEY_COLUMNS]
+
+    if group_file.endswith(FILE_EXTENSIONS['parquet']):
+        return pd.read_parquet(group_file, columns = columns)
+    elif group_file.endswith(FILE_EXTENSIONS['feather']):
+        return pd.read_feather(group_file, columns = columns)
+    else:
+        metrics = pd.read_pickle(group_file)
+        return metrics if columns is None else metrics[[c for c in columns if c in metrics.columns]]
+
+
+def read_metrics(store_directory, groups = None, columns = None):
+
+    """
+    Joins column groups from the metrics store by cluster_id and epoch_name
+
+    Inputs:
+    -------
+    store_directory : str
+        Location of the metrics store
+    groups : list of str (optional)
+        Column groups to load (default = all groups in the store)
+    columns : list of str (optional)
+        Metrics to load; groups without any of these columns are not read
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame, or None if the store is empty
+        Metrics names that appear in more than one group get the group name as a suffix
+
+    """
+
+    if groups is None:
+        groups = list_metrics_groups(store_directory)
+
+    metrics = None
+    previous_group = None
+
+    for group in groups:
+
+        group_columns = None
+
+        if columns is not None:
+            available = read_group_columns(group, store_directory)
+            group_columns = [column for column in columns if column in available and column not in KEY_COLUMNS]
+            if len(group_columns) == 0:
+                continue
+
+        group_metrics = read_metrics_group(group, store_directory, group_columns)
+
+        if group_metrics is None:
+            continue
+
+        if metrics is None:
+            metrics = group_metrics
+        else:
+            metrics = metrics.merge(group_metrics, on = KEY_COLUMNS, how = 'outer',
+                                    suffixes = ('_' + previous_group, '_' + group))
+
+        previous_group = group
+
+    return metrics
+
+
+def read_group_columns(group, store_directory):
+
+    """ Column names of one group, read from the file schema where possible """
+
+    group_file = get_group_files(group, store_directory)[0]
+
+    if group_file.endswith(FILE_EXTENSIONS['parquet']):
+        import pyarrow.parquet as pq
+        return pq.read_schema(group_file).names
+    elif group_file.endswith(FILE_EXTENSIONS['feather']):
+        import pyarrow.feather as pf
+        return pf.read_table(group_file, memory_map = True).column_names
+    else:
+        return list(pd.read_pickle(group_file).columns)
+
+
+def export_metrics_csv(store_directory, cluster_metrics_file):
+
+    """
+    Writes the cluster metrics CSV in its original layout (quality metrics,
+    merged with waveform metrics on cluster_id), for compatibility with
+    existing readers
+
+    The CSV is rebuilt from the column groups every time, so rerunning either
+    module never accumulates duplicate columns.
+
+    Inputs:
+    -------
+    store_directory : str
+        Location of the metrics store
+    cluster_metrics_file : str
+        Path to the CSV file
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame, or None if there are no quality metrics in the store
+
+    """
+
+    metrics = read_metrics_group('quality_metrics', store_directory)
+
+    if metrics is None:
+        return None
+
+    waveform_metrics = read_metrics_group('waveform_metrics', store_directory)
+
+    if waveform_metrics is not None:
+        metrics = metrics.merge(waveform_metrics,
+                     on='cluster_id',
+                     suffixes=('_quality_metrics','_waveform_metrics'))
+
+    metrics.to_csv(cluster_metrics_file)
+
+    return metrics
+
+
+def import_metrics_csv(cluster_metrics_file, waveform_metrics = None):
+
+    """
+    Loads the quality metrics from a cluster metrics CSV written before the
+    metrics store existed, removing any waveform metrics merged into it
+
+    Inputs:
+    -------
+    cluster_metrics_file : str
+        Path to the CSV file
+    waveform_metrics : pandas.DataFrame (optional)
+        Waveform metrics whose columns should be removed
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame, with the quality metrics only
+
+    """
+
+    metrics = pd.read_csv(cluster_metrics_file, index_col=0)
+
+    metrics = metrics.rename(columns = {'epoch_name_quality_metrics' : 'epoch_name'})
+
+    if waveform_metrics is not None:
+        waveform_columns = [column for column in waveform_metrics.columns if column not in KEY_COLUMNS]
+        waveform_columns += [column + '_waveform_metrics' for column in waveform_metrics.columns]
+        metrics = metrics.drop(columns = [column for column in metrics.columns if column in waveform_columns])
+
+    return metrics
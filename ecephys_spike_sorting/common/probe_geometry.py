@@ -0,0 +1,149 @@
+import numpy as np
+from scipy.io import loadmat
+
+
+class ProbeGeometry():
+
+    """
+    Sites sampled for the 2D waveform features, precomputed for every possible peak channel
+
+    The 2D features (see calculate_2D_features) sample the site_range sites closest
+    to the peak channel that are in its column, or in the column of the nearest site
+    at a different depth. These depend only on the site positions, so they are found
+    once per probe instead of once per unit; each unit then only gathers site_range
+    entries from the tables.
+
+    The nearest site at a different depth is also required to have a non-zero
+    amplitude. The tables assume that it does, and get_sampled_sites recomputes the
+    sites for the (rare) units where that is not the case.
+
+    """
+
+    def __init__(self, site_x, site_y, site_range = 16):
+
+        """
+        site_x, site_y : numpy.ndarray (num_sites x 0)
+            Site positions in um, in the order of the rows of the mean waveforms
+        site_range : int
+            Number of sites to sample for each peak channel
+        """
+
+        self.site_x = np.asarray(np.squeeze(site_x), dtype = 'float')
+        self.site_y = np.asarray(np.squeeze(site_y), dtype = 'float')
+        self.site_range = site_range
+        self.num_sites = self.site_x.size
+
+        self.distances = np.sqrt((self.site_x[np.newaxis, :] - self.site_x[:, np.newaxis]) ** 2 +
+                                 (self.site_y[np.newaxis, :] - self.site_y[:, np.newaxis]) ** 2)
+
+        ydiff = self.site_y[np.newaxis, :] != self.site_y[:, np.newaxis]
+
+        # sites at a different depth that are at most as close as all preceding
+        # ones; the last of these with a non-zero amplitude sets the second column
+        candidate_distances = np.where(ydiff, self.distances, np.inf)
+        preceding_min = np.minimum.accumulate(np.concatenate((np.ones((self.num_sites, 1)) * 1e6,
+                                                               candidate_distances[:, :-1]), 1), 1)
+
+        is_candidate = ydiff * (self.distances <= preceding_min)
+
+        num_candidates = np.max(np.sum(is_candidate, 1), initial = 0)
+
+        self.nn_candidates = np.sort(np.where(is_candidate, np.arange(self.num_sites)[np.newaxis, :],
+                                              self.num_sites), 1)[:, :num_candidates]
+        self.nn_candidates[self.nn_candidates == self.num_sites] = -1
+
+        last_candidate = self.num_sites - 1 - np.argmax(is_candidate[:, ::-1], 1)
+        self.x_nn = np.where(np.any(is_candidate, 1), self.site_x[last_candidate], -1)
+
+        self.sampled_sites = get_column_sites(self.distances, self.site_x, self.site_x, self.x_nn, site_range)
+
+    def get_sampled_sites(self, peak_channel, x_nn):
+
+        """ Sites to sample for one unit (padded with -1), given the x position of the second column """
+
+        if x_nn == self.x_nn[peak_channel]:
+            return self.sampled_sites[peak_channel]
+        else:
+            return get_column_sites(self.distances[peak_channel][np.newaxis, :], self.site_x,
+                                    self.site_x[[peak_channel]], np.array([x_nn]), self.site_range)[0]
+
+    def get_x_nn(self, peak_channels, waveforms):
+
+        """
+        x position of the second column sampled for each unit
+
+        Inputs:
+        -------
+        peak_channels : numpy.ndarray (num_units)
+        waveforms : numpy.ndarray (num_units x num_sites x num_samples)
+            Mean waveform of each unit on every site
+
+        Outputs:
+        --------
+        x_nn : numpy.ndarray (num_units)
+            -1 if none of the candidate sites has a non-zero amplitude
+
+        """
+
+        candidates = self.nn_candidates[peak_channels]
+
+        if candidates.shape[1] == 0:
+            return -np.ones((candidates.shape[0],))
+
+        candidate_waveforms = waveforms[np.arange(candidates.shape[0])[:, np.newaxis], np.maximum(candidates, 0), :]
+        amplitudes = np.max(candidate_waveforms, 2) - np.min(candidate_waveforms, 2)
+
+        has_amplitude = (candidates >= 0) * (amplitudes > 0)
+
+        last = candidates.shape[1] - 1 - np.argmax(has_amplitude[:, ::-1], 1)
+        nn = np.take_along_axis(candidates, last[:, np.newaxis], 1)[:, 0]
+
+        return np.where(np.any(has_amplitude, 1), self.site_x[nn], -1)
+
+
+def get_column_sites(distances, site_x, x_peak, x_nn, site_range):
+
+    """
+    The site_range sites closest to each peak channel that have x = x_peak or x = x_nn
+
+    Sites at equal distances are taken in channel order.
+
+    Inputs:
+    -------
+    distances : numpy.ndarray (num_peaks x num_sites)
+        Distance from each peak channel to every site
+    site_x : numpy.ndarray (num_sites, or num_peaks x num_sites)
+    x_peak, x_nn : numpy.ndarray (num_peaks)
+        x positions of the two columns to sample
+    site_range : int
+
+    Outputs:
+    --------
+    sites : numpy.ndarray (num_peaks x min(site_range, num_sites))
+        Sites in order of distance, padded with -1 if fewer sites are in the columns
+
+    """
+
+    num_sites = distances.shape[1]
+
+    in_column = (site_x == x_peak[:, np.newaxis]) | (site_x == x_nn[:, np.newaxis])
+
+    sort_dist_ind = np.argsort(distances, axis = 1, kind = 'stable')
+    sorted_in_column = np.take_along_axis(in_column, sort_dist_ind, 1)
+    selected = sorted_in_column * (np.cumsum(sorted_in_column, 1) <= site_range)
+
+    positions = np.sort(np.where(selected, np.arange(num_sites)[np.newaxis, :], num_sites), 1)[:, :np.min([site_range, num_sites])]
+
+    sites = np.take_along_axis(sort_dist_ind, np.minimum(positions, num_sites - 1), 1)
+    sites[positions == num_sites] = -1
+
+    return sites
+
+
+def geometry_from_chan_map(chan_map_file, site_range = 16):
+
+    """ ProbeGeometry for the sites in a Kilosort _chanMap.mat file (xcoords, ycoords) """
+
+    chan_map = loadmat(chan_map_file)
+
+    return ProbeGeometry(np.squeeze(chan_map['xcoords']), np.squeeze(chan_map['ycoords']), site_range)
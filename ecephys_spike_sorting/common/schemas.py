@@ -33,3 +33,5 @@ class WaveformMetricsFile(DefaultSchema):
     
 class ClusterMetricsFile(DefaultSchema):
     cluster_metrics_file = String(help='Location of cluster metrics CSV')
+    metrics_store_directory = String(required=False, help='Location of the columnar metrics store (default = metrics_store directory next to the cluster metrics CSV)')
+    metrics_store_format = String(required=False, default='parquet', help='File format for the metrics store: parquet, feather or pickle (parquet and feather require pyarrow)')
@@ -5,6 +5,7 @@ import json
 import glob
 import sys
 import time
+import mmap
 
 from git import Repo
 
@@ -220,7 +221,7 @@ def read_cluster_amplitude_tsv(filename):
 
     return cluster_amplitude
 
-def load(folder, filename):
+def load(folder, filename, mmap_mode = None):
 
     """
     Loads a numpy file from a folder.
@@ -231,6 +232,8 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String (optional)
+        If set (e.g. 'r'), memory-map the file instead of reading it into memory
 
     Outputs:
     --------
@@ -239,7 +242,7 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode = mmap_mode)
 
 
 def load_kilosort_data(folder, 
@@ -247,7 +250,8 @@ def load_kilosort_data(folder,
                        convert_to_seconds = True, 
                        use_master_clock = False, 
                        include_pcs = False,
-                       template_zero_padding= 21):
+                       template_zero_padding= 21,
+                       mmap_mode = None):
 
     """
     Loads Kilosort output files from a directory
@@ -266,6 +270,9 @@ def load_kilosort_data(folder,
         Flags whether to load spike principal components (large file)
     template_zero_padding : int (default = 21)
         Number of zeros added to the beginning of each template
+    mmap_mode : String (optional)
+        If set (e.g. 'r'), pc_features and template_features are returned as 
+        memory-mapped arrays instead of being read into memory
 
     Outputs:
     --------
@@ -278,7 +285,7 @@ def load_kilosort_data(folder,
     amplitudes : numpy.ndarray (N x 0)
         Amplitudes for N spikes
     unwhitened_temps : numpy.ndarray (M x samples x channels) 
-        Templates for M units
+        Templates for M units (cached in templates_unwhitened.npy, see load_unwhitened_templates)
     channel_map : numpy.ndarray
         Channels from original data file used for sorting
     channel_pos : numpy.ndarray (channels x 2)
@@ -306,29 +313,23 @@ def load_kilosort_data(folder,
     spike_clusters = load(folder,'spike_clusters.npy')
     spike_templates = load(folder, 'spike_templates.npy')
     amplitudes = load(folder,'amplitudes.npy')
-    templates = load(folder,'templates.npy')
-    unwhitening_mat = load(folder,'whitening_mat_inv.npy')
     channel_map = load(folder, 'channel_map.npy')
     channel_pos = load(folder, 'channel_positions.npy')
 
     if include_pcs:
-        pc_features = load(folder, 'pc_features.npy')
+        pc_features = load(folder, 'pc_features.npy', mmap_mode)
         pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-        template_features = load(folder, 'template_features.npy') 
+        template_features = load(folder, 'template_features.npy', mmap_mode)
 
                 
-    templates = templates[:,template_zero_padding:,:] # remove zeros
     spike_clusters = np.squeeze(spike_clusters) # fix dimensions
     spike_times = np.squeeze(spike_times)# fix dimensions
 
     if convert_to_seconds and sample_rate is not None:
        spike_times = spike_times / sample_rate 
                     
-    unwhitened_temps = np.zeros((templates.shape))
-    
-    for temp_idx in range(templates.shape[0]):
-        
-        unwhitened_temps[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
+    # zeros at the start of each template are removed
+    unwhitened_temps = load_unwhitened_templates(folder, template_zero_padding).astype('float64')
                     
     try:
         cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(folder, 'cluster_group.tsv'))
@@ -350,13 +351,129 @@ def load_kilosort_data(folder,
                pc_features, pc_feature_ind, template_features
 
 
-def get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos):
+def share_array(array):
+
+    """
+    Makes an array available to worker processes without pickling it
+
+    Memory-mapped arrays (including contiguous slices of them) are shared by
+    reference to their file; other arrays are copied into a new block of 
+    shared memory (before Python 3.8, they are copied to each worker instead).
+
+    Input:
+    ------
+    array : numpy.ndarray
+        Data to share
+
+    Outputs:
+    --------
+    shm : multiprocessing.shared_memory.SharedMemory
+        Shared memory block (None if no block was created); the caller must
+        close() and unlink() it when done
+    spec : tuple
+        Description of the shared array, to pass to attach_shared_array
+
+    """
+
+    memmap_spec = get_memmap_spec(array)
+
+    if memmap_spec is not None:
+        return None, memmap_spec
+
+    array = np.asarray(array)
+
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        # before Python 3.8, the array is copied to each worker instead
+        return None, ('array', array)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+
+    return shm, ('shared_memory', shm.name, array.shape, array.dtype.str)
+
+
+def attach_shared_array(spec):
+
+    """
+    Attaches to an array made available by share_array
+
+    Input:
+    ------
+    spec : tuple
+        Description returned by share_array
+
+    Outputs:
+    --------
+    shm : multiprocessing.shared_memory.SharedMemory
+        Shared memory block (None if the array is not in one); keep a reference 
+        for as long as the array is used
+    array : numpy.ndarray
+        View of the shared data
+
+    """
+
+    if spec[0] == 'memmap':
+        kind, filename, shape, dtype, offset = spec
+        return None, np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    if spec[0] == 'array':
+        return None, spec[1]
+
+    from multiprocessing import shared_memory
+
+    kind, name, shape, dtype = spec
+
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def get_memmap_spec(array):
+
+    """
+    Finds the file location of a memory-mapped array
+
+    Works for the array returned by np.load(..., mmap_mode) and for contiguous
+    slices of it, such as the spikes of one epoch.
+
+    Input:
+    ------
+    array : numpy.ndarray
+
+    Output:
+    -------
+    spec : tuple
+        ('memmap', filename, shape, dtype, offset in bytes), or None if the array 
+        is not a contiguous view of a file
+
+    """
+
+    if not isinstance(array, np.memmap) or array.filename is None \
+        or getattr(array, '_mmap', None) is None or not array.flags['C_CONTIGUOUS']:
+        return None
+
+    # np.memmap maps the file from the allocation boundary preceding its offset
+    mmap_start = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+    mmap_address = np.frombuffer(array._mmap, dtype='uint8').ctypes.data
+
+    offset = mmap_start + array.ctypes.data - mmap_address
+
+    return ('memmap', array.filename, array.shape, array.dtype.str, offset)
+
+
+def get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos, chunk_size = 100000):
 
     """
     Calculates the distance (in microns) of individual spikes from the probe tip
 
     This implementation is based on Matlab code from github.com/cortex-lab/spikes
 
+    The spikes are processed in blocks of chunk_size, so pc_features can be a memmap
+    and the temporary arrays stay small.
+
     Input:
     -----
     spike_clusters : numpy.ndarray (N x 0)
@@ -367,27 +484,288 @@ def get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos):
         Channels used for PC calculation for each unit
     channel_pos : (channels x 2)
         X and Y/depth position of each channel, in um
+    chunk_size : int
+        Number of spikes per block
 
     Output:
     ------
-    spike_depths : numpy.ndarray (N x 0)
+    spike_depths : numpy.ndarray (N x 0), float32
         Distance (in microns) from each spike waveform from the probe tip
 
     """
 
-    pc_features_copy = np.copy(pc_features)
-    pc_features_copy = np.squeeze(pc_features_copy[:,0,:])
-    pc_features_copy[pc_features_copy < 0] = 0
-    pc_power = pow(pc_features_copy, 2)
-    
+    channel_ycoord = channel_pos[:, 1].astype('float32')
+
+    spike_depths = np.empty((spike_clusters.size,), dtype = 'float32')
+
+    for start in range(0, spike_clusters.size, chunk_size):
+
+        end = min(start + chunk_size, spike_clusters.size)
+
+        pc_power = np.array(pc_features[start:end, 0, :], dtype = 'float32')
+        np.maximum(pc_power, 0, out = pc_power)
+        np.square(pc_power, out = pc_power)
 
-    spike_feat_ind = pc_feature_ind[spike_clusters, :]
-    spike_feat_ycoord = channel_pos[spike_feat_ind, 1]
-    spike_depths = np.sum(spike_feat_ycoord * pc_power, 1) / np.sum(pc_power,1)
+        spike_feat_ycoord = channel_ycoord[pc_feature_ind[spike_clusters[start:end], :]]
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            spike_depths[start:end] = np.einsum('ij,ij->i', spike_feat_ycoord, pc_power) / np.sum(pc_power, 1)
 
     return spike_depths
 
 
+def load_spike_depths(folder, spike_clusters, pc_features, pc_feature_ind, channel_pos, chunk_size = 100000):
+
+    """
+    Loads spike depths from spike_depths.npy in a Kilosort output directory, or
+    calculates and saves them if that file is missing or out of date
+
+    The saved depths are reused if they have one value per spike and are newer than
+    spike_clusters.npy and pc_features.npy (which are rewritten by curation and 
+    post-processing), pc_feature_ind.npy and channel_positions.npy. They are saved
+    with write_cache_file, so nothing is saved if the folder is not writable.
+
+    Input:
+    -----
+    folder : str
+        Location of Kilosort output directory
+    spike_clusters, pc_features, pc_feature_ind, channel_pos, chunk_size :
+        See get_spike_depths
+
+    Output:
+    ------
+    spike_depths : numpy.ndarray (N x 0), float32
+
+    """
+
+    depths_file = os.path.join(folder, 'spike_depths.npy')
+
+    sources = [os.path.join(folder, f) for f in ('spike_clusters.npy', 'pc_features.npy', 
+                                                 'pc_feature_ind.npy', 'channel_positions.npy')]
+
+    if is_up_to_date(depths_file, sources):
+
+        spike_depths = np.load(depths_file)
+
+        if spike_depths.size == spike_clusters.size:
+            return spike_depths
+
+    spike_depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos, chunk_size)
+
+    write_cache_file(depths_file, lambda temp_file: np.save(temp_file, spike_depths))
+
+    return spike_depths
+
+
+def is_up_to_date(output_file, source_files):
+
+    """ True if output_file exists and is at least as new as each of the source files that exist """
+
+    if not os.path.exists(output_file):
+        return False
+
+    newest_source = np.max([os.path.getmtime(f) for f in source_files if os.path.exists(f)] + [0])
+
+    return os.path.getmtime(output_file) >= newest_source
+
+
+def write_cache_file(cache_file, write):
+
+    """
+    Saves a cache file next to the Kilosort outputs, without leaving a partial file
+
+    The file is written to a temporary file in the same folder, which then replaces
+    cache_file, so other processes only ever see a complete file. If the folder is
+    not writable, nothing is saved and the caller uses the values it calculated.
+
+    Input:
+    -----
+    cache_file : str
+        Path to the cache file
+    write : function
+        Called with the path of the temporary file (which has the same extension)
+
+    Output:
+    ------
+    saved : bool
+        False if the file could not be written
+
+    """
+
+    base, extension = os.path.splitext(cache_file)
+    temp_file = base + '.' + str(os.getpid()) + '.tmp' + extension
+
+    try:
+        write(temp_file)
+        os.replace(temp_file, cache_file)
+    except OSError as error:
+        print('Could not save ' + cache_file + ' (' + str(error) + ')')
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return False
+
+    return True
+
+
+def unwhiten_templates(templates, unwhitening_mat):
+
+    """
+    Multiplies every template by the inverse of the whitening matrix
+
+    Inputs:
+    -------
+    templates : numpy.ndarray (M x samples x channels)
+        Whitened templates, as saved by Kilosort
+    unwhitening_mat : numpy.ndarray (channels x channels)
+        Contents of whitening_mat_inv.npy
+
+    Outputs:
+    --------
+    unwhitened_templates : numpy.ndarray (M x samples x channels)
+
+    """
+
+    # one matrix product for all templates and samples
+    unwhitened_templates = np.dot(np.reshape(templates, (-1, templates.shape[2])), np.ascontiguousarray(unwhitening_mat))
+
+    return np.reshape(unwhitened_templates, templates.shape)
+
+
+def load_unwhitened_templates(folder, template_zero_padding = 21):
+
+    """
+    Loads the unwhitened templates from templates_unwhitened.npy in a Kilosort output
+    directory, or calculates and saves them (see write_cache_file) if that file is
+    missing or older than templates.npy or whitening_mat_inv.npy
+
+    Input:
+    -----
+    folder : str
+        Location of Kilosort output directory
+    template_zero_padding : int (default = 21)
+        Number of zeros added to the beginning of each template (removed from the output)
+
+    Output:
+    ------
+    unwhitened_templates : numpy.ndarray (M x samples x channels), float32
+
+    """
+
+    unwhitened_file = os.path.join(folder, 'templates_unwhitened.npy')
+
+    if is_up_to_date(unwhitened_file, [os.path.join(folder, f) for f in ('templates.npy', 'whitening_mat_inv.npy')]):
+
+        unwhitened_templates = np.load(unwhitened_file)
+
+    else:
+
+        # same precision as templates.npy, whether or not the cache can be saved
+        unwhitened_templates = unwhiten_templates(load(folder, 'templates.npy'), 
+                                                  load(folder, 'whitening_mat_inv.npy')).astype('float32')
+
+        write_cache_file(unwhitened_file, lambda temp_file: np.save(temp_file, unwhitened_templates))
+
+    return unwhitened_templates[:, template_zero_padding:, :]
+
+
+def get_template_table(templates, channel_map, channel_pos = None, spread_threshold = 0.12):
+
+    """
+    Peak channel, amplitude and spread of each template
+
+    Inputs:
+    -------
+    templates : numpy.ndarray (M x samples x channels)
+        Unwhitened templates for M units
+    channel_map : numpy.ndarray
+        Channels from original data file used for sorting
+    channel_pos : numpy.ndarray (channels x 2) (optional)
+        X and Z coordinates for each channel used in the sort
+    spread_threshold : float
+        Fraction of the template amplitude that a channel must exceed to count
+        towards the spread
+
+    Outputs:
+    --------
+    template_table : pandas.DataFrame
+        One row per template: template_id, peak_index (index into channel_map),
+        peak_channel, amplitude (largest peak-to-peak amplitude on any channel) and
+        spread (vertical extent in um of the channels above threshold; number of 
+        channels if channel_pos is not given)
+
+    """
+
+    channel_map = np.squeeze(channel_map)
+
+    peak_to_peak = np.max(templates, 1) - np.min(templates, 1)
+
+    peak_index = np.argmax(peak_to_peak, 1)
+    amplitude = np.max(peak_to_peak, 1)
+
+    above_threshold = peak_to_peak > (amplitude * spread_threshold)[:, np.newaxis]
+
+    if channel_pos is not None:
+        y = np.broadcast_to(channel_pos[:, 1], above_threshold.shape)
+        spread = np.max(np.where(above_threshold, y, -np.inf), 1) - np.min(np.where(above_threshold, y, np.inf), 1)
+        spread[np.invert(np.any(above_threshold, 1))] = 0
+    else:
+        spread = np.sum(above_threshold, 1)
+
+    return pd.DataFrame({'template_id' : np.arange(templates.shape[0]),
+                         'peak_index' : peak_index,
+                         'peak_channel' : channel_map[peak_index],
+                         'amplitude' : amplitude,
+                         'spread' : spread})
+
+
+def load_template_table(folder, template_zero_padding = 21):
+
+    """
+    Loads the table of template peak channels, amplitudes and spreads from 
+    template_table.csv in a Kilosort output directory, or calculates and saves it
+    (see write_cache_file) if that file is missing or out of date
+
+    The table is recalculated if templates.npy, whitening_mat_inv.npy, channel_map.npy
+    or channel_positions.npy is newer, or if it was made with a different 
+    template_zero_padding.
+
+    Input:
+    -----
+    folder : str
+        Location of Kilosort output directory
+    template_zero_padding : int (default = 21)
+        See load_kilosort_data
+
+    Output:
+    ------
+    template_table : pandas.DataFrame
+        See get_template_table
+
+    """
+
+    table_file = os.path.join(folder, 'template_table.csv')
+
+    sources = [os.path.join(folder, f) for f in ('templates.npy', 'whitening_mat_inv.npy', 
+                                                 'channel_map.npy', 'channel_positions.npy')]
+
+    if is_up_to_date(table_file, sources):
+
+        template_table = pd.read_csv(table_file, float_precision = 'round_trip')
+
+        if np.all(template_table['template_zero_padding'] == template_zero_padding):
+            return template_table.drop(columns = 'template_zero_padding')
+
+    channel_pos = load(folder, 'channel_positions.npy') if os.path.exists(os.path.join(folder, 'channel_positions.npy')) else None
+
+    template_table = get_template_table(load_unwhitened_templates(folder, template_zero_padding).astype('float64'), 
+                                        load(folder, 'channel_map.npy'), channel_pos)
+
+    write_cache_file(table_file, lambda temp_file: template_table.assign(template_zero_padding = template_zero_padding)
+                                                                  .to_csv(temp_file, index = False))
+
+    return template_table
+
+
 def get_spike_amplitudes(spike_templates, templates, amplitudes):
 
     """
@@ -549,25 +927,9 @@ def getSortResults(output_dir):
     unqLabel, labelCounts = np.unique(cluLabel, return_counts = True)
     nTot = cluLabel.shape[0]
 
-    templates = np.load(os.path.join(output_dir, 'templates.npy'))
-    channel_map = np.load(os.path.join(output_dir, 'channel_map.npy'))
-    channel_map = np.squeeze(channel_map)
-    
-    # read in inverse of whitening matrix
-    w_inv = np.load((os.path.join(output_dir, 'whitening_mat_inv.npy')))
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nTemplate,],'uint32')
-    
-    # for each template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nTemplate):
-        currT = templates[i,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
+    # peak channel of each (unwhitened) template
+    peak_channels = load_template_table(output_dir)['peak_channel'].values.astype('uint32')
+    nTemplate = peak_channels.size
 
     clus_Table = np.zeros((nTemplate, 2), dtype='uint32')
     clus_Table[unqLabel, 0] = labelCounts
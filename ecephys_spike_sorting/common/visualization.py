@@ -3,7 +3,7 @@ import matplotlib.pyplot as plt
 
 from scipy.signal import butter, filtfilt, medfilt
 
-from .utils import (get_spike_depths, 
+from .utils import (load_spike_depths, 
                     get_spike_amplitudes,
                     load_kilosort_data,
                     rms)
@@ -146,9 +146,10 @@ def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], ex
                 load_kilosort_data(ks_directory, 
                     sample_rate, 
                     use_master_clock = False,
-                    include_pcs = True)
+                    include_pcs = True,
+                    mmap_mode = 'r')
 
-    spike_depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
+    spike_depths = load_spike_depths(ks_directory, spike_clusters, pc_features, pc_feature_ind, channel_pos)
     spike_amplitudes = get_spike_amplitudes(spike_templates, templates, amplitudes)
 
     if exclude_noise:
@@ -5,10 +5,11 @@ import subprocess
 import time
 
 import numpy as np
+from scipy.sparse import issparse, save_npz
 
-from ...common.utils import load_kilosort_data, getSortResults
+from ...common.utils import load_kilosort_data, getSortResults, load_template_table
 
-from .postprocessing import remove_double_counted_spikes
+from .postprocessing import find_double_counted_spikes, remove_spikes, compact_spikes_file
 
 def run_postprocessing(args):
 
@@ -22,59 +23,69 @@ def run_postprocessing(args):
     start = time.time()
     
     include_pcs = args['ks_postprocessing_params']['include_pcs']
+    output_dir = args['directories']['kilosort_output_directory']
     
-    if include_pcs:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-    else:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-        # empty arrays to stand in for the missing variables
-        pc_features = []
-        pc_feature_ind = []
-        template_features = []
-        
-
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
-    template_features, overlap_matrix, overlap_summary = \
-        remove_double_counted_spikes(spike_times, 
-                                     spike_clusters,
-                                     spike_templates, 
-                                     amplitudes, 
-                                     channel_map,
-                                     channel_pos,
-                                     templates, 
-                                     pc_features, 
-                                     pc_feature_ind, 
-                                     template_features,
-                                     cluster_amplitude,
-                                     args['ephys_params']['sample_rate'],
-                                     args['ks_postprocessing_params'])
+    # pc_features and template_features are not needed to find the duplicates; they
+    # are compacted on disk afterwards, so they are never loaded
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+    channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+                load_kilosort_data(output_dir, \
+                    args['ephys_params']['sample_rate'], \
+                    convert_to_seconds = False, \
+                    use_master_clock = False, \
+                    include_pcs = False )
+
+    keep, overlap_matrix, overlap_summary = \
+        find_double_counted_spikes(spike_times, 
+                                   spike_clusters,
+                                   channel_map,
+                                   channel_pos,
+                                   templates, 
+                                   cluster_amplitude,
+                                   args['ephys_params']['sample_rate'],
+                                   args['ks_postprocessing_params'],
+                                   template_table = load_template_table(output_dir))
+
+    spike_times, spike_clusters, spike_templates, amplitudes, _, _ = \
+        remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, [], [], 
+                      np.where(np.invert(keep))[0], False)
 
     print("Saving data...")
 
     # save data -- it's fine to overwrite existing files, because the original outputs are stored in rez.mat
-    output_dir = args['directories']['kilosort_output_directory']
-    np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
-    np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
-    np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
-    np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
-    
-    if args['ks_postprocessing_params']['include_pcs']:
-        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+    # all per-spike outputs are written to temporary files first, and only replace the originals
+    # once every one of them is written, so the spike arrays and features always match
+    temp_files = []
+
+    try:
+        if include_pcs:
+            for features_file in ('pc_features.npy', 'template_features.npy'):
+                temp_files.append(compact_spikes_file(os.path.join(output_dir, features_file), keep,
+                                                      args['ks_postprocessing_params']['feature_chunk_spikes']))
+
+        for spike_file, data in (('spike_times.npy', spike_times), ('amplitudes.npy', amplitudes),
+                                 ('spike_clusters.npy', spike_clusters), ('spike_templates.npy', spike_templates)):
+            temp_files.append(os.path.join(output_dir, spike_file) + '.tmp')
+            with open(temp_files[-1], 'wb') as f:
+                np.save(f, data)
+
+    except BaseException:
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        raise
+
+    for temp_file in temp_files:
+        os.replace(temp_file, temp_file[:-len('.tmp')])
         
-    np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
+    if issparse(overlap_matrix):
+        save_npz(os.path.join(output_dir, 'overlap_matrix.npz'), overlap_matrix)
+        if os.path.exists(os.path.join(output_dir, 'overlap_matrix.npy')):
+            os.remove(os.path.join(output_dir, 'overlap_matrix.npy'))
+    else:
+        np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
+        if os.path.exists(os.path.join(output_dir, 'overlap_matrix.npz')):
+            os.remove(os.path.join(output_dir, 'overlap_matrix.npz'))
     np.save(os.path.join(output_dir, 'overlap_summary.npy'), overlap_summary)
 
     # save the overlap_summary as a text file -- allows user to easily understand what happened
@@ -9,6 +9,8 @@ class PostprocessingParams(DefaultSchema):
     between_unit_overlap_window = Float(required=False, default=0.000166, help='Time window for removing overlapping spikes between two units.')
     between_unit_dist_um = Int(required=False, default=5, help='Number of channels (above and below peak channel) to search for overlapping spikes')
     deletion_mode = String(required=False, default='lowAmpCluster', help='lowAmpCluster or deleteFirst')
+    single_sweep = Boolean(required=False, default=True, help='Find between-unit duplicates for all neighbouring units in one sweep over the spikes in time order, and save overlap_matrix as a sparse matrix (overlap_matrix.npz); if false, compare each pair of units and save a dense overlap_matrix.npy')
+    feature_chunk_spikes = Int(required=False, default=100000, help='Number of spikes of pc_features.npy and template_features.npy to read at a time when removing the duplicates from them')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
 
 class InputParameters(ArgSchema):
@@ -1,13 +1,17 @@
+import os
+
 import numpy as np
 import pandas as pd
 from collections import OrderedDict
+from scipy.sparse import coo_matrix
 
-from ...common.utils import printProgressBar
+from ...common.utils import printProgressBar, get_template_table
+from ...common.cluster_index import ClusterIndex
 
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
                                  pc_feature_ind, template_features, cluster_amplitude, 
-                                 sample_rate, params, epochs = None):
+                                 sample_rate, params, epochs = None, template_table = None):
 
     """ Remove putative double-counted spikes from Kilosort outputs
 
@@ -38,8 +42,13 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         'between_unit_overlap_window' : time window for removing overlapping spikes
         'between_unit_channel_distance' : number of channels over which to search for overlapping spikes
         'include_pcs' : whether to update files pc_features and template_features. Should be 'true' unless these files are absent
+        'single_sweep' : find the overlapping spikes of all units at once (see find_between_unit_overlaps),
+            instead of comparing each pair of units
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    template_table : pandas.DataFrame
+        Peak channel of each template, from load_template_table (optional,
+        calculated from templates if not given)
 
     
     Outputs:
@@ -58,11 +67,52 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         projections of each spike onto the template features
     overlap_matrix : numpy.ndarray (num_clusters x num_clusters)
         Matrix indicating number of spikes removed for each pair of clusters
+        (scipy.sparse.coo_matrix with single_sweep)
+    overlap_summary : numpy.ndarray (num_clusters x 5)
+        Spikes removed from each cluster (see README)
+
+    """
+    keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, spike_clusters, channel_map,
+                                                                       channel_pos, templates, cluster_amplitude,
+                                                                       sample_rate, params, template_table)
+
+    # all removed spikes are deleted at once, so each array is copied only once
+    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
+                                                                        spike_clusters, 
+                                                                        spike_templates, 
+                                                                        amplitudes, 
+                                                                        pc_features, 
+                                                                        template_features, 
+                                                                        np.where(np.invert(keep))[0],
+                                                                        params['include_pcs'])
+
+    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+
+
+def find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, templates, 
+                               cluster_amplitude, sample_rate, params, template_table = None):
+
+    """ Finds putative double-counted spikes in Kilosort outputs, without removing them
+
+    Within-unit overlaps are found first; between-unit overlaps are then found among
+    the remaining spikes. Inputs are the same as for remove_double_counted_spikes.
+
+    Outputs:
+    --------
+    keep : numpy.ndarray (num_spikes x 0)
+        Boolean, False for the spikes to remove
+    overlap_matrix : numpy.ndarray (num_clusters x num_clusters)
+        Matrix indicating number of spikes removed for each pair of clusters
+        (scipy.sparse.coo_matrix with single_sweep)
+    overlap_summary : numpy.ndarray (num_clusters x 5)
+        Spikes removed from each cluster (see README)
 
     """
-    include_pcs = params['include_pcs']
 
-    peak_chan_idx = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+    if template_table is None:
+        template_table = get_template_table(templates, channel_map)
+
+    peak_chan_idx = template_table['peak_index'].values
 
     # to accomdate case where matlab writes out chan map as (1,nchan) instead of (nchan,1)
     channel_map = np.squeeze(channel_map);
@@ -76,12 +126,52 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     
     sorted_unit_list = unit_list[order]
 
-    overlap_matrix = np.zeros((num_clusters, num_clusters), dtype = 'int')
-    
-
     within_unit_overlap_samples = int(params['within_unit_overlap_window'] * sample_rate)
     between_unit_overlap_samples = int(params['between_unit_overlap_window'] * sample_rate)
 
+    keep = np.ones((len(spike_times),), dtype = 'bool')
+
+    if params['single_sweep']:
+
+        # position of each unit in the peak channel order, which is used for the rows
+        # and columns of overlap_matrix
+        unit_rank = np.zeros((num_clusters,), dtype = 'int')
+        unit_rank[order] = np.arange(num_clusters)
+
+        print('Removing within-unit overlapping spikes...')
+
+        spikes_to_remove, removed_per_unit = find_within_unit_overlaps(spike_times, spike_clusters, num_clusters,
+                                                                       within_unit_overlap_samples)
+
+        keep[spikes_to_remove] = False
+        remaining = np.where(keep)[0]
+
+        print('Removing between-unit overlapping spikes...')
+
+        neighbours = get_unit_neighbours(channel_pos[peak_chan_idx[:num_clusters]], params['between_unit_dist_um'])
+
+        spikes_to_remove, removed_from, removed_partner = find_between_unit_overlaps(spike_times[remaining], 
+                                                                                     spike_clusters[remaining], 
+                                                                                     unit_rank, neighbours, 
+                                                                                     cluster_amplitude,
+                                                                                     between_unit_overlap_samples, 
+                                                                                     params['deletion_mode'])
+
+        keep[remaining[spikes_to_remove]] = False
+
+        overlap_matrix = coo_matrix((np.concatenate((removed_per_unit[order], np.ones(removed_from.shape, dtype = 'int'))),
+                                     (np.concatenate((np.arange(num_clusters), unit_rank[removed_from])),
+                                      np.concatenate((np.arange(num_clusters), unit_rank[removed_partner])))),
+                                    shape = (num_clusters, num_clusters))
+        overlap_matrix.sum_duplicates()
+        overlap_matrix.eliminate_zeros()
+
+        overlap_summary = get_overlap_summary(overlap_matrix, spike_clusters[keep], sorted_unit_list)
+
+        return keep, overlap_matrix, overlap_summary
+
+    overlap_matrix = np.zeros((num_clusters, num_clusters), dtype = 'int')
+
     print('Removing within-unit overlapping spikes...')
 
     spikes_to_remove = np.zeros((0,), dtype = 'int')
@@ -98,14 +188,11 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
         spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                        spike_clusters, 
-                                                                        spike_templates, 
-                                                                        amplitudes, 
-                                                                        pc_features, 
-                                                                        template_features, 
-                                                                        spikes_to_remove,
-                                                                        include_pcs)
+    keep[spikes_to_remove] = False
+    remaining = np.where(keep)[0]
+
+    remaining_times = spike_times[remaining]
+    remaining_clusters = spike_clusters[remaining]
 
     print('Removing between-unit overlapping spikes...')
 
@@ -115,7 +202,7 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
         printProgressBar(idx1+1, len(unit_list))
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+        for_unit1 = np.where(remaining_clusters == unit_id1)[0]
         
         for idx2, unit_id2 in enumerate(unit_list[order]):
             
@@ -129,24 +216,19 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
                 amp1 = cluster_amplitude[unit_id1]
                 amp2 = cluster_amplitude[unit_id2]
                 
-                for_unit2 = np.where(spike_clusters == unit_id2)[0]
+                for_unit2 = np.where(remaining_clusters == unit_id2)[0]
 
-                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
+                to_remove1, to_remove2 = find_between_unit_overlap(remaining_times[for_unit1], remaining_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
 
                 overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
                 overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
 
                 spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
 
+    keep[remaining[spikes_to_remove]] = False
+
+    spike_clusters = spike_clusters[keep]
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                         spike_clusters,
-                                                                         spike_templates, 
-                                                                         amplitudes, 
-                                                                         pc_features, 
-                                                                         template_features, 
-                                                                         np.unique(spikes_to_remove),
-                                                                         include_pcs)
 #   build overlap summary 
     overlap_summary = np.zeros((num_clusters, 5), dtype=int )
     for idx1, unit_id1 in enumerate(unit_list[order]):
@@ -159,7 +241,7 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     new_order = np.argsort(overlap_summary[:,0])
     overlap_summary = overlap_summary[new_order,:]
 
-    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+    return keep, overlap_matrix, overlap_summary
 
                 
 def find_within_unit_overlap(spike_train, overlap_window = 5):
@@ -259,6 +341,228 @@ def find_between_unit_overlap(spike_train1, spike_train2, amp1, amp2, overlap_wi
     return spikes_to_remove1, spikes_to_remove2
 
 
+def find_within_unit_overlaps(spike_times, spike_clusters, num_clusters, overlap_window = 5):
+
+    """
+    Finds overlapping spikes within the spike train of every unit at once
+
+    Same as find_within_unit_overlap for each unit: of two consecutive spikes less
+    than overlap_window samples apart, the first is removed.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    num_clusters : int
+        Spikes of clusters with higher IDs are never removed
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+
+    Outputs:
+    --------
+    spikes_to_remove : numpy.ndarray
+        Indices of overlapping spikes
+    removed_per_unit : numpy.ndarray (num_clusters)
+        Number of spikes removed from each unit
+
+    """
+
+    cluster_index = ClusterIndex(spike_clusters, num_clusters)
+
+    grouped_clusters = cluster_index.group(np.squeeze(spike_clusters))
+    grouped_times = cluster_index.group(np.squeeze(spike_times))
+
+    overlapping = (np.diff(grouped_times) < overlap_window) * \
+                  (grouped_clusters[1:] == grouped_clusters[:-1]) * (grouped_clusters[1:] < num_clusters)
+
+    spikes_to_remove = cluster_index.order[:-1][overlapping]
+
+    removed_per_unit = np.bincount(grouped_clusters[:-1][overlapping], minlength = num_clusters)
+
+    return spikes_to_remove, removed_per_unit
+
+
+def get_unit_neighbours(peak_positions, max_distance):
+
+    """
+    Table of the pairs of units that are compared by find_between_unit_overlaps
+
+    Inputs:
+    -------
+    peak_positions : numpy.ndarray (num_clusters x 2)
+        X and Z coordinates of the peak channel of each unit
+    max_distance : float
+        Units whose peak channels are less than this distance apart (in um) are neighbours
+
+    Outputs:
+    --------
+    neighbours : numpy.ndarray (num_clusters x num_clusters)
+        Boolean, False on the diagonal
+
+    """
+
+    deltaX = peak_positions[np.newaxis, :, 0] - peak_positions[:, np.newaxis, 0]
+    deltaZ = peak_positions[np.newaxis, :, 1] - peak_positions[:, np.newaxis, 1]
+
+    neighbours = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 ) < max_distance
+
+    np.fill_diagonal(neighbours, False)
+
+    return neighbours
+
+
+def find_between_unit_overlaps(spike_times, spike_clusters, unit_rank, neighbours, cluster_amplitude, 
+                               overlap_window = 5, deletionMode = 'lowAmpCluster'):
+
+    """
+    Finds overlapping spikes between all pairs of neighbouring units, with one sweep
+    over the spikes in time order
+
+    The spikes are sorted once, and each spike is compared to the following spikes
+    until they are overlap_window samples or more apart, one lag at a time for all
+    spikes. Pairs from two neighbouring units give the same results as
+    find_between_unit_overlap for those units, for each pair of units: 
+
+    'lowAmpCluster' : the spike of the unit with the lower amplitude is removed (for
+        equal amplitudes, the spike of the unit that comes later in unit_rank)
+    'deleteFirst' : the later spike is removed (for simultaneous spikes, the spike of
+        the unit that comes later in unit_rank)
+
+    As for find_between_unit_overlap, this assumes that there are no overlapping
+    spikes within any unit, i.e. that within-unit overlaps were removed with a
+    window at least as long.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    unit_rank : numpy.ndarray (num_clusters)
+        Order in which the units are compared (see remove_double_counted_spikes)
+    neighbours : numpy.ndarray (num_clusters x num_clusters)
+        Pairs of units to compare, from get_unit_neighbours
+    cluster_amplitude : numpy.ndarray (num_clusters)
+        Amplitude of each unit
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+    deletionMode : 'lowAmpCluster' or 'deleteFirst'
+
+    Outputs:
+    --------
+    spikes_to_remove : numpy.ndarray
+        Index of the spike removed for each overlapping pair (a spike can be 
+        removed for more than one pair)
+    removed_from : numpy.ndarray
+        Unit of each removed spike
+    removed_partner : numpy.ndarray
+        The other unit of the pair
+
+    """
+
+    spike_times = np.squeeze(spike_times)
+    spike_clusters = np.squeeze(spike_clusters)
+
+    num_clusters = unit_rank.size
+
+    time_order = np.argsort(spike_times, kind = 'stable')
+    sorted_times = spike_times[time_order].astype('int64')
+    sorted_clusters = spike_clusters[time_order]
+
+    in_table = sorted_clusters < num_clusters
+    sorted_units = np.where(in_table, sorted_clusters, 0)
+
+    # empty arrays, for recordings without any remaining spikes
+    first = [np.zeros((0,), dtype = 'int')]
+    second = [np.zeros((0,), dtype = 'int')]
+
+    candidates = np.arange(sorted_times.size)
+    lag = 1
+
+    while candidates.size > 0:
+
+        candidates = candidates[candidates + lag < sorted_times.size]
+        candidates = candidates[sorted_times[candidates + lag] - sorted_times[candidates] < overlap_window]
+
+        partners = candidates + lag
+
+        is_pair = in_table[candidates] * in_table[partners] * \
+                  neighbours[sorted_units[candidates], sorted_units[partners]]
+
+        first.append(candidates[is_pair])
+        second.append(partners[is_pair])
+
+        lag += 1
+
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+
+    # unit1 and unit2 in the order of find_between_unit_overlap's arguments
+    first_is_unit1 = unit_rank[sorted_units[first]] < unit_rank[sorted_units[second]]
+    unit1_spike = np.where(first_is_unit1, first, second)
+    unit2_spike = np.where(first_is_unit1, second, first)
+
+    if deletionMode == 'deleteFirst':
+        remove_unit1 = (sorted_times[unit1_spike] > sorted_times[unit2_spike])
+    else:
+        remove_unit1 = cluster_amplitude[sorted_units[unit1_spike]] < cluster_amplitude[sorted_units[unit2_spike]]
+
+    removed = np.where(remove_unit1, unit1_spike, unit2_spike)
+    kept = np.where(remove_unit1, unit2_spike, unit1_spike)
+
+    return time_order[removed], sorted_units[removed], sorted_units[kept]
+
+
+def get_overlap_summary(overlap_matrix, spike_clusters, sorted_unit_list):
+
+    """
+    Summary of the spikes removed from each unit (see README), from a sparse overlap matrix
+
+    Inputs:
+    -------
+    overlap_matrix : scipy.sparse.coo_matrix (num_clusters x num_clusters)
+        Spikes removed from the unit in each row for overlaps with the unit in each
+        column, in the order of sorted_unit_list
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each remaining spike
+    sorted_unit_list : numpy.ndarray (num_clusters)
+        Unit of each row and column
+
+    Outputs:
+    --------
+    overlap_summary : numpy.ndarray (num_clusters x 5)
+        Sorted by unit
+
+    """
+
+    num_clusters = overlap_matrix.shape[0]
+
+    rows = overlap_matrix.row[overlap_matrix.data > 0]
+    cols = overlap_matrix.col[overlap_matrix.data > 0]
+    counts = overlap_matrix.data[overlap_matrix.data > 0]
+
+    within_unit = np.bincount(rows[rows == cols], counts[rows == cols], minlength = num_clusters)
+    between_unit = np.bincount(rows[rows != cols], counts[rows != cols], minlength = num_clusters)
+
+    # first column with the largest count in each row, as for numpy.argmax of the dense row
+    top_partner = np.zeros((num_clusters,), dtype = 'int')
+    entries = np.lexsort((cols, -counts, rows))
+    is_first = np.concatenate(([True], rows[entries][1:] != rows[entries][:-1]))[:entries.size]
+    top_partner[rows[entries][is_first]] = cols[entries][is_first]
+
+    overlap_summary = np.zeros((num_clusters, 5), dtype=int )
+    overlap_summary[:,0] = sorted_unit_list
+    overlap_summary[:,1] = np.bincount(np.squeeze(spike_clusters), minlength = num_clusters)[sorted_unit_list]
+    overlap_summary[:,2] = within_unit
+    overlap_summary[:,3] = between_unit
+    overlap_summary[:,4] = sorted_unit_list[top_partner]
+
+#   sort by label
+    return overlap_summary[np.argsort(overlap_summary[:,0]),:]
+
+
 def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, spikes_to_remove, include_pcs):
 
     """
@@ -302,3 +606,83 @@ def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_f
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features
 
+
+
+def remove_spikes_from_file(npy_file, keep, chunk_spikes = 100000):
+
+    """
+    Removes spikes from a per-spike .npy file (e.g. pc_features.npy) without loading it
+
+    The kept spikes are written to a new file next to it (see compact_spikes_file), 
+    which then replaces the original.
+
+    Inputs:
+    ------
+    npy_file : str
+        Path to an array with one row per spike
+    keep : numpy.ndarray (num_spikes x 0)
+        Boolean, False for the spikes to remove (from find_double_counted_spikes)
+    chunk_spikes : int
+        Number of spikes to read at a time
+
+    """
+
+    os.replace(compact_spikes_file(npy_file, keep, chunk_spikes), npy_file)
+
+
+def compact_spikes_file(npy_file, keep, chunk_spikes = 100000):
+
+    """
+    Writes the kept spikes of a per-spike .npy file to npy_file + '.tmp'
+
+    The file is read as a memmap in blocks of chunk_spikes spikes, so only one
+    block is held in memory at a time. The original file is not changed, and no
+    temporary file is left behind if compaction fails.
+
+    Inputs:
+    ------
+    npy_file : str
+        Path to an array with one row per spike
+    keep : numpy.ndarray (num_spikes x 0)
+        Boolean, False for the spikes to remove (from find_double_counted_spikes)
+    chunk_spikes : int
+        Number of spikes to read at a time
+
+    Outputs:
+    --------
+    temp_file : str
+        Path to the compacted array
+
+    """
+
+    source = np.load(npy_file, mmap_mode = 'r')
+
+    if source.shape[0] != keep.size:
+        raise ValueError(npy_file + ' has ' + str(source.shape[0]) + ' spikes, expected ' + str(keep.size))
+
+    temp_file = npy_file + '.tmp'
+
+    try:
+        compacted = np.lib.format.open_memmap(temp_file, mode = 'w+', dtype = source.dtype,
+                                              shape = (int(np.sum(keep)),) + source.shape[1:])
+
+        position = 0
+
+        for start in range(0, keep.size, chunk_spikes):
+
+            block = source[start:start + chunk_spikes][keep[start:start + chunk_spikes]]
+
+            compacted[position:position + block.shape[0]] = block
+            position += block.shape[0]
+
+        compacted.flush()
+
+        # close both maps before the file is moved
+        del source, compacted
+
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    return temp_file
@@ -6,13 +6,19 @@ import time
 
 import numpy as np
 import pandas as pd
-from scipy.io import loadmat
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import load_kilosort_data, load_template_table
+from ...common.probe_geometry import geometry_from_chan_map
+from ...common.fingerprints import get_cluster_fingerprints, load_fingerprints, save_fingerprints, compare_fingerprints
+from ...common.metrics_store import get_metrics_store_directory, write_metrics_group, list_metrics_groups, \
+                                    export_metrics_csv, import_metrics_csv
 
-from .extract_waveforms import extract_waveforms, writeDataAsNpy
+from .extract_waveforms import extract_waveforms, extract_waveforms_single_pass, writeDataAsNpy, copy_unchanged_waveforms, \
+                               get_sparse_channels, get_channels_file
 from .waveform_metrics import calculate_waveform_metrics
 from .metrics_from_file import metrics_from_file
+from .c_waves import calculate_c_waves
+from .waveform_store import get_waveform_store_file
 
 def calculate_mean_waveforms(args):
 
@@ -31,30 +37,61 @@ def calculate_mean_waveforms(args):
         clus_lbl_npy = os.path.join(args['directories']['kilosort_output_directory'], 'spike_clusters.npy' )
         dest, wavefile = os.path.split(args['mean_waveform_params']['mean_waveforms_file'])
         
+        # the channel_pos loaded from the phy output omits any sites excluded
+        # as noise by the kilosort_helper module, or excluded fow low spike rete
+        # by kilosort itself. The waveform metrics are calculated on ALL sites
+        # based on the mean waveforms calculated for each unit; therefore
+        # we need the site locations for all sites.
+        # load the channel map associated with this kilosort run; in kilosort_helper
+        # a copy is made next to the data file
+        input_file = args['ephys_params']['ap_band_file']
+        dat_dir, dat_fname = os.path.split(input_file)
+        dat_name, dat_ext = os.path.splitext(dat_fname)
+        chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
+        geometry = geometry_from_chan_map(chanMapMat, args['mean_waveform_params']['site_range'])
+        site_x, site_y = geometry.site_x, geometry.site_y
+
+        if args['mean_waveform_params']['use_C_Waves_binary']:
         
-        # path to the 'runit.bat' executable that calls C_Waves.
-        # Essential in linux where C_Waves executable is only callable through runit
-        if sys.platform.startswith('win'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.bat')
-        elif sys.platform.startswith('linux'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.sh')
+            # path to the 'runit.bat' executable that calls C_Waves.
+            # Essential in linux where C_Waves executable is only callable through runit
+            if sys.platform.startswith('win'):
+                exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.bat')
+            elif sys.platform.startswith('linux'):
+                exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.sh')
+            else:
+                print('unknown system, cannot run C_Waves')
+            
+            cwaves_cmd = [exe_path, 
+                          '-spikeglx_bin=' + spikeglx_bin,
+                          '-clus_table_npy=' + clus_table_npy,
+                          '-clus_time_npy=' + clus_time_npy,
+                          '-clus_lbl_npy=' + clus_lbl_npy,
+                          '-dest=' + dest,
+                          '-samples_per_spike=' + repr(args['mean_waveform_params']['samples_per_spike']),
+                          '-pre_samples=' + repr(args['mean_waveform_params']['pre_samples']),
+                          '-num_spikes=' + repr(args['mean_waveform_params']['spikes_per_epoch']),
+                          '-snr_radius=' + repr(args['mean_waveform_params']['snr_radius'])]
+                                    
+            print(' '.join(cwaves_cmd))
+            
+            # make the C_Waves call; arguments are passed as a list, so no shell is needed
+            subprocess.call(cwaves_cmd)
+
         else:
-            print('unknown system, cannot run C_Waves')
-        
-        cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                                ' -clus_table_npy=' + clus_table_npy + \
-                                ' -clus_time_npy=' + clus_time_npy + \
-                                ' -clus_lbl_npy=' + clus_lbl_npy + \
-                                ' -dest=' + dest + \
-                                ' -samples_per_spike=' + repr(args['mean_waveform_params']['samples_per_spike']) + \
-                                ' -pre_samples=' + repr(args['mean_waveform_params']['pre_samples']) + \
-                                ' -num_spikes=' + repr(args['mean_waveform_params']['spikes_per_epoch']) + \
-                                ' -snr_radius=' + repr(args['mean_waveform_params']['snr_radius'])
-                                
-        print(cwaves_cmd)
-        
-        # make the C_Waves call
-        subprocess.call(cwaves_cmd)
+
+            calculate_c_waves(spikeglx_bin, clus_table_npy, clus_time_npy, clus_lbl_npy, dest,
+                              args['mean_waveform_params']['samples_per_spike'],
+                              args['mean_waveform_params']['pre_samples'],
+                              args['mean_waveform_params']['spikes_per_epoch'],
+                              args['mean_waveform_params']['snr_radius'],
+                              args['ephys_params']['num_channels'],
+                              args['ephys_params']['bit_volts'],
+                              site_x, site_y,
+                              args['ephys_params']['vertical_site_spacing'],
+                              chunk_samples = args['mean_waveform_params']['chunk_samples'],
+                              num_workers = args['mean_waveform_params']['num_workers'],
+                              worker_memory_mb = args['mean_waveform_params']['worker_memory_mb'])
 
         
         # C_Waves writes out files of the waveforms and snr
@@ -66,23 +103,6 @@ def calculate_mean_waveforms(args):
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False)
                 
-        # read in inverse of whitening matrix
-        w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
-        
-        # the channel_pos loaded from the phy output omits any sites excluded
-        # as noise by the kilosort_helper module, or excluded fow low spike rete
-        # by kilosort itself. The waveform metrics are calculated on ALL sites
-        # based on the mean waveforms calculated for each unit; therefore
-        # we need the site locations for all sites.
-        # load the channel map associated with this kilosort run; in kilosort_helper
-        # a copy is made next to the data file
-        input_file = args['ephys_params']['ap_band_file']
-        dat_dir, dat_fname = os.path.split(input_file)
-        dat_name, dat_ext = os.path.splitext(dat_fname)
-        chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
-        site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
-        site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
-        
                 
         mean_waveform_fullpath = os.path.join(dest, 'mean_waveforms.npy')
         snr_fullpath = os.path.join(dest, 'cluster_snr.npy')
@@ -95,11 +115,14 @@ def calculate_mean_waveforms(args):
                     args['ephys_params']['bit_volts'], \
                     args['ephys_params']['sample_rate'], \
                     args['ephys_params']['vertical_site_spacing'], \
-                    w_inv, \
                     site_x, site_y, \
-                    args['mean_waveform_params'])
+                    args['mean_waveform_params'], \
+                    geometry, \
+                    load_template_table(args['directories']['kilosort_output_directory']))
                 
         metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'])      
+        save_fingerprints(get_cluster_fingerprints(spike_clusters, args['mean_waveform_params']), 
+                          args['mean_waveform_params']['mean_waveforms_file'])
         
     else:
         
@@ -114,31 +137,91 @@ def calculate_mean_waveforms(args):
                 load_kilosort_data(args['directories']['kilosort_output_directory'], \
                     args['ephys_params']['sample_rate'], \
                     convert_to_seconds = False)
+
+        template_table = load_template_table(args['directories']['kilosort_output_directory'])
     
-        print("Calculating mean waveforms...")
+        mean_waveforms_file = args['mean_waveform_params']['mean_waveforms_file']
+        waveform_metrics_file = args['waveform_metrics']['waveform_metrics_file']
+
+        fingerprints = get_cluster_fingerprints(spike_clusters, args['mean_waveform_params'])
+        units_to_update = None
+
+        if args['mean_waveform_params']['incremental'] and os.path.exists(waveform_metrics_file):
+            units_to_update = compare_fingerprints(load_fingerprints(mean_waveforms_file), fingerprints)
+
+        if units_to_update is not None:
+            print("Calculating mean waveforms for " + str(len(units_to_update)) + " updated units...")
+        else:
+            print("Calculating mean waveforms...")
     
-        waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
+        if args['mean_waveform_params']['single_pass']:
+            extract = extract_waveforms_single_pass
+        else:
+            extract = extract_waveforms
+
+        if args['mean_waveform_params']['sparse_channels'] > 0:
+            unit_channels = get_sparse_channels(templates, channel_map, channel_pos, 
+                                                args['ephys_params']['vertical_site_spacing'],
+                                                args['mean_waveform_params']['sparse_channels'],
+                                                template_table)
+        else:
+            unit_channels = None
+
+        if args['mean_waveform_params']['save_waveform_store']:
+            waveform_store_file = get_waveform_store_file(mean_waveforms_file)
+        else:
+            waveform_store_file = None
+
+        waveforms, spike_counts, coords, labels, metrics = extract(data, spike_times, \
                     spike_clusters,
                     templates,
                     channel_map,
                     args['ephys_params']['bit_volts'], \
                     args['ephys_params']['sample_rate'], \
                     args['ephys_params']['vertical_site_spacing'], \
-                    args['mean_waveform_params'])
+                    args['mean_waveform_params'],
+                    units_to_update = units_to_update,
+                    channel_pos = channel_pos,
+                    unit_channels = unit_channels,
+                    template_table = template_table,
+                    waveform_store_file = waveform_store_file)
     
-        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'])
+        if units_to_update is not None:
+            mean_waveforms, metrics = copy_unchanged_waveforms(waveforms[:, -1, 0, :, :], metrics, 
+                                                               np.load(mean_waveforms_file), 
+                                                               pd.read_csv(waveform_metrics_file, index_col=0), 
+                                                               units_to_update)
+            np.save(mean_waveforms_file, mean_waveforms)
+        else:
+            writeDataAsNpy(waveforms, mean_waveforms_file)
+
+        if waveform_store_file is not None:
+            waveforms.file.close()
+
+        if unit_channels is not None:
+            np.save(get_channels_file(mean_waveforms_file), unit_channels)
+        elif os.path.exists(get_channels_file(mean_waveforms_file)):
+            os.remove(get_channels_file(mean_waveforms_file))
+
+        metrics.to_csv(waveform_metrics_file)
+        save_fingerprints(fingerprints, mean_waveforms_file)
+
+
+    store_directory = get_metrics_store_directory(args['cluster_metrics'])
+    store_format = args['cluster_metrics']['metrics_store_format']
+
+    write_metrics_group(metrics, 'waveform_metrics', store_directory, store_format)
 
+    # quality metrics saved before the metrics store existed
+    if 'quality_metrics' not in list_metrics_groups(store_directory) and \
+            os.path.exists(args['cluster_metrics']['cluster_metrics_file']):
+        write_metrics_group(import_metrics_csv(args['cluster_metrics']['cluster_metrics_file'], metrics),
+                            'quality_metrics', store_directory, store_format)
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
-    if os.path.exists(args['cluster_metrics']['cluster_metrics_file']):
-        qmetrics = pd.read_csv(args['cluster_metrics']['cluster_metrics_file'])
-        qmetrics = qmetrics.drop(qmetrics.columns[0], axis='columns')
-        qmetrics = qmetrics.merge(pd.read_csv(args['waveform_metrics']['waveform_metrics_file'], index_col=0),
-                     on='cluster_id',
-                     suffixes=('_quality_metrics','_waveform_metrics'))  
+    if 'quality_metrics' in list_metrics_groups(store_directory):
         print("Saving merged quality metrics ...")
-        qmetrics.to_csv(args['cluster_metrics']['cluster_metrics_file'])
+        export_metrics_csv(store_directory, args['cluster_metrics']['cluster_metrics_file'])
         
     execution_time = time.time() - start
 
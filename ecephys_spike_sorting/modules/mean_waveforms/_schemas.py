@@ -13,8 +13,16 @@ class MeanWaveformParams(DefaultSchema):
     site_range = Int(require=False, default=16, help='Number of sites to use for 2D waveform metrics')
     cWaves_path = InputDir(require=False, help='directory containing the TPrime executable.')
     use_C_Waves = Bool(require=False, default=False, help='Use faster C routine to calculate mean waveforms')
+    use_C_Waves_binary = Bool(require=False, default=False, help='With use_C_Waves, run the C_Waves executable in cWaves_path instead of the built-in python implementation')
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
+    single_pass = Bool(require=False, default=True, help='Read the raw data once, in order, in blocks of chunk_samples samples, instead of reading each spike separately for every epoch (python only)')
+    chunk_samples = Int(require=False, default=100000, help='Number of samples to read at a time in single_pass mode')
+    num_workers = Int(require=False, default=1, help='Number of processes reading the raw data in single_pass mode; each reads a separate time shard')
+    worker_memory_mb = Float(require=False, default=2048.0, help='Approximate memory limit (in MB) for the blocks of raw data read by each process in single_pass mode; with several workers, the waveform accumulators are split into batches that fit in the same limit')
+    sparse_channels = Int(require=False, default=0, help='If > 0, only extract this many channels nearest the peak channel of each unit (python only); mean_waveforms_file then has shape (units x sparse_channels x samples), and the channels of each unit are saved next to it in a _channels.npy file. Use at least 2 x site_range channels for the same 2D metrics as a full extraction')
+    save_waveform_store = Bool(require=False, default=False, help='Also save the mean and std waveforms of every unit and epoch in a chunked, compressed HDF5 file next to mean_waveforms_file (_store.h5), written as each unit is finished rather than kept in memory; one unit can be loaded with read_unit_waveforms (python only)')
+    incremental = Bool(require=False, default=False, help='Only recalculate waveforms for clusters that changed since the last run, based on the fingerprints saved next to the mean waveforms file (python only)')
 
 
 class InputParameters(ArgSchema):
@@ -0,0 +1,222 @@
+import os
+
+import numpy as np
+import warnings
+
+from .extract_waveforms import accumulate_waveforms_in_shards
+from ...common.cluster_index import ClusterIndex
+
+SNR_SAMPLES = 15 # leading samples of each waveform used to estimate the noise
+
+
+def calculate_c_waves(spikeglx_bin,
+                      clus_table_npy,
+                      clus_time_npy,
+                      clus_lbl_npy,
+                      dest,
+                      samples_per_spike,
+                      pre_samples,
+                      num_spikes,
+                      snr_radius,
+                      num_channels,
+                      bit_volts,
+                      site_x,
+                      site_y,
+                      site_spacing,
+                      chunk_samples = 100000,
+                      num_workers = 1,
+                      worker_memory_mb = 2048.0):
+
+    """
+    Built-in replacement for the C_Waves executable: calculates the mean waveform
+    and SNR of each cluster, and writes them in the same format as C_Waves
+
+    Up to num_spikes spikes, evenly spaced through each cluster's spike train, are
+    averaged. The SNR is (Vmax - Vmin) of the mean waveform on the peak channel,
+    divided by twice the standard deviation of the residuals (spike - mean) over
+    the first 15 samples of all sites within snr_radius sites of the peak channel.
+    The residuals are never stored: their sum of squares is the M2 term of the
+    running variance (see waveform_stats).
+
+    Inputs:
+    -------
+    spikeglx_bin : str
+        Path to the AP band binary (int16, num_channels interleaved channels)
+    clus_table_npy : str
+        Path to clus_Table.npy (clusters x 2: spike count, peak channel), as
+        written by getSortResults
+    clus_time_npy : str
+        Path to spike_times.npy (in samples)
+    clus_lbl_npy : str
+        Path to spike_clusters.npy
+    dest : str
+        Output directory
+    samples_per_spike : int
+    pre_samples : int
+        Number of samples before the spike time
+    num_spikes : int
+        Maximum number of spikes per cluster
+    snr_radius : int
+        Radius (in sites) of the disk of channels used for the noise estimate
+    num_channels : int
+        Number of channels in the binary (including the sync channel)
+    bit_volts : float
+        Conversion factor from int16 to uV
+    site_x, site_y : numpy.ndarray
+        Positions (in um) of the probe sites; the mean waveforms include only
+        these channels (not the sync channel)
+    site_spacing : float
+        Vertical distance between sites (m), used to convert snr_radius to um
+    chunk_samples, num_workers, worker_memory_mb :
+        see accumulate_waveforms_in_shards
+
+    Outputs:
+    --------
+    mean_waveforms_file : str
+        Path to mean_waveforms.npy (clusters x sites x samples, float32, in uV)
+    snr_file : str
+        Path to cluster_snr.npy (clusters x 2: SNR, number of spikes averaged)
+
+    """
+
+    clus_table = np.load(clus_table_npy)
+    spike_times = np.squeeze(np.load(clus_time_npy, mmap_mode = 'r'))
+    spike_clusters = np.squeeze(np.load(clus_lbl_npy, mmap_mode = 'r'))
+
+    num_clusters = clus_table.shape[0]
+    peak_channels = clus_table[:, 1].astype('int')
+    num_sites = site_x.size
+
+    raw_data = np.memmap(spikeglx_bin, dtype = 'int16', mode = 'r')
+    raw_data = np.reshape(raw_data, (int(raw_data.size / num_channels), num_channels))
+
+    print("Selecting spikes...")
+
+    spike_samples, spike_units = select_uniform_spikes(spike_times, spike_clusters, num_clusters, num_spikes)
+
+    # spikes whose window extends beyond the data are skipped
+    starts = spike_samples.astype('int64') - pre_samples
+    valid = (starts >= 0) * (starts + samples_per_spike <= raw_data.shape[0])
+
+    order = np.argsort(starts[valid], kind = 'stable')
+
+    print("Reading waveforms...")
+
+    counts, means, m2 = accumulate_waveforms_in_shards(raw_data, starts[valid][order], spike_units[valid][order],
+                                                       num_clusters, samples_per_spike, bit_volts, chunk_samples,
+                                                       worker_memory_mb, num_workers)
+
+    mean_waveforms = means[:, :num_sites, :].astype('float32')
+
+    snr = calculate_disk_snr(counts, means[:, :num_sites, :], m2[:, :num_sites, :], peak_channels,
+                             site_x, site_y, snr_radius * site_spacing * 1e6)
+
+    cluster_snr = np.stack((snr, counts), axis = 1).astype('float32')
+
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+
+    mean_waveforms_file = os.path.join(dest, 'mean_waveforms.npy')
+    snr_file = os.path.join(dest, 'cluster_snr.npy')
+
+    np.save(mean_waveforms_file, mean_waveforms)
+    np.save(snr_file, cluster_snr)
+
+    return mean_waveforms_file, snr_file
+
+
+def select_uniform_spikes(spike_times, spike_clusters, num_clusters, num_spikes):
+
+    """
+    Selects up to num_spikes spikes per cluster, evenly spaced through the cluster's
+    spike train (every spike for clusters with fewer spikes)
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray
+        Spike times in samples, in ascending order
+    spike_clusters : numpy.ndarray
+        Cluster ID of each spike
+    num_clusters : int
+        Number of clusters (spikes with higher IDs are ignored)
+    num_spikes : int
+        Maximum number of spikes per cluster
+
+    Outputs:
+    --------
+    spike_samples : numpy.ndarray
+        Times of the selected spikes
+    spike_units : numpy.ndarray
+        Cluster of each selected spike
+
+    """
+
+    cluster_index = ClusterIndex(spike_clusters, num_clusters)
+
+    cluster_counts = cluster_index.counts[:num_clusters]
+    selected_counts = np.minimum(cluster_counts, num_spikes)
+
+    spike_units = np.repeat(np.arange(num_clusters), selected_counts)
+    rank = np.arange(spike_units.size) - np.repeat(np.cumsum(selected_counts) - selected_counts, selected_counts)
+
+    # position within each cluster's (time-ordered) spikes
+    position = (rank * cluster_counts[spike_units]) // selected_counts[spike_units]
+
+    spike_indices = cluster_index.order[cluster_index.offsets[spike_units] + position]
+
+    return np.asarray(spike_times[spike_indices]), spike_units
+
+
+def calculate_disk_snr(counts, means, m2, peak_channels, site_x, site_y, radius):
+
+    """
+    SNR of each cluster, from the running mean and variance of its waveforms
+
+    Inputs:
+    -------
+    counts : numpy.ndarray (clusters)
+        Number of waveforms averaged
+    means : numpy.ndarray (clusters x sites x samples)
+        Mean waveforms
+    m2 : numpy.ndarray (clusters x sites x samples)
+        Sum of squared residuals of the waveforms (see waveform_stats)
+    peak_channels : numpy.ndarray (clusters)
+        Peak site of each cluster
+    site_x, site_y : numpy.ndarray
+        Site positions (um)
+    radius : float
+        Radius (um) of the disk of sites used to estimate the noise
+
+    Outputs:
+    --------
+    snr : numpy.ndarray (clusters)
+        0 for clusters with fewer than two waveforms
+
+    """
+
+    num_clusters = counts.size
+
+    distance = np.sqrt((site_x[np.newaxis, :] - site_x[peak_channels][:, np.newaxis]) ** 2 +
+                       (site_y[np.newaxis, :] - site_y[peak_channels][:, np.newaxis]) ** 2)
+
+    in_disk = distance <= radius + 1e-6
+
+    residual_sum_of_squares = np.sum(np.sum(m2[:, :, :SNR_SAMPLES], 2) * in_disk, 1)
+
+    # one mean is estimated for each site and sample
+    degrees_of_freedom = (counts - 1) * np.sum(in_disk, 1) * np.min([SNR_SAMPLES, means.shape[2]])
+
+    peak_waveforms = means[np.arange(num_clusters), peak_channels, :]
+    amplitude = np.max(peak_waveforms, 1) - np.min(peak_waveforms, 1)
+
+    snr = np.zeros((num_clusters,))
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        has_spikes = (counts > 1) * (residual_sum_of_squares > 0)
+        snr[has_spikes] = amplitude[has_spikes] / \
+            (2 * np.sqrt(residual_sum_of_squares[has_spikes] / degrees_of_freedom[has_spikes]))
+
+    return snr
@@ -6,10 +6,17 @@ import xarray as xr
 import pandas as pd
 
 import warnings
+import multiprocessing
+from functools import partial
 
-from .waveform_metrics import calculate_waveform_metrics
+from .waveform_metrics import calculate_waveform_metrics_batch, calculate_snr_from_stats, get_site_positions
+from .waveform_stats import new_waveform_accumulator, add_waveform, update_waveform_accumulator, \
+                            merge_waveform_accumulators, get_mean_and_std
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
+from ...common.utils import printProgressBar, share_array, attach_shared_array, get_template_table
+from ...common.cluster_index import ClusterIndex
+from ...common.probe_geometry import ProbeGeometry
+from .waveform_store import create_waveform_store, close_waveform_store
 
 def extract_waveforms(raw_data, 
                       spike_times, 
@@ -20,7 +27,12 @@ def extract_waveforms(raw_data,
                       sample_rate, 
                       site_spacing, 
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      units_to_update=None,
+                      channel_pos=None,
+                      unit_channels=None,
+                      template_table=None,
+                      waveform_store_file=None):
     
     """
     Calculate mean waveforms for sorted units.
@@ -34,14 +46,25 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    units_to_update : only calculate waveforms and metrics for these cluster IDs (optional)
+    channel_pos : positions of the channels in channel_map, in um (optional)
+    unit_channels : channels to extract for each unit (units x K), e.g. from
+        get_sparse_channels (optional, default = all channels)
+    template_table : peak channel of each template, from load_template_table
+        (optional, calculated from templates if not given)
+    waveform_store_file : write the waveforms of each unit to this file as they are
+        calculated, instead of keeping them all in memory (optional, see
+        create_waveform_store)
 
     Outputs:
     -------
-    mean_waveforms : numpy array with dims :
+    mean_waveforms : numpy array (or, with waveform_store_file, the 'waveforms'
+    dataset of the store, which reads from the file when indexed and is closed
+    with mean_waveforms.file.close()) with dims :
      - 1 : clusterID
      - 2 : epochs
      - 3 : mean (0) or std (1)
-     - 4 : channels
+     - 4 : channels (or the K channels in unit_channels)
      - 5 : samples
     spike_count : numpy array with dims :
      - 1 : clusterID
@@ -71,7 +94,7 @@ def extract_waveforms(raw_data,
 
     # #############################################
 
-    metrics = pd.DataFrame()
+    metric_inputs = []
 
     if epochs is None:
         epochs = [Epoch('complete_session', 0, np.inf)]
@@ -80,12 +103,31 @@ def extract_waveforms(raw_data,
     total_units = len(cluster_ids)
     total_epochs = len(epochs)
 
+    total_channels = raw_data.shape[1] if unit_channels is None else unit_channels.shape[1]
+
     # allocate array for waveforms, datatype = default, double
-    mean_waveforms = np.zeros(
-        (total_units, total_epochs, 2, raw_data.shape[1], samples_per_spike))
+    if waveform_store_file is None:
+        mean_waveforms = np.zeros(
+            (total_units, total_epochs, 2, total_channels, samples_per_spike))
+    else:
+        store = create_waveform_store(waveform_store_file, cluster_ids, [epoch.name for epoch in epochs], 
+                                      total_channels, samples_per_spike, pre_samples, sample_rate, 
+                                      unit_channels, units_to_update)
+        mean_waveforms = store['waveforms']
+
     spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
 
-    peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
+    if template_table is None:
+        template_table = get_template_table(templates, channel_map)
+
+    peak_channels = template_table['peak_channel'].values
+
+    site_x, site_y = (channel_pos[:,0], channel_pos[:,1]) if channel_pos is not None else (None, None)
+
+    # the sites sampled for the 2D features only depend on the peak channel, unless 
+    # each unit has its own channels
+    geometry = get_probe_geometry(channel_map, site_x, site_y, site_spacing, site_range) \
+        if unit_channels is None else None
 
     for epoch_idx, epoch in enumerate(epochs):
 
@@ -99,15 +141,19 @@ def extract_waveforms(raw_data,
 
             printProgressBar(cluster_idx+1, total_units)
 
+            if units_to_update is not None and cluster_id not in units_to_update:
+                continue
+
             in_cluster = (spike_clusters[in_epoch] == cluster_id)
 
             if np.sum(in_cluster) > 0:
 
                 times_for_cluster = spike_times_in_epoch[in_cluster]
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
+                # running mean and variance, so individual waveforms are not kept
+                accumulator = new_waveform_accumulator(1, total_channels, samples_per_spike)
+
+                channels = slice(None) if unit_channels is None else unit_channels[cluster_idx]
 
                 np.random.shuffle(times_for_cluster)
 
@@ -117,47 +163,680 @@ def extract_waveforms(raw_data,
                 for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
                     start = int(peak_time-pre_samples)
                     end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
+                    rawWaveform = raw_data[start:end, channels].T
 
                     # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
-
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         epoch.name
-                                                                         )])
+                    if start >= 0 and rawWaveform.shape[1] == samples_per_spike:
+                        add_waveform(accumulator, 0, rawWaveform * bit_volts)
+
+                means, stds = get_mean_and_std(accumulator)
+
+                rows, unit_channel_map, unit_site_x, unit_site_y, peak_row = \
+                    get_metric_channels(cluster_idx, peak_channels, channel_map, site_x, site_y, unit_channels)
 
                 with warnings.catch_warnings():
 
                     warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
+                    snr = calculate_snr_from_stats(means[0, peak_row, :], stds[0, peak_row, :])
+
+                metric_inputs.append((means[0][rows, :], snr, cluster_id, peak_channels[cluster_idx],
+                                      unit_channel_map, epoch.name, unit_site_x, unit_site_y))
 
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
+                mean_waveforms[cluster_idx, epoch_idx, :, :, :] = np.stack((means[0] - means[0][:, :1], # remove offset
+                                                                            stds[0]))
 
                 spike_count[cluster_idx, epoch_idx] = total_waveforms
 
+    if waveform_store_file is not None:
+        mean_waveforms = close_waveform_store(store, spike_count, units_to_update)
+
+    metrics = get_waveform_metrics(metric_inputs, sample_rate, upsampling_factor, spread_threshold, 
+                                   site_range, site_spacing, geometry)
+
+    dimCoords, dimLabels = generateDimLabels(
+        cluster_ids, total_epochs, pre_samples, samples_per_spike, total_channels, sample_rate)
+
+    return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
+
+
+def extract_waveforms_single_pass(raw_data, 
+                                  spike_times, 
+                                  spike_clusters, 
+                                  templates, 
+                                  channel_map, 
+                                  bit_volts, 
+                                  sample_rate, 
+                                  site_spacing, 
+                                  params, 
+                                  epochs=None,
+                                  units_to_update=None,
+                                  channel_pos=None,
+                                  unit_channels=None,
+                                  template_table=None,
+                                  waveform_store_file=None):
+
+    """
+    Calculate mean waveforms for sorted units with one sequential pass over the raw data.
+
+    The spikes to average are selected for every cluster and epoch up front (the same
+    spikes as extract_waveforms, for the same random seed), sorted by time, and read 
+    from the binary in blocks of params['chunk_samples'] samples. Each block's spike
+    waveforms are added to the running mean and variance of their cluster and epoch
+    (see waveform_stats), so the file is read once in order, rather than once per
+    epoch in random order.
+
+    With num_workers > 1, the selected spikes are split into consecutive time shards,
+    which are read by separate processes; their accumulators are merged at the end.
+
+    Inputs, outputs and parameters are the same as for extract_waveforms, plus:
+
+    chunk_samples : number of samples to read from raw_data at a time
+    num_workers : number of processes reading the raw data
+    worker_memory_mb : approximate memory limit for each process (see accumulate_waveforms_in_shards)
+
+    """
+
+    samples_per_spike = params['samples_per_spike']
+    pre_samples = params['pre_samples']
+    spikes_per_epoch = params['spikes_per_epoch']
+    chunk_samples = params['chunk_samples']
+
+    if epochs is None:
+        epochs = [Epoch('complete_session', 0, np.inf)]
+
+    cluster_ids = np.arange(np.max(spike_clusters) + 1)
+    total_units = len(cluster_ids)
+    total_epochs = len(epochs)
+    total_channels = raw_data.shape[1] if unit_channels is None else unit_channels.shape[1]
+
+    if template_table is None:
+        template_table = get_template_table(templates, channel_map)
+
+    peak_channels = template_table['peak_channel'].values
+
+    site_x, site_y = (channel_pos[:,0], channel_pos[:,1]) if channel_pos is not None else (None, None)
+
+    # the sites sampled for the 2D features only depend on the peak channel, unless 
+    # each unit has its own channels
+    geometry = get_probe_geometry(channel_map, site_x, site_y, site_spacing, params['site_range']) \
+        if unit_channels is None else None
+
+    print("Selecting spikes...")
+
+    spike_samples, spike_units, spike_epochs, spike_slots, spike_count = \
+        select_waveform_spikes(spike_times, spike_clusters, total_units, epochs, sample_rate, spikes_per_epoch, units_to_update)
+
+    # spikes whose window extends beyond the data are skipped, as in extract_waveforms
+    starts = spike_samples.astype('int64') - pre_samples
+    valid = (starts >= 0) * (starts + samples_per_spike <= raw_data.shape[0])
+
+    order = np.argsort(starts[valid], kind = 'stable')
+    starts = starts[valid][order]
+    slot_index = (spike_units[valid] * total_epochs + spike_epochs[valid])[order]
+
+    print("Reading waveforms...")
+
+    if unit_channels is not None:
+        slot_channels = np.repeat(unit_channels[:total_units], total_epochs, axis = 0)
+    else:
+        slot_channels = None
+
+    accumulator = accumulate_waveforms_in_shards(raw_data, starts, slot_index, total_units * total_epochs, 
+                                                 samples_per_spike, bit_volts, chunk_samples, 
+                                                 params['worker_memory_mb'], params['num_workers'],
+                                                 slot_channels)
+
+    means, stds = get_mean_and_std(accumulator)
+    del accumulator # only the means and stds are kept while the output is filled
+
+    if waveform_store_file is None:
+        mean_waveforms = np.zeros((total_units, total_epochs, 2, total_channels, samples_per_spike))
+    else:
+        store = create_waveform_store(waveform_store_file, cluster_ids, [epoch.name for epoch in epochs], 
+                                      total_channels, samples_per_spike, pre_samples, sample_rate, 
+                                      unit_channels, units_to_update)
+        mean_waveforms = store['waveforms']
+
+    metric_inputs = []
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        for cluster_idx, cluster_id in enumerate(cluster_ids):
+
+            if spike_count[cluster_idx, epoch_idx] == 0:
+                continue
+
+            slot = cluster_idx * total_epochs + epoch_idx
+
+            rows, unit_channel_map, unit_site_x, unit_site_y, peak_row = \
+                get_metric_channels(cluster_idx, peak_channels, channel_map, site_x, site_y, unit_channels)
+
+            with warnings.catch_warnings():
+
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                snr = calculate_snr_from_stats(means[slot, peak_row, :], stds[slot, peak_row, :])
+
+            metric_inputs.append((means[slot][rows, :], snr, cluster_id, peak_channels[cluster_idx],
+                                  unit_channel_map, epoch.name, unit_site_x, unit_site_y))
+
+            mean_waveforms[cluster_idx, epoch_idx, :, :, :] = np.stack((means[slot] - means[slot][:, :1], # remove offset
+                                                                        stds[slot]))
+
+    if waveform_store_file is not None:
+        mean_waveforms = close_waveform_store(store, spike_count, units_to_update)
+
+    metrics = get_waveform_metrics(metric_inputs, sample_rate, params['upsampling_factor'], 
+                                   params['spread_threshold'], params['site_range'], site_spacing, geometry)
+
     dimCoords, dimLabels = generateDimLabels(
-        cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
+        cluster_ids, total_epochs, pre_samples, samples_per_spike, total_channels, sample_rate)
 
     return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
 
 
+def accumulate_waveforms_in_shards(raw_data, 
+                                   starts, 
+                                   slot_index, 
+                                   num_slots, 
+                                   samples_per_spike, 
+                                   bit_volts, 
+                                   chunk_samples, 
+                                   max_memory_mb, 
+                                   num_workers = 1,
+                                   slot_channels = None):
+
+    """
+    Splits the spikes into time shards with equal numbers of spikes, accumulates 
+    each shard in a process pool (see accumulate_waveforms), and merges the results
+
+    With one process, the waveforms are added directly to the output accumulator.
+    With more, if the accumulators of all slots take more than half of max_memory_mb, 
+    the slots are processed in batches (one pass through the spikes of each batch), 
+    so each worker only holds the accumulators of one batch.
+
+    raw_data is shared with the workers by reference to its file if it is a memmap,
+    or through shared memory otherwise.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray (samples x channels)
+    starts : numpy.ndarray
+        First sample of each spike waveform, sorted
+    slot_index : numpy.ndarray
+        Accumulator slot (cluster and epoch) of each spike
+    num_slots : int
+        Total number of slots
+    num_workers : int
+        Number of processes (at most the number of CPUs)
+    slot_channels : numpy.ndarray (num_slots x K)
+        Channels to read for each slot (optional, default = all channels)
+
+    Outputs:
+    --------
+    accumulator : tuple of numpy.ndarray
+        Mean and variance of the waveforms in each slot (see new_waveform_accumulator)
+
+    """
+
+    num_workers = int(np.min([num_workers, multiprocessing.cpu_count(), max(starts.size, 1)]))
+
+    num_channels = raw_data.shape[1] if slot_channels is None else slot_channels.shape[1]
+
+    accumulator = new_waveform_accumulator(num_slots, num_channels, samples_per_spike)
+
+    slots_per_batch = max(num_slots, 1)
+
+    shm = None
+    pool = None
+
+    if num_workers > 1:
+        slot_bytes = 2 * num_channels * samples_per_spike * 8
+        slots_per_batch = int(np.clip(max_memory_mb * 1024 ** 2 / 2 / slot_bytes, 1, slots_per_batch))
+
+        shm, spec = share_array(raw_data)
+        pool = multiprocessing.Pool(num_workers, initializer = _init_waveform_worker, initargs = (spec,))
+
+    try:
+        for batch_start in range(0, max(num_slots, 1), slots_per_batch):
+
+            batch_end = min(batch_start + slots_per_batch, num_slots)
+
+            if batch_start > 0 or batch_end < num_slots:
+                print('Slots ' + str(batch_start) + ' to ' + str(batch_end) + ' of ' + str(num_slots))
+
+            in_batch = (slot_index >= batch_start) * (slot_index < batch_end)
+            batch_starts = starts[in_batch]
+            batch_index = slot_index[in_batch] - batch_start
+            batch_channels = None if slot_channels is None else slot_channels[batch_start:batch_end]
+
+            # the slots of this batch, as views into the output
+            batch_accumulator = tuple(values[batch_start:batch_end] for values in accumulator)
+
+            if pool is not None:
+
+                bounds = np.linspace(0, batch_starts.size, num_workers + 1).astype('int')
+
+                shard_results = pool.starmap(partial(_waveform_worker, 
+                                                     samples_per_spike = samples_per_spike,
+                                                     bit_volts = bit_volts,
+                                                     chunk_samples = chunk_samples,
+                                                     max_memory_mb = max_memory_mb,
+                                                     slot_channels = batch_channels),
+                                             [(batch_starts[first:last], batch_index[first:last]) 
+                                              for first, last in zip(bounds[:-1], bounds[1:])], chunksize = 1)
+
+                for shard_slots, shard_accumulator in shard_results:
+                    merge_waveform_accumulators(batch_accumulator, shard_accumulator, shard_slots)
+
+            else:
+                accumulate_waveforms(raw_data, batch_starts, batch_index, samples_per_spike, bit_volts, 
+                                     chunk_samples, max_memory_mb, batch_channels, show_progress = True,
+                                     accumulator = batch_accumulator)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    return accumulator
+
+
+def accumulate_waveforms(raw_data, 
+                         starts, 
+                         slot_index, 
+                         samples_per_spike, 
+                         bit_volts, 
+                         chunk_samples, 
+                         max_memory_mb, 
+                         slot_channels = None,
+                         show_progress = False,
+                         accumulator = None):
+
+    """
+    Reads spike waveforms from raw_data in order, in blocks of at most chunk_samples 
+    samples, and adds them to the running mean and variance of their slot
+
+    Unless an accumulator is given, only the slots that occur in slot_index are 
+    allocated, so shards that contain a subset of the clusters use less memory.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray (samples x channels)
+    starts : numpy.ndarray
+        First sample of each spike waveform, sorted
+    slot_index : numpy.ndarray
+        Accumulator slot (cluster and epoch) of each spike
+    samples_per_spike : int
+    bit_volts : float
+    chunk_samples : int
+        Maximum number of samples to read at a time
+    max_memory_mb : float
+        Approximate memory limit (see get_block_sizes)
+    slot_channels : numpy.ndarray (num_slots x K)
+        Channels to read for each slot (optional, default = all channels)
+    show_progress : bool
+        Show a progress bar
+    accumulator : tuple of numpy.ndarray
+        Accumulator of all slots to add the waveforms to (optional, updated in place)
+
+    Outputs:
+    --------
+    shard_slots : numpy.ndarray
+        Slot of each entry in shard_accumulator
+    shard_accumulator : tuple of numpy.ndarray
+        Mean and variance of the waveforms in each slot
+
+    """
+
+    if accumulator is None:
+        shard_slots, local_slots = np.unique(slot_index, return_inverse = True)
+    else:
+        shard_slots, local_slots = np.arange(accumulator[0].size), slot_index
+
+    if slot_channels is not None:
+        shard_channels = slot_channels[shard_slots]
+        num_channels = shard_channels.shape[1]
+    else:
+        num_channels = raw_data.shape[1]
+
+    if accumulator is None:
+        accumulator = new_waveform_accumulator(shard_slots.size, num_channels, samples_per_spike)
+
+    chunk_samples, max_spikes = get_block_sizes(raw_data.shape[1], samples_per_spike, chunk_samples, 
+                                                 max_memory_mb, num_channels)
+
+    offsets = np.arange(samples_per_spike)
+    first = 0
+
+    while first < starts.size:
+
+        last = min(np.searchsorted(starts, starts[first] + chunk_samples), first + max_spikes)
+
+        # one read per block, extended to cover the last spike's window
+        block_start = starts[first]
+        block = np.asarray(raw_data[block_start:starts[last-1] + samples_per_spike, :])
+
+        samples = (starts[first:last] - block_start)[:, np.newaxis] + offsets[np.newaxis, :]
+
+        if slot_channels is not None:
+            snippets = block[samples[:, :, np.newaxis], shard_channels[local_slots[first:last]][:, np.newaxis, :]]
+        else:
+            snippets = block[samples, :]
+
+        snippets = np.transpose(snippets, (0, 2, 1)) * bit_volts
+
+        update_waveform_accumulator(accumulator, local_slots[first:last], snippets)
+
+        if show_progress:
+            printProgressBar(last, starts.size)
+
+        first = last
+
+    return shard_slots, accumulator
+
+
+def get_block_sizes(num_channels, samples_per_spike, chunk_samples, max_memory_mb, num_waveform_channels = None):
+
+    """
+    Number of samples and spikes to read at a time, so that the blocks read by 
+    accumulate_waveforms use about half of max_memory_mb
+
+    The other half is left for the waveform accumulators (see 
+    accumulate_waveforms_in_shards); the blocks' half is split between the raw 
+    data block and the temporary float64 copies of the block's waveforms.
+
+    num_channels is the number of channels in the raw data, and num_waveform_channels 
+    the number extracted for each spike (default = all).
+
+    Outputs:
+    --------
+    chunk_samples : int
+        Maximum number of samples per block (at most the requested chunk_samples)
+    max_spikes : int
+        Maximum number of spikes per block
+
+    """
+
+    if num_waveform_channels is None:
+        num_waveform_channels = num_channels
+
+    available_bytes = max_memory_mb * 1024 ** 2 / 2
+
+    bytes_per_sample = num_channels * 2 * 2 # int16 block, plus a copy if raw_data is a memmap
+    bytes_per_spike = num_waveform_channels * samples_per_spike * 8 * 4 # float64 waveforms and temporary arrays
+
+    chunk_samples = int(np.clip(available_bytes / 2 / bytes_per_sample - samples_per_spike, 1, chunk_samples))
+    max_spikes = int(np.max([available_bytes / 2 / bytes_per_spike, 1]))
+
+    return chunk_samples, max_spikes
+
+
+_worker_data = {}
+
+def _init_waveform_worker(raw_data_spec):
+
+    """ Attaches a pool worker to the raw data """
+
+    _worker_data['shm'], _worker_data['raw_data'] = attach_shared_array(raw_data_spec)
+
+
+def _waveform_worker(starts, slot_index, samples_per_spike, bit_volts, chunk_samples, max_memory_mb, slot_channels):
+
+    return accumulate_waveforms(_worker_data['raw_data'], starts, slot_index, samples_per_spike, bit_volts, 
+                                chunk_samples, max_memory_mb, slot_channels)
+
+
+def get_sparse_channels(templates, channel_map, channel_pos, site_spacing, num_channels, template_table = None):
+
+    """
+    Channels nearest the peak channel of each template, for sparse waveform extraction
+
+    Inputs:
+    -------
+    templates : numpy.ndarray (units x samples x channels in channel_map)
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    channel_pos : numpy.ndarray (channels in channel_map x 2)
+        Channel positions in um (None = Neuropixels 1.0 layout, see get_site_positions)
+    site_spacing : float
+        Vertical distance between sites (m), used if channel_pos is None
+    num_channels : int
+        Number of channels (K) per unit
+    template_table : pandas.DataFrame (optional)
+        Peak channel of each template (see load_template_table)
+
+    Outputs:
+    --------
+    unit_channels : numpy.ndarray (units x K)
+        Channels (in the raw data) of each unit, in ascending order, including 
+        the peak channel
+
+    """
+
+    if channel_pos is None:
+        channel_pos = np.stack(get_site_positions(channel_map, site_spacing), axis = 1)
+
+    num_channels = np.min([num_channels, channel_map.size])
+
+    if template_table is None:
+        template_table = get_template_table(templates, channel_map)
+
+    peak_index = template_table['peak_index'].values
+
+    distances = np.sum((channel_pos[np.newaxis, :, :] - channel_pos[peak_index][:, np.newaxis, :]) ** 2, 2)
+
+    nearest = np.argsort(distances, axis = 1, kind = 'stable')[:, :num_channels]
+
+    return np.sort(channel_map[nearest], axis = 1)
+
+
+def get_waveform_metrics(metric_inputs, sample_rate, upsampling_factor, spread_threshold, site_range, site_spacing,
+                         geometry = None):
+
+    """
+    Waveform metrics of all units and epochs, calculated in one batch
+
+    Inputs:
+    -------
+    metric_inputs : list of tuples
+        (mean waveform, snr, cluster_id, peak_channel, channel_map, epoch_name, site_x, site_y)
+        for each unit and epoch, as returned by get_metric_channels
+    geometry : ProbeGeometry (optional)
+        Sites for the 2D features, if all units have the same channels (see get_probe_geometry)
+    Other inputs are as for calculate_waveform_metrics_batch
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+        One row per unit and epoch, in the order of metric_inputs
+
+    """
+
+    if len(metric_inputs) == 0:
+        return pd.DataFrame()
+
+    mean_2D_waveforms, snr, cluster_ids, peak_channels, channel_maps, epoch_names, site_x, site_y = zip(*metric_inputs)
+
+    if site_x[0] is None or site_y[0] is None:
+        site_x, site_y = None, None
+    else:
+        site_x, site_y = np.stack(site_x), np.stack(site_y)
+
+    return calculate_waveform_metrics_batch(np.stack(mean_2D_waveforms),
+                                            np.array(snr),
+                                            np.array(cluster_ids),
+                                            np.array(peak_channels),
+                                            np.stack(channel_maps),
+                                            sample_rate,
+                                            upsampling_factor,
+                                            spread_threshold,
+                                            site_range,
+                                            site_spacing,
+                                            list(epoch_names),
+                                            site_x,
+                                            site_y,
+                                            geometry)
+
+
+def get_probe_geometry(channel_map, site_x, site_y, site_spacing, site_range):
+
+    """ ProbeGeometry for the channels in channel_map (Neuropixels 1.0 layout if site_x and site_y are None) """
+
+    if site_x is None or site_y is None:
+        site_x, site_y = get_site_positions(channel_map, site_spacing)
+
+    return ProbeGeometry(site_x, site_y, site_range)
+
+
+def get_metric_channels(cluster_idx, peak_channels, channel_map, site_x, site_y, unit_channels = None):
+
+    """
+    Mean waveform rows and channel positions to use for the metrics of one unit
+
+    Outputs:
+    --------
+    rows : numpy.ndarray
+        Rows of the mean waveform on the channels in channel_map, or all rows 
+        if only the unit's channels were extracted
+    unit_channel_map : numpy.ndarray
+        Channel of each of these rows (channel_map argument of the metrics functions)
+    unit_site_x, unit_site_y : numpy.ndarray
+        Positions of these channels (None if site_x and site_y are None)
+    peak_row : int
+        Row of the peak channel in the mean waveform
+
+    """
+
+    if unit_channels is None:
+        return channel_map, channel_map, site_x, site_y, peak_channels[cluster_idx]
+
+    channels = unit_channels[cluster_idx]
+
+    # position of each channel in channel_map
+    local_index = np.argmax(channel_map[np.newaxis, :] == channels[:, np.newaxis], axis = 1)
+
+    if site_x is not None and site_y is not None:
+        site_x, site_y = site_x[local_index], site_y[local_index]
+
+    peak_row = np.where(channels == peak_channels[cluster_idx])[0][0]
+
+    return np.arange(channels.size), channels, site_x, site_y, peak_row
+
+
+def select_waveform_spikes(spike_times, spike_clusters, total_units, epochs, sample_rate, spikes_per_epoch, units_to_update = None):
+
+    """
+    Randomly selects up to spikes_per_epoch spikes per cluster and epoch
+
+    The spikes are shuffled in the same order as in extract_waveforms, so both
+    select the same spikes for the same random seed.
+
+    Inputs:
+    -------
+    spike_times : spike times (in samples)
+    spike_clusters : cluster IDs for each spike time
+    total_units : number of clusters (max cluster ID + 1)
+    epochs : list of Epoch objects
+    sample_rate : Hz
+    spikes_per_epoch : max number of spikes per cluster and epoch
+    units_to_update : only select spikes for these cluster IDs (optional)
+
+    Outputs:
+    --------
+    spike_samples : numpy.ndarray
+        Time (in samples) of each selected spike
+    spike_units : numpy.ndarray
+        Cluster ID of each selected spike
+    spike_epochs : numpy.ndarray
+        Epoch index of each selected spike
+    spike_slots : numpy.ndarray
+        Position of each spike within the selection for its cluster and epoch
+    spike_count : numpy.ndarray (clusters x epochs + 1)
+        Number of selected spikes
+
+    """
+
+    spike_count = np.zeros((total_units, len(epochs) + 1), dtype = 'int')
+
+    selected = []
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+
+        cluster_index = ClusterIndex(spike_clusters[in_epoch], total_units)
+        grouped_times = cluster_index.group(spike_times[in_epoch])
+
+        for cluster_id in cluster_index.cluster_ids:
+
+            if units_to_update is not None and cluster_id not in units_to_update:
+                continue
+
+            times_for_cluster = grouped_times[cluster_index.slice(cluster_id)].copy()
+
+            np.random.shuffle(times_for_cluster)
+
+            total_waveforms = np.min([times_for_cluster.size, spikes_per_epoch])
+
+            selected.append((times_for_cluster[:total_waveforms], cluster_id, epoch_idx))
+
+            spike_count[cluster_id, epoch_idx] = total_waveforms
+
+    if len(selected) == 0:
+        empty = np.zeros((0,), dtype = 'int')
+        return empty, empty, empty, empty, spike_count
+
+    spike_samples = np.concatenate([times for times, cluster_id, epoch_idx in selected])
+    spike_units = np.concatenate([np.ones((times.size,), dtype = 'int') * cluster_id for times, cluster_id, epoch_idx in selected])
+    spike_epochs = np.concatenate([np.ones((times.size,), dtype = 'int') * epoch_idx for times, cluster_id, epoch_idx in selected])
+    spike_slots = np.concatenate([np.arange(times.size) for times, cluster_id, epoch_idx in selected])
+
+    return spike_samples, spike_units, spike_epochs, spike_slots, spike_count
+
+
+def copy_unchanged_waveforms(mean_waveforms, metrics, previous_waveforms, previous_metrics, units_to_update):
+
+    """ Combine waveforms and metrics for updated units with the previous outputs for all other units
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (units x channels x samples)
+        Overall mean waveforms (as saved by writeDataAsNpy), for the updated units
+    metrics : pandas.DataFrame
+        Waveform metrics for the updated units
+    previous_waveforms : numpy.ndarray (units x channels x samples)
+        Contents of the existing mean waveforms file
+    previous_metrics : pandas.DataFrame
+        Contents of the existing waveform metrics file
+    units_to_update : numpy.ndarray
+        IDs of units whose waveforms were recalculated
+
+    Outputs:
+    --------
+    mean_waveforms : numpy.ndarray (units x channels x samples)
+    metrics : pandas.DataFrame
+        Same layout as the outputs of a full run
+
+    """
+
+    num_previous = np.min([previous_waveforms.shape[0], mean_waveforms.shape[0]])
+
+    unchanged = np.ones((num_previous,), dtype = 'bool')
+    unchanged[units_to_update[units_to_update < num_previous]] = False
+
+    mean_waveforms[:num_previous][unchanged] = previous_waveforms[:num_previous][unchanged]
+
+    previous_metrics = previous_metrics[np.invert(np.isin(previous_metrics['cluster_id'], units_to_update)) * \
+                                        (previous_metrics['cluster_id'] < mean_waveforms.shape[0])]
+
+    metrics = pd.concat([previous_metrics, metrics])
+    metrics = metrics.iloc[np.argsort(metrics['cluster_id'].values, kind = 'stable')]
+
+    return mean_waveforms, metrics
+
+
 def generateDimLabels(good_clusters, num_epochs, pre_samples, total_samples, num_channels, sample_rate):
     """ Generate dimension labels and coordinates for the xarray """
 
@@ -208,3 +887,9 @@ def writeDataAsNpy(waveforms, output_file):
     mean_waveforms = waveforms[:, -1, 0, :, :]  # extract overall mean
 
     np.save(output_file, mean_waveforms)
+
+
+def get_channels_file(output_file):
+    """ Location of the channel table saved with sparse mean waveforms """
+
+    return os.path.splitext(output_file)[0] + '_channels.npy'
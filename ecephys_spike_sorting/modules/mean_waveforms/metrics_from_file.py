@@ -3,13 +3,13 @@ import os
 import glob
 
 import xarray as xr
-import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics_from_avg
+from .waveform_metrics import calculate_waveform_metrics_batch
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
+from ...common.probe_geometry import ProbeGeometry
+from ...common.utils import get_template_table
 
 def metrics_from_file(mean_waveform_fullpath,
                       snr_fullpath,
@@ -20,10 +20,11 @@ def metrics_from_file(mean_waveform_fullpath,
                       bit_volts, 
                       sample_rate, 
                       site_spacing, 
-                      w_inv,
                       site_x,
                       site_y,
-                      params):
+                      params,
+                      geometry = None,
+                      template_table = None):
                      
     
     """
@@ -40,8 +41,10 @@ def metrics_from_file(mean_waveform_fullpath,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : um (now unused)
-    w_inv : inverse of the whitening matrix used in KS2
     site_x, site_y: x and y coordinates of all channels, in um
+    geometry : ProbeGeometry for site_x and site_y (optional, built here if not given)
+    template_table : peak channel of each template, from load_template_table (optional,
+        calculated from the unwhitened templates if not given)
 
     Outputs:
     -------
@@ -78,8 +81,6 @@ def metrics_from_file(mean_waveform_fullpath,
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
     
@@ -88,40 +89,32 @@ def metrics_from_file(mean_waveform_fullpath,
 
     channel_map = np.squeeze(channel_map)
     
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nTemplate,],'uint32')
-    # for each template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0,nTemplate):
-        currT = templates[i,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
-    
-    for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(cluster_idx+1, total_units)
-
-        snr = snr_array[cluster_idx,0]
-        nSpike = snr_array[cluster_idx,1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
-        if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
-                                                                     snr,
-                                                                     cluster_id, 
-                                                                     peak_channels[cluster_idx], 
-                                                                     channel_map,
-                                                                     sample_rate, 
-                                                                     upsampling_factor,
-                                                                     spread_threshold,
-                                                                     site_range,
-                                                                     site_x, site_y                                                                    
-                                                                     )])
-
+    if template_table is None:
+        template_table = get_template_table(templates, channel_map)
 
+    peak_channels = template_table['peak_channel'].values
+    
+    # units with at least one spike; the waveforms include all sites, so the 
+    # peak channel is also the row of the peak site
+    has_spikes = snr_array[:total_units, 1] > 0
+    num_sites = mean_waveforms.shape[1]
+
+    if geometry is None:
+        geometry = ProbeGeometry(site_x, site_y, site_range)
+
+    metrics = calculate_waveform_metrics_batch(mean_waveforms[:total_units][has_spikes],
+                                               snr_array[:total_units, 0][has_spikes],
+                                               cluster_ids[has_spikes],
+                                               peak_channels[:total_units][has_spikes],
+                                               np.arange(num_sites),
+                                               sample_rate,
+                                               upsampling_factor,
+                                               spread_threshold,
+                                               site_range,
+                                               None,
+                                               'complete_session',
+                                               site_x, site_y,
+                                               geometry)
 
     return metrics
 
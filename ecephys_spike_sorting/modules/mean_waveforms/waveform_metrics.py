@@ -1,10 +1,13 @@
 import numpy as np
 import random
 import pandas as pd
+import warnings
 
 from scipy.stats import linregress
 from scipy.signal import resample
 
+from ...common.probe_geometry import get_column_sites
+
 def calculate_waveform_metrics(waveforms, 
                                cluster_id, 
                                peak_channel, 
@@ -14,7 +17,10 @@ def calculate_waveform_metrics(waveforms,
                                spread_threshold,
                                site_range,
                                site_spacing,
-                               epoch_name):
+                               epoch_name,
+                               site_x = None,
+                               site_y = None,
+                               geometry = None):
     
     """
     Calculate metrics for an array of waveforms.
@@ -45,6 +51,11 @@ def calculate_waveform_metrics(waveforms,
         Number of sites to use for 2D waveform metrics
     site_spacing : float
         Average vertical distance between sites (m)
+    site_x, site_y : numpy.ndarray
+        Positions (in um) of the channels in channel_map (default = Neuropixels 1.0 
+        layout with site_spacing between rows)
+    geometry : ProbeGeometry (optional)
+        Precomputed sites for the 2D features, for the same site positions
 
     Outputs:
     -------
@@ -56,9 +67,48 @@ def calculate_waveform_metrics(waveforms,
     snr = calculate_snr(waveforms[:, peak_channel, :])
 
     mean_2D_waveform = np.squeeze(np.nanmean(waveforms[:, channel_map, :], 0))
+
+    return calculate_waveform_metrics_from_mean(mean_2D_waveform, snr, cluster_id, peak_channel, channel_map, 
+                                                sample_rate, upsampling_factor, spread_threshold, site_range, 
+                                                site_spacing, epoch_name, site_x, site_y, geometry)
+
+
+def calculate_waveform_metrics_from_mean(mean_2D_waveform,
+                                         snr,
+                                         cluster_id, 
+                                         peak_channel, 
+                                         channel_map, 
+                                         sample_rate, 
+                                         upsampling_factor, 
+                                         spread_threshold,
+                                         site_range,
+                                         site_spacing,
+                                         epoch_name,
+                                         site_x = None,
+                                         site_y = None,
+                                         geometry = None):
+
+    """
+    Calculate metrics from the mean waveform of a cluster, for when the individual
+    spike waveforms are not kept in memory
+
+    Inputs:
+    -------
+    mean_2D_waveform : numpy.ndarray (channels in channel_map x num_samples)
+        Mean waveform on the channels used for spike sorting
+    snr : float
+        Signal-to-noise ratio on the peak channel (see calculate_snr)
+
+    Other inputs and outputs are as for calculate_waveform_metrics
+
+    """
+
+    if site_x is None or site_y is None:
+        site_x, site_y = get_site_positions(channel_map, site_spacing)
+
     local_peak = np.argmin(np.abs(channel_map - peak_channel))
 
-    num_samples = waveforms.shape[2]
+    num_samples = mean_2D_waveform.shape[1]
     new_sample_count = int(num_samples * upsampling_factor)
 
     mean_1D_waveform = resample(
@@ -75,7 +125,7 @@ def calculate_waveform_metrics(waveforms,
         mean_1D_waveform, timestamps)
 
     amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, spread_threshold, site_range, site_spacing)
+        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range, geometry)
 
     data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
               recovery_slope, amplitude, spread, velocity_above, velocity_below]]
@@ -87,6 +137,20 @@ def calculate_waveform_metrics(waveforms,
 
     return metrics
 
+
+def get_site_positions(channel_map, site_spacing):
+
+    """
+    Site positions (in um) for channels of a Neuropixels 1.0 probe: two sites per 
+    row, site_spacing (m) between rows, staggered across four columns
+
+    """
+
+    site_x = np.array([43.0, 11.0, 59.0, 27.0])[channel_map % 4]
+    site_y = (channel_map // 2) * site_spacing * 1e6
+
+    return site_x, site_y
+
 def calculate_waveform_metrics_from_avg(avg_waveform,
                                         snr,
                                         cluster_id, 
@@ -96,7 +160,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
                                         upsampling_factor, 
                                         spread_threshold,
                                         site_range,
-                                        site_x, site_y):
+                                        site_x, site_y,
+                                        geometry = None):
 
     """
     Calculate metrics for an array of waveforms for a single cluster.
@@ -127,6 +192,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     site_range : float
         Number of sites to use for 2D waveform metrics
     site_x, site_y : channel positions in um
+    geometry : ProbeGeometry (optional)
+        Precomputed sites for the 2D features, for the same site positions
 
     Outputs:
     -------
@@ -165,7 +232,7 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
         mean_1D_waveform, timestamps)
 
     amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range)
+        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range, geometry)
 
     data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
               recovery_slope, amplitude, spread, velocity_above, velocity_below]]
@@ -210,6 +277,31 @@ def calculate_snr(W):
     return snr
 
 
+def calculate_snr_from_stats(mean_waveform, std_waveform):
+
+    """
+    Calculate SNR of spike waveforms from their mean and standard deviation,
+    without the individual waveforms
+
+    The residuals used by calculate_snr have zero mean at every sample, so their
+    variance is the average over samples of the variance of the waveforms.
+
+    Input:
+    -------
+    mean_waveform : mean of N waveforms (samples), or of several units (units x samples)
+    std_waveform : population standard deviation of the same waveforms (same shape)
+
+    Output:
+    snr : signal-to-noise ratio for unit (scalar, or one per unit), same as calculate_snr
+
+    """
+
+    A = np.max(mean_waveform, -1) - np.min(mean_waveform, -1)
+    snr = A/(2*np.sqrt(np.mean(std_waveform ** 2, -1)))
+
+    return snr
+
+
 def calculate_waveform_duration(waveform, timestamps):
     
     """ 
@@ -368,7 +460,7 @@ def calculate_waveform_recovery_slope(waveform, timestamps, window=20):
 # ==========================================================
 
 
-def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16):
+def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16, geometry=None):
     
     """ 
     Compute features of 2D waveform (channels x samples)
@@ -381,6 +473,8 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     spread_threshold : float
     site_range: int
     site_x, site_y : float
+    geometry : ProbeGeometry (optional)
+        Precomputed sites to sample for each peak channel (same site_x, site_y and site_range)
 
     Outputs:
     --------
@@ -393,6 +487,80 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
 
     assert site_range % 2 == 0 # must be even
     
+    if geometry is not None:
+        assert geometry.site_range == site_range
+        x_nn = geometry.get_x_nn(np.array([peak_channel]), waveform[np.newaxis, :, :])[0]
+        sites_to_sample = geometry.get_sampled_sites(peak_channel, x_nn)
+        sites_to_sample = sites_to_sample[sites_to_sample >= 0]
+    else:
+        sites_to_sample = find_sites_to_sample(waveform, peak_channel, site_x, site_y, site_range)
+
+    wv = waveform[sites_to_sample, :]
+
+    #smoothed_waveform = np.zeros((wv.shape[0]-1,wv.shape[1]))
+    #for i in range(wv.shape[0]-1):
+    #    smoothed_waveform[i,:] = np.mean(wv[i:i+2,:],0)
+
+    trough_idx = np.argmin(wv, 1)
+    trough_amplitude = np.min(wv, 1)
+
+    peak_idx = np.argmax(wv, 1)
+    peak_amplitude = np.max(wv, 1)
+
+    duration = np.abs(timestamps[peak_idx] - timestamps[trough_idx])
+
+    overall_amplitude = peak_amplitude - trough_amplitude
+    amplitude = np.max(overall_amplitude)
+    max_chan = np.argmax(overall_amplitude)
+
+    points_above_thresh = np.where(overall_amplitude > (amplitude * spread_threshold))[0]
+    
+    if len(points_above_thresh) > 1:
+        points_above_thresh = points_above_thresh[isnot_outlier(points_above_thresh)]
+        
+    yDist = site_y[sites_to_sample] - site_y[peak_channel]
+    yDist = yDist[points_above_thresh]
+    
+    numpts = yDist.size
+    # debug print to understand what sites are selected
+#    for i in range(numpts):
+#        print('i, ydist:' + repr(i) + ', ' + repr(yDist[i]))
+    spread = np.max(yDist) - np.min(yDist)
+
+    # original channel based calculation of spread
+    
+    # spread = len(points_above_thresh) * site_spacing * 1e6
+    # channels = sites_to_sample - peak_channel
+    # channels = channels[points_above_thresh]
+
+    trough_times = timestamps[trough_idx] - timestamps[trough_idx[max_chan]]
+    trough_times = trough_times[points_above_thresh]
+
+    velocity_above, velocity_below = get_velocity(yDist, trough_times)
+ 
+    return amplitude, spread, velocity_above, velocity_below
+
+
+def find_sites_to_sample(waveform, peak_channel, site_x, site_y, site_range):
+
+    """
+    Sites used for the 2D features of one unit (see ProbeGeometry for the 
+    precomputed version)
+
+    Inputs:
+    ------
+    waveform : numpy.ndarray (N channels x M samples)
+    peak_channel : int
+    site_x, site_y : numpy.ndarray (N channels)
+    site_range: int
+
+    Outputs:
+    --------
+    sites_to_sample : numpy.ndarray
+        Up to site_range sites, in order of distance from the peak channel
+
+    """
+
     # sample sites that are in the same "column" as the peak channel
     # first find nn with y ~= y_peak
     # x = x_peak or x_nn. For NP 1.0, this will select either the 
@@ -417,7 +585,9 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
             
     # select among sites with x = x_peak and x_nn for sites to sample
     inCol = (site_x == x_peak) | (site_x == x_nn)   
-    sort_dist_ind = np.argsort(dist)
+    # stable, so that sites at equal distances are sampled in channel order (also 
+    # when waveform only contains the channels around the peak)
+    sort_dist_ind = np.argsort(dist, kind = 'stable')
     sites_to_sample = np.zeros(site_range+1, dtype='int32')
     
     nfound = 0
@@ -440,50 +610,8 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
 
     # take only as many sites as we "found"
     sites_to_sample = sites_to_sample[0:nfound]
-    wv = waveform[sites_to_sample, :]
-
-    #smoothed_waveform = np.zeros((wv.shape[0]-1,wv.shape[1]))
-    #for i in range(wv.shape[0]-1):
-    #    smoothed_waveform[i,:] = np.mean(wv[i:i+2,:],0)
-
-    trough_idx = np.argmin(wv, 1)
-    trough_amplitude = np.min(wv, 1)
-
-    peak_idx = np.argmax(wv, 1)
-    peak_amplitude = np.max(wv, 1)
-
-    duration = np.abs(timestamps[peak_idx] - timestamps[trough_idx])
-
-    overall_amplitude = peak_amplitude - trough_amplitude
-    amplitude = np.max(overall_amplitude)
-    max_chan = np.argmax(overall_amplitude)
-
-    points_above_thresh = np.where(overall_amplitude > (amplitude * spread_threshold))[0]
-    
-    if len(points_above_thresh) > 1:
-        points_above_thresh = points_above_thresh[isnot_outlier(points_above_thresh)]
-        
-    yDist = site_y[sites_to_sample] - site_y[peak_channel]
-    yDist = yDist[points_above_thresh]
-    
-    numpts = yDist.size
-    # debug print to understand what sites are selected
-#    for i in range(numpts):
-#        print('i, ydist:' + repr(i) + ', ' + repr(yDist[i]))
-    spread = np.max(yDist) - np.min(yDist)
-
-    # original channel based calculation of spread
-    
-    # spread = len(points_above_thresh) * site_spacing * 1e6
-    # channels = sites_to_sample - peak_channel
-    # channels = channels[points_above_thresh]
-
-    trough_times = timestamps[trough_idx] - timestamps[trough_idx[max_chan]]
-    trough_times = trough_times[points_above_thresh]
 
-    velocity_above, velocity_below = get_velocity(yDist, trough_times)
- 
-    return amplitude, spread, velocity_above, velocity_below
+    return sites_to_sample
 
 
 # ==========================================================
@@ -569,3 +697,363 @@ def isnot_outlier(points, thresh=1.5):
     modified_z_score = 0.6745 * diff / med_abs_deviation
 
     return modified_z_score <= thresh
+
+
+# ==========================================================
+
+# BATCHED METRICS:
+
+# ==========================================================
+
+
+METRIC_COLUMNS = ['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
+                  'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
+                  'spread', 'velocity_above', 'velocity_below']
+
+
+def calculate_waveform_metrics_batch(mean_2D_waveforms,
+                                     snr,
+                                     cluster_ids,
+                                     peak_channels,
+                                     channel_map,
+                                     sample_rate,
+                                     upsampling_factor,
+                                     spread_threshold,
+                                     site_range,
+                                     site_spacing,
+                                     epoch_names,
+                                     site_x = None,
+                                     site_y = None,
+                                     geometry = None):
+
+    """
+    Calculate metrics from the mean waveforms of many units at once
+
+    Gives the same values as calling calculate_waveform_metrics_from_mean for each
+    unit, but resamples all peak-channel waveforms with one FFT and computes every
+    feature with array operations along the unit axis.
+
+    Inputs:
+    -------
+    mean_2D_waveforms : numpy.ndarray (units x channels x samples)
+        Mean waveform of each unit on the channels in channel_map
+    snr : numpy.ndarray (units)
+        Signal-to-noise ratio on the peak channel of each unit
+    cluster_ids : numpy.ndarray (units)
+    peak_channels : numpy.ndarray (units)
+        Peak channel of each unit
+    channel_map : numpy.ndarray (channels, or units x channels)
+        Channel of each row of the mean waveforms (per unit for sparse waveforms)
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+    spread_threshold : float
+        Threshold for computing spread of 2D waveform
+    site_range : float
+        Number of sites to use for 2D waveform metrics
+    site_spacing : float
+        Average vertical distance between sites (m)
+    epoch_names : str, or list of str (units)
+    site_x, site_y : numpy.ndarray (channels, or units x channels)
+        Positions (in um) of the channels in channel_map (default = Neuropixels 1.0 
+        layout with site_spacing between rows)
+    geometry : ProbeGeometry (optional)
+        Precomputed sites for the 2D features, if all units have the same channels
+        (replaces site_x and site_y)
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        One row per unit
+
+    """
+
+    num_units, num_channels, num_samples = mean_2D_waveforms.shape
+
+    if num_units == 0:
+        return pd.DataFrame(columns = METRIC_COLUMNS)
+
+    channel_map = np.broadcast_to(channel_map, (num_units, num_channels))
+
+    if geometry is not None:
+        site_x, site_y = geometry.site_x, geometry.site_y
+    elif site_x is None or site_y is None:
+        site_x, site_y = get_site_positions(channel_map, site_spacing)
+
+    site_x = np.broadcast_to(site_x, (num_units, num_channels))
+    site_y = np.broadcast_to(site_y, (num_units, num_channels))
+
+    peak_channels = np.asarray(peak_channels)
+    local_peak = np.argmin(np.abs(channel_map - peak_channels[:, np.newaxis]), 1)
+
+    new_sample_count = int(num_samples * upsampling_factor)
+
+    mean_1D_waveforms = resample(mean_2D_waveforms[np.arange(num_units), local_peak, :], new_sample_count, axis = 1)
+
+    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+
+    duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope = \
+        calculate_1D_features_batch(mean_1D_waveforms, timestamps)
+
+    amplitude, spread, velocity_above, velocity_below = calculate_2D_features_batch(
+        mean_2D_waveforms, timestamps, local_peak, site_x, site_y, spread_threshold, site_range, geometry)
+
+    metrics = pd.DataFrame({'cluster_id' : cluster_ids,
+                            'epoch_name' : epoch_names,
+                            'peak_channel' : peak_channels,
+                            'snr' : snr,
+                            'duration' : duration,
+                            'halfwidth' : halfwidth,
+                            'PT_ratio' : PT_ratio,
+                            'repolarization_slope' : repolarization_slope,
+                            'recovery_slope' : recovery_slope,
+                            'amplitude' : amplitude,
+                            'spread' : spread,
+                            'velocity_above' : velocity_above,
+                            'velocity_below' : velocity_below},
+                           columns = METRIC_COLUMNS)
+
+    return metrics
+
+
+def calculate_1D_features_batch(waveforms, timestamps, window=20):
+
+    """
+    Duration, halfwidth, peak-to-trough ratio, repolarization slope and recovery
+    slope of many 1D waveforms (see the functions for single waveforms above)
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (units x N samples)
+    timestamps : numpy.ndarray (N samples)
+    window : int
+        Window (in samples) for the slopes
+
+    Outputs:
+    --------
+    duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope : numpy.ndarray (units)
+
+    """
+
+    num_units, num_samples = waveforms.shape
+
+    units = np.arange(num_units)
+    sample_idx = np.arange(num_samples)[np.newaxis, :]
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+
+    trough = waveforms[units, trough_idx]
+    peak = waveforms[units, peak_idx]
+
+    # measure from the peak if it is larger than the trough
+    use_peak = peak > np.abs(trough)
+    start_idx = np.where(use_peak, peak_idx, trough_idx)
+    sign = np.where(use_peak, 1.0, -1.0)[:, np.newaxis]
+
+    after_start = sample_idx >= start_idx[:, np.newaxis]
+
+    # duration: from the peak to the following trough, or vice versa
+    end_idx = np.argmin(np.where(after_start, waveforms * sign, np.inf), 1)
+    duration = (timestamps[end_idx] - timestamps[start_idx]) * 1e3
+
+    # halfwidth: first crossings of half the peak (or trough) before and after it
+    threshold = (np.where(use_peak, peak, trough) * 0.5)[:, np.newaxis]
+
+    crossing_1 = np.invert(after_start) * (waveforms * sign > threshold * sign)
+    crossing_2 = after_start * (waveforms * sign < threshold * sign)
+
+    has_crossings = np.any(crossing_1, 1) * np.any(crossing_2, 1)
+
+    halfwidth = (timestamps[np.argmax(crossing_2, 1)] - timestamps[np.argmax(crossing_1, 1)]) * 1e3
+    halfwidth[np.invert(has_crossings)] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        PT_ratio = np.abs(peak / trough)
+
+    # slopes, after inverting the waveforms whose largest deflection is positive
+    max_point = np.argmax(np.abs(waveforms), 1)
+    inverted = - waveforms * np.sign(waveforms[units, max_point])[:, np.newaxis]
+
+    repolarization_window = (sample_idx >= max_point[:, np.newaxis]) * (sample_idx < max_point[:, np.newaxis] + window)
+    repolarization_slope = get_regression_slopes(timestamps, inverted, repolarization_window) * 1e-6
+
+    recovery_idx = np.argmax(np.where(sample_idx >= max_point[:, np.newaxis], inverted, -np.inf), 1)
+
+    recovery_window = (sample_idx >= recovery_idx[:, np.newaxis]) * (sample_idx < recovery_idx[:, np.newaxis] + window)
+    recovery_slope = get_regression_slopes(timestamps, inverted, recovery_window) * 1e-6
+
+    return duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope
+
+
+def calculate_2D_features_batch(waveforms, timestamps, peak_channels, site_x, site_y, spread_threshold = 0.12, site_range=16, geometry=None):
+
+    """
+    Amplitude, spread and velocities above and below the soma for many 2D waveforms
+    (see calculate_2D_features)
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (units x N channels x M samples)
+    timestamps : numpy.ndarray
+    peak_channels : numpy.ndarray (units)
+        Row of the peak channel in each waveform
+    site_x, site_y : numpy.ndarray (units x N channels)
+    spread_threshold : float
+    site_range: int
+    geometry : ProbeGeometry (optional)
+        Precomputed sites to sample, if all units have the same channels
+
+    Outputs:
+    --------
+    amplitude, spread, velocity_above, velocity_below : numpy.ndarray (units)
+
+    """
+
+    assert site_range % 2 == 0 # must be even
+
+    num_units, num_channels, num_samples = waveforms.shape
+    units = np.arange(num_units)[:, np.newaxis]
+
+    peak_y = site_y[units[:, 0], peak_channels][:, np.newaxis]
+
+    if geometry is not None:
+
+        assert geometry.site_range == site_range
+
+        x_nn = geometry.get_x_nn(peak_channels, waveforms)
+        sites_to_sample = geometry.sampled_sites[peak_channels]
+
+        for unit in np.where(x_nn != geometry.x_nn[peak_channels])[0]:
+            sites_to_sample[unit] = geometry.get_sampled_sites(peak_channels[unit], x_nn[unit])
+
+    else:
+
+        peak_x = site_x[units[:, 0], peak_channels][:, np.newaxis]
+
+        dist = np.sqrt(( pow((site_x - peak_x),2) + pow((site_y - peak_y),2)))
+        ydiff = (site_y != peak_y)
+
+        channel_amplitude = np.max(waveforms, 2) - np.min(waveforms, 2)
+
+        # the column of the nearest site at a different y is taken from the last site 
+        # that is at most as close as all preceding ones (as in find_sites_to_sample)
+        candidate_dist = np.where(ydiff, dist, np.inf)
+        preceding_min = np.minimum.accumulate(np.concatenate((np.ones((num_units, 1)) * 1e6, candidate_dist[:, :-1]), 1), 1)
+
+        is_nn = ydiff * (dist <= preceding_min) * (channel_amplitude > 0)
+        last_nn = num_channels - 1 - np.argmax(is_nn[:, ::-1], 1)
+        x_nn = np.where(np.any(is_nn, 1), site_x[units[:, 0], last_nn], -1)
+
+        sites_to_sample = get_column_sites(dist, site_x, peak_x[:, 0], x_nn, site_range)
+
+    num_sampled = sites_to_sample.shape[1]
+    is_sampled = sites_to_sample >= 0
+    sites_to_sample = np.maximum(sites_to_sample, 0)
+
+    wv = waveforms[units, sites_to_sample, :]
+
+    trough_idx = np.argmin(wv, 2)
+    overall_amplitude = np.where(is_sampled, np.max(wv, 2) - np.min(wv, 2), -np.inf)
+
+    amplitude = np.max(overall_amplitude, 1)
+    max_chan = np.argmax(overall_amplitude, 1)
+
+    above_thresh = is_sampled * (overall_amplitude > (amplitude * spread_threshold)[:, np.newaxis])
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        # remove outliers among the sampled positions (see isnot_outlier)
+        points = np.where(above_thresh, np.arange(num_sampled)[np.newaxis, :], np.nan)
+        diff = np.abs(points - np.nanmedian(points, 1)[:, np.newaxis])
+        modified_z_score = 0.6745 * diff / np.nanmedian(diff, 1)[:, np.newaxis]
+
+        check_outliers = (np.sum(above_thresh, 1) > 1)[:, np.newaxis]
+        points_above_thresh = above_thresh * (np.invert(check_outliers) | (modified_z_score <= 1.5))
+
+    yDist = site_y[units, sites_to_sample] - peak_y
+
+    has_points = np.any(points_above_thresh, 1)
+
+    spread = np.max(np.where(points_above_thresh, yDist, -np.inf), 1) - np.min(np.where(points_above_thresh, yDist, np.inf), 1)
+    spread[np.invert(has_points)] = np.nan
+
+    trough_times = timestamps[trough_idx] - timestamps[trough_idx[units[:, 0], max_chan]][:, np.newaxis]
+
+    velocity_above, velocity_below = get_velocity_batch(yDist, trough_times, points_above_thresh)
+
+    return amplitude, spread, velocity_above, velocity_below
+
+
+def get_velocity_batch(yDist, times, mask):
+
+    """
+    Calculate slope of trough time above and below soma for many units (see get_velocity)
+
+    Inputs:
+    -------
+    yDist : numpy.ndarray (units x sites)
+        distance of site to soma, in um
+    times : numpy.ndarray (units x sites)
+        Trough time relative to peak channel
+    mask : numpy.ndarray (units x sites)
+        Sites to include
+
+    Outputs:
+    --------
+    velocity_above, velocity_below : numpy.ndarray (units)
+        NaN for units with fewer than two sites above (or below) the soma
+
+    """
+
+    above_soma = mask * (yDist >= 0)
+    below_soma = mask * (yDist <= 0)
+
+    velocity_above = get_regression_slopes(yDist, times, above_soma) * 1e6
+    velocity_below = get_regression_slopes(yDist, times, below_soma) * 1e6
+
+    return velocity_above, velocity_below
+
+
+def get_regression_slopes(x, y, mask):
+
+    """
+    Least-squares slope of y against x for each row, using the entries in mask
+
+    Inputs:
+    -------
+    x : numpy.ndarray (units x N, or N)
+    y : numpy.ndarray (units x N)
+    mask : numpy.ndarray (units x N)
+
+    Outputs:
+    --------
+    slopes : numpy.ndarray (units)
+        NaN for rows with fewer than two points, or identical x values
+
+    """
+
+    x = np.broadcast_to(x, y.shape)
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        count = np.sum(mask, 1)
+
+        x_mean = np.sum(np.where(mask, x, 0), 1) / count
+        y_mean = np.sum(np.where(mask, y, 0), 1) / count
+
+        dx = np.where(mask, x - x_mean[:, np.newaxis], 0)
+        dy = np.where(mask, y - y_mean[:, np.newaxis], 0)
+
+        ssxm = np.sum(dx ** 2, 1)
+        slopes = np.sum(dx * dy, 1) / ssxm
+
+    slopes[(count < 2) | (ssxm == 0)] = np.nan
+
+    return slopes
@@ -0,0 +1,173 @@
+import numpy as np
+import warnings
+
+
+def new_waveform_accumulator(num_slots, num_channels, num_samples):
+
+    """
+    Running mean and variance of spike waveforms, for num_slots cluster/epoch combinations
+
+    Waveforms are added with update_waveform_accumulator, so the mean and std
+    waveforms can be computed without keeping the individual spikes in memory.
+    Accumulators for different subsets of spikes can be combined with
+    merge_waveform_accumulators.
+
+    Outputs:
+    --------
+    accumulator : tuple of numpy.ndarray
+        - counts (num_slots) : number of waveforms in each slot
+        - means (num_slots x num_channels x num_samples) : running mean
+        - m2 (num_slots x num_channels x num_samples) : sum of squared
+          differences from the mean (Welford's M2)
+
+    """
+
+    counts = np.zeros((num_slots,))
+    means = np.zeros((num_slots, num_channels, num_samples))
+    m2 = np.zeros((num_slots, num_channels, num_samples))
+
+    return counts, means, m2
+
+
+def update_waveform_accumulator(accumulator, slots, waveforms):
+
+    """
+    Adds a batch of waveforms to an accumulator
+
+    The mean and M2 of the waveforms in each slot are computed from the batch
+    and then combined with the running values (Chan et al., 1979), which is
+    as stable as adding one waveform at a time with Welford's method.
+
+    Inputs:
+    -------
+    accumulator : tuple of numpy.ndarray
+        Output of new_waveform_accumulator (updated in place)
+    slots : numpy.ndarray (num_waveforms)
+        Slot index of each waveform
+    waveforms : numpy.ndarray (num_waveforms x num_channels x num_samples)
+        Waveforms to add (e.g. int16 samples multiplied by bit_volts)
+
+    Outputs:
+    --------
+    accumulator : tuple of numpy.ndarray
+        The same (updated) accumulator
+
+    """
+
+    if len(slots) == 0:
+        return accumulator
+
+    order = np.argsort(slots, kind = 'stable')
+    batch_slots, batch_starts, batch_counts = np.unique(slots[order], return_index = True, return_counts = True)
+    waveforms = np.asarray(waveforms, dtype = 'float64')[order]
+
+    batch_means = np.add.reduceat(waveforms, batch_starts, axis = 0) / batch_counts[:, np.newaxis, np.newaxis]
+    batch_m2 = np.add.reduceat((waveforms - np.repeat(batch_means, batch_counts, axis = 0)) ** 2, batch_starts, axis = 0)
+
+    merge_into_accumulator(accumulator, batch_slots, batch_counts, batch_means, batch_m2)
+
+    return accumulator
+
+
+def add_waveform(accumulator, slot, waveform):
+
+    """
+    Adds one waveform to an accumulator (Welford's method)
+
+    Inputs:
+    -------
+    accumulator : tuple of numpy.ndarray
+        Output of new_waveform_accumulator (updated in place)
+    slot : int
+        Slot index of the waveform
+    waveform : numpy.ndarray (num_channels x num_samples)
+
+    """
+
+    counts, means, m2 = accumulator
+
+    counts[slot] += 1
+
+    delta = waveform - means[slot]
+    means[slot] += delta / counts[slot]
+    m2[slot] += delta * (waveform - means[slot])
+
+
+def merge_waveform_accumulators(accumulator, other, slots = None):
+
+    """
+    Combines two accumulators over different spikes, as if all spikes had been
+    added to one of them
+
+    Inputs:
+    -------
+    accumulator : tuple of numpy.ndarray
+        Output of new_waveform_accumulator (updated in place)
+    other : tuple of numpy.ndarray
+        Accumulator with the same shape, or with a subset of the slots
+    slots : numpy.ndarray (optional)
+        Slot in accumulator of each slot in other (default = same slots)
+
+    Outputs:
+    --------
+    accumulator : tuple of numpy.ndarray
+        The same (updated) accumulator
+
+    """
+
+    other_counts, other_means, other_m2 = other
+
+    if slots is None:
+        slots = np.arange(other_counts.size)
+
+    selection = np.where(other_counts > 0)[0]
+
+    merge_into_accumulator(accumulator, slots[selection], other_counts[selection], 
+                           other_means[selection], other_m2[selection])
+
+    return accumulator
+
+
+def merge_into_accumulator(accumulator, slots, counts, means, m2):
+
+    """ Pairwise update of the count, mean and M2 of the given slots """
+
+    accumulator_counts, accumulator_means, accumulator_m2 = accumulator
+
+    previous_counts = accumulator_counts[slots]
+    total_counts = previous_counts + counts
+
+    delta = means - accumulator_means[slots]
+    weight = (counts / total_counts)[:, np.newaxis, np.newaxis]
+
+    accumulator_means[slots] += delta * weight
+    accumulator_m2[slots] += m2 + delta ** 2 * (previous_counts[:, np.newaxis, np.newaxis] * weight)
+    accumulator_counts[slots] = total_counts
+
+
+def get_mean_and_std(accumulator):
+
+    """
+    Mean and (population) standard deviation waveforms of each slot
+
+    Outputs:
+    --------
+    means : numpy.ndarray (num_slots x num_channels x num_samples)
+        NaN for slots without waveforms
+    stds : numpy.ndarray (num_slots x num_channels x num_samples)
+        Same as numpy.std with ddof = 0
+
+    """
+
+    counts, means, m2 = accumulator
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        empty = (counts == 0)[:, np.newaxis, np.newaxis]
+
+        stds = np.sqrt(m2 / counts[:, np.newaxis, np.newaxis])
+        means = np.where(empty, np.nan, means)
+
+    return means, stds
@@ -0,0 +1,214 @@
+import os
+
+import numpy as np
+import h5py as h5
+
+# one chunk per unit and epoch (mean and std on all channels), so each unit
+# is read or written without touching the rest of the file
+STORE_COMPRESSION = 'gzip'
+STORE_COMPRESSION_LEVEL = 4
+
+# the store is written next to the existing one, which is only replaced once it is closed
+TEMP_SUFFIX = '.tmp'
+
+
+def get_waveform_store_file(output_file):
+    """ Location of the waveform store saved with the mean waveforms """
+
+    return os.path.splitext(output_file)[0] + '_store.h5'
+
+
+def create_waveform_store(store_file,
+                          cluster_ids,
+                          epoch_names,
+                          num_channels,
+                          samples_per_spike,
+                          pre_samples,
+                          sample_rate,
+                          unit_channels = None,
+                          units_to_update = None):
+
+    """
+    Creates a chunked, compressed HDF5 file for the mean and std waveforms of every
+    unit and epoch, which the extractors write to as each unit is finished
+
+    The file uses the same layout as writeDataAsXarray (HDF5 is also the NetCDF4
+    format): a 'waveforms' dataset (units x epochs x 2 x channels x samples) with
+    one chunk per unit and epoch, 'spike_count' (units x epochs + 1, the last being
+    the entire dataset), and the coordinates of each dimension.
+
+    For incremental runs (units_to_update is not None), the waveforms of all other
+    units are copied from the existing store, if there is one and its epochs,
+    channels and samples match (otherwise they are left at zero).
+
+    The new store is written to a temporary file, which close_waveform_store moves
+    over store_file, so the existing store is kept if the run fails.
+
+    Inputs:
+    -------
+    store_file : str
+        Path to the store (see get_waveform_store_file)
+    cluster_ids : numpy.ndarray
+        IDs of all units (one row each)
+    epoch_names : list of str
+    num_channels : int
+        Number of channels extracted for each unit
+    samples_per_spike : int
+    pre_samples : int
+    sample_rate : float
+    unit_channels : numpy.ndarray (units x num_channels)
+        Channels of each unit, for sparse waveforms (optional)
+    units_to_update : numpy.ndarray
+        IDs of the units that will be written (optional, default = all units)
+
+    Outputs:
+    --------
+    store : h5py.File
+        Open for writing (pass to close_waveform_store when all units are written)
+
+    """
+
+    store = h5.File(store_file + TEMP_SUFFIX, 'w')
+
+    num_units = len(cluster_ids)
+    num_epochs = len(epoch_names)
+
+    store.create_dataset('cluster_id', data = np.asarray(cluster_ids))
+    store.create_dataset('epoch', data = np.array(list(epoch_names) + ['all'], dtype = object),
+                         dtype = h5.string_dtype())
+    store.create_dataset('channel', data = np.arange(num_channels))
+    store.create_dataset('time', data = (np.arange(samples_per_spike) - pre_samples) / sample_rate)
+
+    waveforms = store.create_dataset('waveforms',
+                                     shape = (num_units, num_epochs, 2, num_channels, samples_per_spike),
+                                     dtype = 'float64',
+                                     chunks = (1, 1, 2, num_channels, samples_per_spike),
+                                     compression = STORE_COMPRESSION,
+                                     compression_opts = STORE_COMPRESSION_LEVEL,
+                                     shuffle = True,
+                                     fillvalue = 0)
+
+    spike_count = store.create_dataset('spike_count', shape = (num_units, num_epochs + 1), dtype = 'int64',
+                                       fillvalue = 0)
+
+    for dim, label in enumerate(('clusterID', 'epoch', 'mean or std', 'channel', 'time')):
+        waveforms.dims[dim].label = label
+
+    spike_count.dims[0].label = 'clusterID'
+    spike_count.dims[1].label = 'epoch'
+
+    if unit_channels is not None:
+        store.create_dataset('unit_channels', data = unit_channels[:num_units])
+
+    if units_to_update is not None and os.path.exists(store_file):
+        copy_unchanged_units(store, store_file, units_to_update)
+
+    return store
+
+
+def copy_unchanged_units(store, previous_file, units_to_update):
+
+    """
+    Copies the waveforms and spike counts of units that are not updated from a
+    previous store, one unit at a time
+
+    Nothing is copied if the epochs, channels or samples differ.
+
+    """
+
+    with h5.File(previous_file, 'r') as previous:
+
+        if previous['waveforms'].shape[1:] != store['waveforms'].shape[1:] or \
+                list(previous['epoch'][:]) != list(store['epoch'][:]):
+            print('Previous waveform store has a different layout; unchanged units are not copied')
+            return
+
+        if 'unit_channels' in store and ('unit_channels' not in previous or \
+                previous['unit_channels'].shape[1:] != store['unit_channels'].shape[1:]):
+            print('Previous waveform store has different channels; unchanged units are not copied')
+            return
+
+        num_previous = np.min([previous['waveforms'].shape[0], store['waveforms'].shape[0]])
+
+        units_to_update = np.asarray(units_to_update)
+
+        unchanged = np.ones((num_previous,), dtype = 'bool')
+        unchanged[units_to_update[units_to_update < num_previous]] = False
+
+        for unit in np.where(unchanged)[0]:
+            store['waveforms'][unit] = previous['waveforms'][unit]
+
+            if 'unit_channels' in store:
+                store['unit_channels'][unit] = previous['unit_channels'][unit]
+
+        spike_count = previous['spike_count'][:num_previous]
+        store['spike_count'][np.where(unchanged)[0]] = spike_count[unchanged]
+
+
+def close_waveform_store(store, spike_count, units_to_update = None):
+
+    """
+    Saves the spike counts of the units that were written, closes the store and
+    moves it over the previous one
+
+    Outputs:
+    --------
+    waveforms : h5py.Dataset
+        The 'waveforms' dataset, reopened read-only; it is indexed like the array
+        returned without a store, and only reads the waveforms that are selected.
+        The caller closes it with waveforms.file.close()
+
+    """
+
+    if units_to_update is None:
+        store['spike_count'][...] = spike_count
+    else:
+        units_to_update = np.asarray(units_to_update)
+        rows = np.unique(units_to_update[units_to_update < spike_count.shape[0]])
+        store['spike_count'][rows] = spike_count[rows]
+
+    temp_file = store.filename
+    store_file = temp_file[:-len(TEMP_SUFFIX)]
+    store.close()
+
+    os.replace(temp_file, store_file)
+
+    return h5.File(store_file, 'r')['waveforms']
+
+
+def read_unit_waveforms(store_file, cluster_id):
+
+    """
+    Loads the waveforms of one unit from a waveform store, without reading the others
+
+    Inputs:
+    -------
+    store_file : str
+        Path to a store written by create_waveform_store
+    cluster_id : int
+
+    Outputs:
+    --------
+    waveforms : numpy.ndarray (epochs x 2 x channels x samples)
+        Mean (0) and std (1) waveforms in each epoch
+    spike_count : numpy.ndarray (epochs + 1)
+        Number of spikes averaged in each epoch (last is entire dataset)
+    channels : numpy.ndarray (channels)
+        Channel of each row, or None if all channels were extracted
+
+    """
+
+    with h5.File(store_file, 'r') as store:
+
+        unit = np.where(store['cluster_id'][:] == cluster_id)[0]
+
+        if unit.size == 0:
+            raise ValueError('Unit ' + str(cluster_id) + ' is not in ' + store_file)
+
+        unit = unit[0]
+
+        waveforms = store['waveforms'][unit]
+        spike_count = store['spike_count'][unit]
+        channels = store['unit_channels'][unit] if 'unit_channels' in store else None
+
+    return waveforms, spike_count, channels
@@ -7,7 +7,7 @@ import numpy as np
 
 from .id_noise_templates import id_noise_templates, id_noise_templates_rf
 
-from ...common.utils import write_cluster_group_tsv, load_kilosort_data
+from ...common.utils import write_cluster_group_tsv, load_kilosort_data, load_template_table
 
 
 def classify_noise_templates(args):
@@ -25,7 +25,8 @@ def classify_noise_templates(args):
     if args['noise_waveform_params']['use_random_forest']:
         # use random forest classifier
         cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, \
-                    cluster_ids, templates, args['noise_waveform_params'])
+                    cluster_ids, templates, args['noise_waveform_params'], \
+                    load_template_table(args['directories']['kilosort_output_directory']))
     else:
         # use heuristics to identify templates that look like noise
         cluster_ids, is_noise = id_noise_templates(cluster_ids, templates, np.squeeze(channel_map), \
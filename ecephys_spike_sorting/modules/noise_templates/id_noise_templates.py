@@ -6,14 +6,14 @@ from sklearn.ensemble import RandomForestClassifier
 from scipy.interpolate import griddata
 from scipy.ndimage.filters import gaussian_filter1d
 
-from ...common.utils import printProgressBar
+from ...common.utils import printProgressBar, get_template_table
 
 import multiprocessing
 from functools import partial
 
 import pickle
 
-def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params):
+def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params, template_table = None):
 
     """
     Uses a random forest classifier to identify noise units based on waveform shape
@@ -24,6 +24,8 @@ def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, p
     spike_clusters : cluster IDs for each spike time []
     cluster_ids : all unique cluster ids
     templates : template for each unit output by Kilosort
+    template_table : peak channel of each template, from load_template_table 
+        (optional, calculated from templates if not given)
 
     Outputs:
     -------
@@ -46,7 +48,10 @@ def id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, p
 
     feature_matrix = np.zeros((cluster_ids.size, 61, 32))
 
-    peak_channels = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+    if template_table is None:
+        template_table = get_template_table(templates, np.arange(templates.shape[2]))
+
+    peak_channels = template_table['peak_index'].values
 
     for idx, unit in enumerate(cluster_ids):
         
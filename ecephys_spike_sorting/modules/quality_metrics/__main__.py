@@ -7,10 +7,15 @@ import time
 import numpy as np
 import pandas as pd
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import load_kilosort_data, load_spike_depths
 from ...common.epoch import get_epochs_from_nwb_file
+from ...common.fingerprints import get_cluster_fingerprints, load_fingerprints, save_fingerprints, compare_fingerprints
+from ...common.metrics_store import get_metrics_store_directory, write_metrics_group, read_metrics_group, \
+                                    list_metrics_groups, export_metrics_csv
 
-from .metrics import calculate_metrics
+from .metrics import calculate_metrics, get_units_to_update
+
+PC_METRICS = ['isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate']
 
 
 def calculate_quality_metrics(args):
@@ -21,6 +26,10 @@ def calculate_quality_metrics(args):
     
     include_pcs = args['quality_metrics_params']['include_pcs']
 
+    output_file = args['cluster_metrics']['cluster_metrics_file']
+    store_directory = get_metrics_store_directory(args['cluster_metrics'])
+    store_format = args['cluster_metrics']['metrics_store_format']
+
     print("Loading data...")
 
     try:
@@ -30,7 +39,10 @@ def calculate_quality_metrics(args):
                     load_kilosort_data(args['directories']['kilosort_output_directory'], \
                         args['ephys_params']['sample_rate'], \
                         use_master_clock = False,
-                        include_pcs = include_pcs)
+                        include_pcs = include_pcs,
+                        mmap_mode = 'r')
+            spike_depths = load_spike_depths(args['directories']['kilosort_output_directory'], 
+                                             spike_clusters, pc_features, pc_feature_ind, channel_pos)
         else:
             spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
             channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
@@ -40,9 +52,28 @@ def calculate_quality_metrics(args):
                         include_pcs = include_pcs)
             pc_features = []
             pc_feature_ind = []
+            spike_depths = None
             
+        fingerprints = get_cluster_fingerprints(spike_clusters, args['quality_metrics_params'])
+        units_to_update = None
+
+        if args['quality_metrics_params']['incremental'] and include_pcs:
+
+            changed_units = compare_fingerprints(load_fingerprints(output_file), fingerprints)
 
-        metrics = calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'])
+            if changed_units is not None:
+                units_to_update = get_units_to_update(changed_units, spike_clusters, templates.shape[0], pc_features, pc_feature_ind)
+                print("Updating PC metrics for " + str(len(units_to_update)) + " units")
+
+        metrics = calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'],
+                                    units_to_update = units_to_update,
+                                    spike_depths = spike_depths)
+
+        if units_to_update is not None:
+            previous_metrics = read_metrics_group('quality_metrics', store_directory)
+            if previous_metrics is None:
+                previous_metrics = pd.read_csv(output_file, index_col=0)
+            metrics = copy_unchanged_metrics(metrics, previous_metrics, units_to_update, PC_METRICS)
 
     except FileNotFoundError:
         
@@ -53,18 +84,19 @@ def calculate_quality_metrics(args):
         return {"execution_time" : execution_time,
             "quality_metrics_output_file" : None} 
 
-    
-    output_file = args['cluster_metrics']['cluster_metrics_file']
-
-    if os.path.exists(args['waveform_metrics']['waveform_metrics_file']):
-        metrics = metrics.merge(pd.read_csv(args['waveform_metrics']['waveform_metrics_file'], index_col=0),
-                     on='cluster_id',
-                     suffixes=('_quality_metrics','_waveform_metrics'))
 
     print("Saving data...")
-   
 
-    metrics.to_csv(output_file)
+    write_metrics_group(metrics, 'quality_metrics', store_directory, store_format)
+
+    # waveform metrics saved before the metrics store existed
+    if 'waveform_metrics' not in list_metrics_groups(store_directory) and \
+            os.path.exists(args['waveform_metrics']['waveform_metrics_file']):
+        write_metrics_group(pd.read_csv(args['waveform_metrics']['waveform_metrics_file'], index_col=0),
+                            'waveform_metrics', store_directory, store_format)
+
+    export_metrics_csv(store_directory, output_file)
+    save_fingerprints(fingerprints, output_file)
 
     execution_time = time.time() - start
 
@@ -75,6 +107,43 @@ def calculate_quality_metrics(args):
             "quality_metrics_output_file" : output_file} # output manifest
 
 
+def copy_unchanged_metrics(metrics, previous_metrics, units_to_update, columns):
+
+    """ Fill in metrics that were not recalculated from a previous output file
+
+    Inputs:
+    -------
+    metrics : pandas.DataFrame
+        Output of calculate_metrics
+    previous_metrics : pandas.DataFrame
+        Contents of the existing metrics file (possibly merged with waveform metrics)
+    units_to_update : numpy.ndarray
+        Units whose metrics were recalculated
+    columns : list of str
+        Metrics to copy for the other units
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+        metrics, with previous values for all other units
+
+    """
+
+    # the epoch name has a suffix if the waveform metrics were merged into the file
+    epoch_column = 'epoch_name' if 'epoch_name' in previous_metrics.columns else 'epoch_name_quality_metrics'
+
+    previous_metrics = previous_metrics.rename(columns = {epoch_column : 'epoch_name'})
+    previous_metrics = previous_metrics.drop_duplicates(['cluster_id', 'epoch_name']).set_index(['cluster_id', 'epoch_name'])
+
+    keys = pd.MultiIndex.from_arrays((metrics['cluster_id'].values, metrics['epoch_name'].values))
+    to_copy = np.invert(np.isin(metrics['cluster_id'].values, units_to_update)) * keys.isin(previous_metrics.index)
+
+    for column in columns:
+        metrics.loc[to_copy, column] = previous_metrics.loc[keys[to_copy], column].values
+
+    return metrics
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
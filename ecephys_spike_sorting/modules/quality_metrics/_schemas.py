@@ -11,11 +11,22 @@ class QualityMetricsParams(DefaultSchema):
     max_spikes_for_unit = Int(required=False, default=500, help='Number of spikes to subsample for computing PC metrics')
     max_spikes_for_nn = Int(required=False, default=10000, help='Further subsampling for NearestNeighbor calculation')
     n_neighbors = Int(required=False, default=4, help='Number of neighbors to use for NearestNeighbor calculation')
+    nn_method = String(required=False, default='ball_tree', help="Nearest neighbor search: a ball tree for each unit ('ball_tree'), blocked brute-force distances for each unit ('brute'), or one KD-tree shared by all units with the same peak channel ('kd_tree')")
+    mahalanobis_method = String(required=False, default='inverse', help="Isolation distance and L-ratio from a Cholesky factor of the covariance ('cholesky') or from its inverse and cdist ('inverse')")
+    covariance_regularization = Float(required=False, default=0.0, help='Ridge added to covariance matrices in the Cholesky and Fisher methods, relative to their mean variance (0 = no ridge; singular matrices give NaN isolation distance and L-ratio, and sklearn d-prime)')
+    pc_metrics_dtype = String(required=False, default='float64', help="Precision of the batched PC metric computations ('float64' or 'float32')")
+    lda_method = String(required=False, default='fisher', help="d-prime from the closed-form Fisher discriminant ('fisher') or from sklearn LinearDiscriminantAnalysis ('sklearn')")
     n_silhouette = Int(required=False, default=10000, help='Number of spikes to use for calculating silhouette score')
+    fast_silhouette = Boolean(required=False, default=False, help='Compute distances for the silhouette score once, and only score nearby pairs of units')
+    silhouette_radius_um = Float(required=False, default=None, allow_none=True, help='Maximum distance between peak channels of units compared in the fast silhouette score; distances to spikes of units further away are not computed (None to compare all pairs)')
 
     drift_metrics_min_spikes_per_interval = Int(required=False, default=10, help='Minimum number of spikes for computing depth')
     drift_metrics_interval_s = Float(required=False, default=100, help='Interval length is seconds for computing spike depth')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    num_workers = Int(required=False, default=1, help='Number of processes to use for PC-based metrics')
+    vectorized_metrics = Boolean(required=False, default=True, help='Compute firing rate, presence ratio, ISI violations and amplitude cutoff for all units at once')
+    incremental = Boolean(required=False, default=False, help='Only recalculate PC metrics for clusters that changed since the last run (and their neighbors), based on the fingerprints saved next to the metrics file')
+    single_pass_epochs = Boolean(required=False, default=True, help='With vectorized_metrics and sorted spike times, group spikes by cluster once and derive the spike train metrics of every epoch from one pass')
 
 class InputParameters(ArgSchema):
     
@@ -0,0 +1,526 @@
+import numpy as np
+
+import warnings
+
+from scipy.ndimage import gaussian_filter1d
+
+from ...common.cluster_index import ClusterIndex
+
+
+def calculate_spike_train_metrics(spike_times,
+                                  spike_clusters,
+                                  amplitudes,
+                                  total_units,
+                                  isi_threshold,
+                                  min_isi,
+                                  cluster_index = None):
+
+    """ Calculate firing rate, presence ratio, ISI violations and amplitude cutoff for all units at once
+
+    Vectorized equivalent of calculate_firing_rate, calculate_presence_ratio,
+    calculate_isi_violations and calculate_amplitude_cutoff in metrics.py. Spikes are
+    sorted by (cluster, time) once, and every metric is computed with segmented
+    reductions over that order instead of calling the scalar functions for each unit.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Amplitude value for each spike time
+    total_units : Int
+        Number of units (length of the output arrays)
+    isi_threshold : float
+        Threshold for isi violation
+    min_isi : float
+        Threshold for duplicate spikes
+    cluster_index : ClusterIndex (optional)
+        Pre-computed grouping of spike_clusters
+
+    Outputs:
+    --------
+    firing_rates : numpy.ndarray (total_units x 0)
+    presence_ratios : numpy.ndarray (total_units x 0)
+    isi_viol : numpy.ndarray (total_units x 0)
+    amplitude_cutoffs : numpy.ndarray (total_units x 0)
+
+    """
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
+    grouped_times = cluster_index.group(spike_times)
+    grouped_units = np.repeat(np.arange(cluster_index.counts.size), cluster_index.counts)
+
+    firing_rates = batch_firing_rate(cluster_index.counts, min_time, max_time)
+    presence_ratios = batch_presence_ratio(grouped_times, grouped_units, cluster_index.counts.size, min_time, max_time)
+    isi_viol = batch_isi_violations(grouped_times, grouped_units, cluster_index.counts.size, min_time, max_time, isi_threshold, min_isi)
+    amplitude_cutoffs = batch_amplitude_cutoff(cluster_index.group(amplitudes), cluster_index)
+
+    return firing_rates[:total_units], presence_ratios[:total_units], \
+           isi_viol[:total_units], amplitude_cutoffs[:total_units]
+
+
+def calculate_epoch_spike_train_metrics(spike_times,
+                                        spike_clusters,
+                                        amplitudes,
+                                        total_units,
+                                        epoch_slices,
+                                        isi_threshold,
+                                        min_isi,
+                                        cluster_index = None):
+
+    """ Spike train metrics (see calculate_spike_train_metrics) for several epochs in one pass
+
+    Requires sorted spike times, so that every epoch is a contiguous range of spikes,
+    and a contiguous run within each cluster of the session-wide ClusterIndex. Spikes
+    are grouped by cluster once for the whole session; spike counts for each 
+    (cluster, epoch boundary) and cumulative ISI violation counts are computed in 
+    a single sweep, and the firing rate and ISI violations of each epoch 
+    (including one covering the whole session) are derived from them. 
+    Presence ratio and amplitude cutoff depend on the epoch's own bins, so they are
+    computed from the epoch's runs, without masking or sorting again.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds (sorted)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    amplitudes : numpy.ndarray (num_spikes x 0)
+        Amplitude value for each spike time
+    total_units : Int
+        Number of units (length of the output arrays)
+    epoch_slices : list of slices
+        Range of spikes in each epoch (see metrics.get_epoch_index)
+    isi_threshold : float
+        Threshold for isi violation
+    min_isi : float
+        Threshold for duplicate spikes
+    cluster_index : ClusterIndex (optional)
+        Pre-computed grouping of spike_clusters (for all spikes)
+
+    Outputs:
+    --------
+    epoch_indexes : list of ClusterIndex
+        Grouping of the spikes within each epoch (indices relative to the start of the epoch)
+    epoch_metrics : list of tuples
+        (firing_rates, presence_ratios, isi_viol, amplitude_cutoffs) for each epoch
+
+    """
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    num_units = cluster_index.counts.size
+
+    grouped_times = cluster_index.group(spike_times)
+    grouped_units = np.repeat(np.arange(num_units), cluster_index.counts)
+
+    # number of spikes of each cluster before every epoch boundary
+    boundaries = np.unique([[epoch.start, epoch.stop] for epoch in epoch_slices])
+    segments = np.repeat(np.arange(boundaries.size + 1), np.diff(np.concatenate(([0], boundaries, [spike_times.size]))))
+    counts = np.bincount(spike_clusters * (boundaries.size + 1) + segments, minlength = num_units * (boundaries.size + 1))
+    counts_before = np.cumsum(np.reshape(counts, (num_units, boundaries.size + 1)), 1)
+
+    isi_stats = session_isi_statistics(grouped_times, grouped_units, isi_threshold, min_isi)
+
+    epoch_indexes = []
+    epoch_metrics = []
+
+    for in_epoch in epoch_slices:
+
+        first = cluster_index.offsets[:-1] + counts_before[:, np.searchsorted(boundaries, in_epoch.start)]
+        last = cluster_index.offsets[:-1] + counts_before[:, np.searchsorted(boundaries, in_epoch.stop)]
+
+        min_time = spike_times[in_epoch.start]
+        max_time = spike_times[in_epoch.stop - 1]
+
+        epoch_index = cluster_index.select(first, last)
+        epoch_times = epoch_index.group(spike_times)
+        epoch_units = np.repeat(np.arange(num_units), epoch_index.counts)
+
+        firing_rates = batch_firing_rate(epoch_index.counts, min_time, max_time)
+        presence_ratios = batch_presence_ratio(epoch_times, epoch_units, num_units, min_time, max_time)
+        isi_viol = epoch_isi_violations(grouped_times, isi_stats, first, last, min_time, max_time, isi_threshold, min_isi)
+        amplitude_cutoffs = batch_amplitude_cutoff(epoch_index.group(amplitudes), epoch_index)
+
+        epoch_indexes.append(ClusterIndex.from_counts(epoch_index.order - in_epoch.start, epoch_index.counts))
+        epoch_metrics.append((firing_rates[:total_units], presence_ratios[:total_units], 
+                              isi_viol[:total_units], amplitude_cutoffs[:total_units]))
+
+    return epoch_indexes, epoch_metrics
+
+
+# ==========================================================
+
+# VECTORIZED IMPLEMENTATIONS OF SPIKE TRAIN METRICS:
+
+# ==========================================================
+
+
+def batch_firing_rate(spike_counts, min_time, max_time):
+
+    """ Firing rate for all units (see metrics.firing_rate)
+
+    Inputs:
+    -------
+    spike_counts : numpy.ndarray (num_units x 0)
+        Number of spikes for each unit
+    min_time : float
+        Time of first possible spike
+    max_time : float
+        Time of last possible spike
+
+    Outputs:
+    --------
+    firing_rates : numpy.ndarray (num_units x 0)
+        Firing rate in Hz
+
+    """
+
+    return spike_counts / (max_time - min_time)
+
+
+def batch_presence_ratio(grouped_times, grouped_units, num_units, min_time, max_time, num_bins = 100):
+
+    """ Presence ratio for all units (see metrics.presence_ratio)
+
+    Builds a 2-D (unit x time bin) occupancy table with the same bin edges
+    as the scalar implementation.
+
+    Inputs:
+    -------
+    grouped_times : numpy.ndarray (num_spikes x 0)
+        Spike times, sorted by cluster
+    grouped_units : numpy.ndarray (num_spikes x 0)
+        Cluster ID for each entry of grouped_times
+    num_units : Int
+        Number of rows in the output
+    min_time : float
+        Minimum time for potential spikes
+    max_time : float
+        Maximum time for potential spikes
+
+    Outputs:
+    --------
+    presence_ratios : numpy.ndarray (num_units x 0)
+        Fraction of time bins in which each unit is spiking
+
+    """
+
+    edges = np.linspace(min_time, max_time, num_bins)
+    time_bins = edges.size - 1
+
+    # each bin is [left, right), except the last, which includes the right edge
+    bin_index = np.searchsorted(edges, grouped_times, side = 'right') - 1
+    in_range = (bin_index >= 0) * (grouped_times <= max_time)
+    bin_index = np.minimum(bin_index, time_bins - 1)
+
+    occupied = np.zeros((num_units, time_bins), dtype = 'bool')
+    occupied[grouped_units[in_range], bin_index[in_range]] = True
+
+    return np.sum(occupied, 1) / num_bins
+
+
+def batch_isi_violations(grouped_times, grouped_units, num_units, min_time, max_time, isi_threshold, min_isi = 0):
+
+    """ ISI violations for all units (see metrics.isi_violations)
+
+    Inputs:
+    -------
+    grouped_times : numpy.ndarray (num_spikes x 0)
+        Spike times, sorted by cluster (and by time within each cluster)
+    grouped_units : numpy.ndarray (num_spikes x 0)
+        Cluster ID for each entry of grouped_times
+    num_units : Int
+        Number of rows in the output
+    min_time : minimum time for potential spikes
+    max_time : maximum time for potential spikes
+    isi_threshold : threshold for isi violation
+    min_isi : threshold for duplicate spikes
+
+    Outputs:
+    --------
+    fpRates : numpy.ndarray (num_units x 0)
+        Rate of contaminating spikes as a fraction of overall rate (0 for units without spikes)
+
+    """
+
+    same_unit = grouped_units[1:] == grouped_units[:-1]
+
+    # drop the second spike of every duplicate pair, as in the scalar version
+    duplicate = same_unit * (np.diff(grouped_times) <= min_isi)
+    keep = np.concatenate(([True], np.invert(duplicate)))
+
+    kept_times = grouped_times[keep]
+    kept_units = grouped_units[keep]
+
+    isis = np.diff(kept_times)
+    violation = (kept_units[1:] == kept_units[:-1]) * (isis < isi_threshold)
+
+    num_spikes = np.bincount(kept_units, minlength = num_units)
+    num_violations = np.bincount(kept_units[1:][violation], minlength = num_units)
+
+    return isi_violation_rates(num_violations, num_spikes, min_time, max_time, isi_threshold, min_isi)
+
+
+def isi_violation_rates(num_violations, num_spikes, min_time, max_time, isi_threshold, min_isi):
+
+    """ Rate of contaminating spikes from the number of ISI violations (see metrics.isi_violations)
+
+    num_spikes is the number of spikes after removing duplicates (0 gives a rate of 0)
+
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        violation_time = 2 * num_spikes * (isi_threshold - min_isi)
+        total_rate = num_spikes / (max_time - min_time)
+        fpRates = num_violations / violation_time / total_rate
+
+    fpRates[num_spikes == 0] = 0
+
+    return fpRates
+
+
+def batch_amplitude_cutoff(grouped_amplitudes, cluster_index, num_histogram_bins = 500, histogram_smoothing_value = 3):
+
+    """ Amplitude cutoff for all units (see metrics.amplitude_cutoff)
+
+    Builds a 2-D (unit x amplitude bin) density histogram, using the same
+    per-unit bin edges as numpy.histogram, and smooths every row at once.
+
+    Inputs:
+    -------
+    grouped_amplitudes : numpy.ndarray (num_spikes x 0)
+        Spike amplitudes, sorted by cluster
+    cluster_index : ClusterIndex
+        Grouping used to sort the amplitudes
+
+    Outputs:
+    --------
+    fraction_missing : numpy.ndarray (num_units x 0)
+        Fraction of missing spikes for each unit (0-0.5)
+
+    """
+
+    fraction_missing = np.zeros((cluster_index.counts.size,))
+
+    cluster_ids = cluster_index.cluster_ids
+
+    if cluster_ids.size == 0:
+        return fraction_missing
+
+    grouped_amplitudes = grouped_amplitudes.astype('float64')
+
+    # row of the 2-D histogram for every spike
+    rows = np.repeat(np.arange(cluster_ids.size), cluster_index.counts[cluster_ids])
+
+    starts = cluster_index.offsets[cluster_ids]
+    first_edge = np.minimum.reduceat(grouped_amplitudes, starts)
+    last_edge = np.maximum.reduceat(grouped_amplitudes, starts)
+
+    # numpy.histogram widens the range of constant inputs
+    constant = first_edge == last_edge
+    first_edge[constant] -= 0.5
+    last_edge[constant] += 0.5
+
+    edges = np.linspace(first_edge, last_edge, num_histogram_bins + 1, axis = 1)
+
+    # bin assignment, with the same edge corrections as numpy.histogram
+    scaled = (grouped_amplitudes - first_edge[rows]) / (last_edge - first_edge)[rows] * num_histogram_bins
+    bin_index = np.minimum(scaled.astype('int'), num_histogram_bins - 1)
+    bin_index[grouped_amplitudes < edges[rows, bin_index]] -= 1
+    bin_index[(grouped_amplitudes >= edges[rows, bin_index + 1]) * (bin_index != num_histogram_bins - 1)] += 1
+
+    counts = np.bincount(rows * num_histogram_bins + bin_index,
+                         minlength = cluster_ids.size * num_histogram_bins)
+    counts = np.reshape(counts, (cluster_ids.size, num_histogram_bins))
+
+    h = counts / np.diff(edges, axis = 1) / np.sum(counts, 1, keepdims = True)
+
+    pdf = gaussian_filter1d(h, histogram_smoothing_value, axis = 1)
+    support = edges[:, :-1]
+
+    bins = np.arange(num_histogram_bins)
+    peak_index = np.argmax(pdf, 1)
+
+    distance = np.abs(pdf - pdf[:, :1])
+    distance[bins < peak_index[:, np.newaxis]] = np.inf
+    G = np.argmin(distance, 1)
+
+    bin_size = np.mean(np.diff(support, axis = 1), 1)
+    missing = np.sum(pdf * (bins >= G[:, np.newaxis]), 1) * bin_size
+
+    fraction_missing[cluster_ids] = np.minimum(missing, 0.5)
+
+    return fraction_missing
+
+
+def batch_drift_metrics(grouped_times, grouped_depths, grouped_units, num_units, interval_starts, interval_ends, min_spikes_per_interval):
+
+    """ Max drift and cumulative drift for all units (see metrics.calculate_drift_metrics)
+
+    Spikes are keyed by (unit, interval) and sorted by depth within each key once,
+    so that the median depth of every segment can be read off the sorted array.
+
+    Inputs:
+    -------
+    grouped_times : numpy.ndarray (num_spikes x 0)
+        Spike times, sorted by cluster
+    grouped_depths : numpy.ndarray (num_spikes x 0)
+        Spike depths, in the same order as grouped_times
+    grouped_units : numpy.ndarray (num_spikes x 0)
+        Cluster ID for each entry of grouped_times
+    num_units : Int
+        Number of rows in the output
+    interval_starts : numpy.ndarray (num_intervals x 0)
+        Start time of each interval (spikes must be strictly later)
+    interval_ends : numpy.ndarray (num_intervals x 0)
+        End time of each interval (spikes must be strictly earlier)
+    min_spikes_per_interval : Int
+        Intervals with fewer spikes are ignored
+
+    Outputs:
+    --------
+    max_drift : numpy.ndarray (num_units x 0)
+        Peak-to-peak range of the median depths (NaN if no interval has enough spikes)
+    cumulative_drift : numpy.ndarray (num_units x 0)
+        Sum of the changes in median depth between consecutive intervals
+
+    """
+
+    num_intervals = interval_starts.size
+
+    interval_index = np.searchsorted(interval_starts, grouped_times, side = 'left') - 1
+    in_interval = interval_index >= 0
+    in_interval[in_interval] = grouped_times[in_interval] < interval_ends[interval_index[in_interval]]
+
+    keys = grouped_units[in_interval] * num_intervals + interval_index[in_interval]
+    depths = grouped_depths[in_interval]
+
+    order = np.lexsort((depths, keys))
+    sorted_depths = depths[order]
+
+    counts = np.bincount(keys, minlength = num_units * num_intervals)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    # median of each (unit, interval) segment, as in np.median
+    valid = (counts >= min_spikes_per_interval) * (counts > 0)
+    lower = offsets[valid] + (counts[valid] - 1) // 2
+    upper = offsets[valid] + counts[valid] // 2
+
+    median_depths = np.zeros((num_units * num_intervals,), dtype = 'float64') * np.nan
+    median_depths[valid] = (sorted_depths[lower] + sorted_depths[upper]) / 2
+
+    # np.median returns NaN for segments that contain NaN
+    contains_nan = np.bincount(keys, weights = np.isnan(depths), minlength = num_units * num_intervals) > 0
+    median_depths[contains_nan] = np.nan
+
+    median_depths = np.reshape(median_depths, (num_units, num_intervals))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        max_drift = np.around(np.nanmax(median_depths, 1) - np.nanmin(median_depths, 1), 2)
+        cumulative_drift = np.around(np.nansum(np.abs(np.diff(median_depths, axis = 1)), 1), 2)
+
+    return max_drift, cumulative_drift
+
+
+def session_isi_statistics(grouped_times, grouped_units, isi_threshold, min_isi = 0):
+
+    """ Duplicate spikes and ISI violations for the whole session, as cumulative counts
+
+    Inputs are as for batch_isi_violations.
+
+    Outputs:
+    --------
+    isi_stats : dict
+        'duplicate' : bool for each spike, True if it is removed as a duplicate
+        'kept' : positions of the spikes that are not duplicates
+        'cum_kept' : number of spikes that are not duplicates, before each position
+        'cum_violations' : number of ISI violations ending before each position
+
+    """
+
+    same_unit = grouped_units[1:] == grouped_units[:-1]
+
+    duplicate = np.concatenate(([False], same_unit * (np.diff(grouped_times) <= min_isi)))
+    kept = np.where(np.invert(duplicate))[0]
+
+    violation = np.zeros((grouped_times.size,), dtype = 'bool')
+    violation[kept[1:]] = (grouped_units[kept[1:]] == grouped_units[kept[:-1]]) * \
+                          (np.diff(grouped_times[kept]) < isi_threshold)
+
+    return {'duplicate' : duplicate,
+            'kept' : kept,
+            'cum_kept' : np.concatenate(([0], np.cumsum(np.invert(duplicate)))),
+            'cum_violations' : np.concatenate(([0], np.cumsum(violation)))}
+
+
+def epoch_isi_violations(grouped_times, isi_stats, first, last, min_time, max_time, isi_threshold, min_isi = 0):
+
+    """ ISI violations for all units within one epoch, from session_isi_statistics
+
+    Same result as batch_isi_violations on the spikes of the epoch. The first spike 
+    of each run is never a duplicate within the epoch, so the only correction to the
+    session-wide counts is for runs that start with a (session) duplicate.
+
+    Inputs:
+    -------
+    grouped_times : numpy.ndarray (num_spikes x 0)
+        Spike times, sorted by cluster (and by time within each cluster)
+    isi_stats : dict
+        Output of session_isi_statistics
+    first : numpy.ndarray (num_units x 0)
+        Position of the first spike of each unit within the epoch
+    last : numpy.ndarray (num_units x 0)
+        Position after the last spike of each unit within the epoch
+    min_time : minimum time for potential spikes
+    max_time : maximum time for potential spikes
+    isi_threshold : threshold for isi violation
+    min_isi : threshold for duplicate spikes
+
+    Outputs:
+    --------
+    fpRates : numpy.ndarray (num_units x 0)
+
+    """
+
+    duplicate = isi_stats['duplicate']
+    kept = isi_stats['kept']
+    cum_kept = isi_stats['cum_kept']
+    cum_violations = isi_stats['cum_violations']
+
+    num_spikes = np.zeros(first.shape, dtype = 'int')
+    num_violations = np.zeros(first.shape, dtype = 'int')
+
+    has_spikes = last > first
+    first = first[has_spikes]
+    last = last[has_spikes]
+
+    starts_with_duplicate = duplicate[first]
+
+    num_spikes[has_spikes] = cum_kept[last] - cum_kept[first] + starts_with_duplicate
+    violations = cum_violations[last] - cum_violations[first + 1]
+
+    # the first kept spike after a duplicate is compared to the start of the run,
+    # instead of the last kept spike before the epoch
+    next_kept = kept[np.minimum(np.searchsorted(kept, first, side = 'right'), kept.size - 1)]
+    to_correct = starts_with_duplicate * (next_kept > first) * (next_kept < last)
+
+    next_kept = next_kept[to_correct]
+    violations[to_correct] += (grouped_times[next_kept] - grouped_times[first[to_correct]] < isi_threshold).astype('int') - \
+                              (cum_violations[next_kept + 1] - cum_violations[next_kept])
+
+    num_violations[has_spikes] = violations
+
+    return isi_violation_rates(num_violations, num_spikes, min_time, max_time, isi_threshold, min_isi)
@@ -3,20 +3,28 @@ import pandas as pd
 from collections import OrderedDict
 
 import warnings
+import multiprocessing
+from functools import partial
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.neighbors import NearestNeighbors
 from sklearn.metrics import silhouette_score
 
 from scipy.spatial.distance import cdist
+from scipy.sparse import csr_matrix
+from scipy.linalg import solve_triangular, cho_solve
 from scipy.stats import chi2
+from scipy.special import chdtrc
 from scipy.ndimage.filters import gaussian_filter1d
 
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar, get_spike_depths
+from ...common.cluster_index import ClusterIndex
+from ...common.utils import printProgressBar, get_spike_depths, share_array, attach_shared_array
 
+from .batch_metrics import calculate_spike_train_metrics, calculate_epoch_spike_train_metrics, batch_drift_metrics
 
-def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None):
+
+def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None, units_to_update = None, spike_depths = None):
 
     """ Calculate metrics for all units on one probe
 
@@ -42,6 +50,11 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
         contains information on Epoch start and stop times
     params : dict of parameters
         'isi_threshold' : minimum time for isi violations
+    units_to_update : numpy.ndarray (optional)
+        Only calculate PC-based metrics (isolation distance, L-ratio, d-prime and 
+        nearest neighbor metrics) for these units; the other units get zeros
+    spike_depths : numpy.ndarray (num_spikes x 0) (optional)
+        Pre-computed spike depths (see load_spike_depths), used for the drift metrics
 
     
     Outputs:
@@ -65,22 +78,65 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
     [total_units, dummy, dummy] = templates.shape
     total_epochs = len(epochs)
 
-    for epoch in epochs:
+    times_are_sorted = np.all(np.diff(spike_times) >= 0)
+
+    # contiguous range of spikes if possible, so that per-spike arrays
+    # (including memory-mapped pc_features) are sliced without copying
+    epoch_indices = [get_epoch_index(spike_times, epoch, times_are_sorted) for epoch in epochs]
+
+    single_pass = params['single_pass_epochs'] and params['vectorized_metrics'] and times_are_sorted
+
+    if single_pass:
+
+        print("Calculating firing rate, presence ratio, isi violations and amplitude cutoff for all epochs")
+        epoch_cluster_indexes, epoch_spike_train_metrics = calculate_epoch_spike_train_metrics(spike_times,
+                                                                                               spike_clusters,
+                                                                                               amplitudes,
+                                                                                               total_units,
+                                                                                               epoch_indices,
+                                                                                               params['isi_threshold'],
+                                                                                               params['min_isi'])
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        in_epoch = epoch_indices[epoch_idx]
+
+        if single_pass:
+
+            cluster_index = epoch_cluster_indexes[epoch_idx]
+            firing_rate, presence_ratio, isi_viol, amplitude_cutoff = epoch_spike_train_metrics[epoch_idx]
+
+        elif params['vectorized_metrics']:
+
+            # group spikes by cluster once, and share the index with every helper
+            cluster_index = ClusterIndex(spike_clusters[in_epoch], total_units)
+
+            print("Calculating firing rate, presence ratio, isi violations and amplitude cutoff")
+            firing_rate, presence_ratio, isi_viol, amplitude_cutoff = calculate_spike_train_metrics(spike_times[in_epoch],
+                                                                                                    spike_clusters[in_epoch],
+                                                                                                    amplitudes[in_epoch],
+                                                                                                    total_units,
+                                                                                                    params['isi_threshold'],
+                                                                                                    params['min_isi'],
+                                                                                                    cluster_index)
+
+        else:
 
-        in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+            cluster_index = ClusterIndex(spike_clusters[in_epoch], total_units)
 
-        print("Calculating isi violations")
-        isi_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'])
+            print("Calculating isi violations")
+            isi_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'], cluster_index)
         
-        print("Calculating presence ratio")
-        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+            print("Calculating presence ratio")
+            presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units, cluster_index)
 
-        print("Calculating firing rate")
-        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+            print("Calculating firing rate")
+            firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, cluster_index)
         
-        print("Calculating amplitude cutoff")
-        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
+            print("Calculating amplitude cutoff")
+            amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units, cluster_index)
         
+
         if include_pcs:
         
             print("Calculating PC-based metrics")
@@ -92,15 +148,32 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
                                                                                                 params['max_radius_um'],
                                                                                                 params['max_spikes_for_unit'],
                                                                                                 params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
+                                                                                                params['n_neighbors'],
+                                                                                                cluster_index,
+                                                                                                params['num_workers'],
+                                                                                                params['mahalanobis_method'],
+                                                                                                params['covariance_regularization'],
+                                                                                                params['pc_metrics_dtype'],
+                                                                                                params['lda_method'],
+                                                                                                params['nn_method'],
+                                                                                                units_to_update)
   
             print("Calculating silhouette score")
             nSpikes = spike_times[in_epoch].size
-            the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
-                                                       total_units,
-                                                       pc_features[in_epoch,:,:],
-                                                       pc_feature_ind,
-                                                       min(nSpikes, params['n_silhouette']))
+            if params['fast_silhouette']:
+                the_silhouette_score = calculate_silhouette_score_fast(spike_clusters[in_epoch], 
+                                                           total_units,
+                                                           pc_features[in_epoch,:,:],
+                                                           pc_feature_ind,
+                                                           min(nSpikes, params['n_silhouette']),
+                                                           channel_pos,
+                                                           params['silhouette_radius_um'])
+            else:
+                the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
+                                                           total_units,
+                                                           pc_features[in_epoch,:,:],
+                                                           pc_feature_ind,
+                                                           min(nSpikes, params['n_silhouette']))
 
 
             print("Calculating drift metrics")
@@ -111,7 +184,9 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
                                                        pc_feature_ind,
                                                        channel_pos,
                                                        params['drift_metrics_interval_s'],
-                                                       params['drift_metrics_min_spikes_per_interval'])
+                                                       params['drift_metrics_min_spikes_per_interval'],
+                                                       cluster_index,
+                                                       spike_depths[in_epoch] if spike_depths is not None else None)
         else:
             # fill in empty arrays for dataframe            
             isolation_distance = np.zeros((total_units,))
@@ -152,78 +227,99 @@ def calculate_metrics(spike_times, spike_clusters, amplitudes, channel_map, chan
 
 # ===============================================================
 
-def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi):
+def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi, cluster_index = None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.cluster_ids
 
     viol_rates = np.zeros((total_units,))
 
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
+    grouped_times = cluster_index.group(spike_times)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx+1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        viol_rates[cluster_id], num_violations = isi_violations(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times), 
+        viol_rates[cluster_id], num_violations = isi_violations(grouped_times[cluster_index.slice(cluster_id)], 
+                                                       min_time = min_time, 
+                                                       max_time = max_time, 
                                                        isi_threshold=isi_threshold, 
                                                        min_isi = min_isi)
 
     return viol_rates
 
-def calculate_presence_ratio(spike_times, spike_clusters, total_units):
+def calculate_presence_ratio(spike_times, spike_clusters, total_units, cluster_index = None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.cluster_ids
 
     ratios = np.zeros((total_units,))
 
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
+    grouped_times = cluster_index.group(spike_times)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        ratios[cluster_id] = presence_ratio(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times))
+        ratios[cluster_id] = presence_ratio(grouped_times[cluster_index.slice(cluster_id)], 
+                                                       min_time = min_time, 
+                                                       max_time = max_time)
 
     return ratios
 
 
 
-def calculate_firing_rate(spike_times, spike_clusters, total_units):
+def calculate_firing_rate(spike_times, spike_clusters, total_units, cluster_index = None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.cluster_ids
 
     firing_rates = np.zeros((total_units,))
 
     min_time = np.min(spike_times)
     max_time = np.max(spike_times)
 
+    grouped_times = cluster_index.group(spike_times)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        firing_rates[cluster_id] = firing_rate(spike_times[for_this_cluster], 
-                                        min_time = np.min(spike_times),
-                                        max_time = np.max(spike_times))
+        firing_rates[cluster_id] = firing_rate(grouped_times[cluster_index.slice(cluster_id)], 
+                                        min_time = min_time,
+                                        max_time = max_time)
 
     return firing_rates
 
 
-def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
+def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units, cluster_index = None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.cluster_ids
 
     amplitude_cutoffs = np.zeros((total_units,))
 
+    grouped_amplitudes = cluster_index.group(amplitudes)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-
-        for_this_cluster = (spike_clusters == cluster_id)
-        amplitude_cutoffs[cluster_id] = amplitude_cutoff(amplitudes[for_this_cluster])
+        amplitude_cutoffs[cluster_id] = amplitude_cutoff(grouped_amplitudes[cluster_index.slice(cluster_id)])
 
     return amplitude_cutoffs
 
@@ -236,140 +332,478 @@ def calculate_pc_metrics(spike_clusters,
                          max_radius_um, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         cluster_index = None,
+                         num_workers = 1,
+                         mahalanobis_method = 'inverse',
+                         regularization = 0.0,
+                         dtype = 'float64',
+                         lda_method = 'fisher',
+                         nn_method = 'ball_tree',
+                         units_to_update = None):
 
 # OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
 #    assert(num_channels_to_compare % 2 == 1)
 #    half_spread = int((num_channels_to_compare - 1) / 2)
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    peak_channels = get_peak_channels(pc_features, pc_feature_ind, cluster_index, total_units)
+
+    cluster_ids = cluster_index.cluster_ids
+
+    if units_to_update is not None:
+        cluster_ids = np.intersect1d(cluster_ids, units_to_update)
 
-    peak_channels = np.zeros((total_units,), dtype='uint16')
     isolation_distances = np.zeros((total_units,))
     l_ratios = np.zeros((total_units,))
     d_primes = np.zeros((total_units,))
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
+    has_metrics = np.zeros((total_units,), dtype = 'bool')
+
+    spike_counts = cluster_index.counts.astype('int')
+
+    metric_params = {'max_radius_um' : max_radius_um,
+                     'max_spikes_for_cluster' : max_spikes_for_cluster,
+                     'max_spikes_for_nn' : max_spikes_for_nn,
+                     'n_neighbors' : n_neighbors,
+                     'mahalanobis_method' : mahalanobis_method,
+                     'regularization' : regularization,
+                     'dtype' : dtype,
+                     'lda_method' : lda_method,
+                     'nn_method' : nn_method}
+
+    if num_workers > 1:
+        unit_metrics = parallel_pc_metrics(cluster_ids, spike_clusters, spike_counts, peak_channels, 
+                                           pc_features, pc_feature_ind, channel_pos, metric_params, num_workers)
+    else:
+        unit_metrics = (calculate_unit_pc_metrics(cluster_id, spike_clusters, spike_counts, peak_channels, 
+                                                  pc_features, pc_feature_ind, channel_pos, **metric_params) 
+                        for cluster_id in cluster_ids)
 
-    for idx, cluster_id in enumerate(cluster_ids):
-        for_unit = np.squeeze(spike_clusters == cluster_id)
+    for idx, (cluster_id, metrics_for_unit) in enumerate(zip(cluster_ids, unit_metrics)):
+
+        printProgressBar(idx + 1, len(cluster_ids))
+
+        if metrics_for_unit is not None:
+
+            has_metrics[cluster_id] = True
+
+            isolation_distances[cluster_id], l_ratios[cluster_id], d_primes[cluster_id], \
+                nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = metrics_for_unit
+
+        else:
+
+            isolation_distances[cluster_id] = np.nan
+            d_primes[cluster_id] = np.nan
+            nn_hit_rates[cluster_id] = np.nan
+            nn_miss_rates[cluster_id] = np.nan
+
+    if nn_method == 'kd_tree':
+
+        print("Calculating nearest neighbor metrics for each neighborhood")
+        shared_hit_rates, shared_miss_rates = calculate_neighborhood_nn_metrics(cluster_index, peak_channels, pc_features, 
+                                                                                pc_feature_ind, channel_pos, max_radius_um, 
+                                                                                max_spikes_for_nn, n_neighbors)
+
+        nn_hit_rates[has_metrics] = shared_hit_rates[has_metrics]
+        nn_miss_rates[has_metrics] = shared_miss_rates[has_metrics]
+
+
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+
+def get_peak_channels(pc_features, pc_feature_ind, cluster_index, total_units):
+
+    """ Channel with the largest mean first PC for each unit (0 for units without spikes) """
+
+    peak_channels = np.zeros((total_units,), dtype='uint16')
+
+    for idx, cluster_id in enumerate(cluster_index.cluster_ids):
+        for_unit = cluster_index.indices(cluster_id)
         pc_max = np.argmax(np.mean(pc_features[for_unit, 0, :],0))
         peak_channels[cluster_id] = pc_feature_ind[cluster_id, pc_max]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    return peak_channels
 
-        
-        printProgressBar(idx + 1, len(cluster_ids))
 
-            
-        peak_channel = peak_channels[cluster_id]
-        
-        # calculate distances from all channels to peak channel
-        chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
-                            np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
+def get_units_to_update(changed_units, spike_clusters, total_units, pc_features, pc_feature_ind):
+
+    """ Units whose PC-based metrics can depend on a set of changed units
+
+    The PC metrics of a unit compare it with the units that have PCs on its peak
+    channel, so any unit whose peak channel is among the PC channels of a changed
+    (new, modified or deleted) unit has to be recalculated as well.
+
+    Inputs:
+    -------
+    changed_units : numpy.ndarray
+        IDs of units that are new, changed or deleted
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    total_units : Int
+        Number of units
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+
+    Outputs:
+    --------
+    units_to_update : numpy.ndarray
+        IDs of the changed units and of the units that depend on them
+
+    """
+
+    cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    peak_channels = get_peak_channels(pc_features, pc_feature_ind, cluster_index, total_units)
+
+    changed_units = np.asarray(changed_units, dtype = 'int')
+    changed_channels = np.unique(pc_feature_ind[changed_units[changed_units < pc_feature_ind.shape[0]], :])
+
+    neighbors = cluster_index.cluster_ids[np.isin(peak_channels[cluster_index.cluster_ids], changed_channels)]
+
+    return np.union1d(changed_units, neighbors)
+
+
+def calculate_unit_pc_metrics(cluster_id,
+                              spike_clusters,
+                              spike_counts,
+                              peak_channels,
+                              pc_features, 
+                              pc_feature_ind, 
+                              channel_pos,
+                              max_radius_um, 
+                              max_spikes_for_cluster, 
+                              max_spikes_for_nn, 
+                              n_neighbors,
+                              mahalanobis_method = 'inverse',
+                              regularization = 0.0,
+                              dtype = 'float64',
+                              lda_method = 'fisher',
+                              nn_method = 'ball_tree'):
+
+    """ Calculate PC-based metrics for one unit, against the units that share its peak channel
+
+    Spike subsampling uses a random generator seeded with the cluster ID, so the 
+    result for each unit does not depend on the order (or process) in which 
+    units are evaluated.
+
+    mahalanobis_method selects mahalanobis_metrics_cholesky ('cholesky', using
+    the regularization and dtype arguments) or mahalanobis_metrics ('inverse').
+    lda_method selects fisher_metrics ('fisher') or lda_metrics ('sklearn') for 
+    d-prime. Both closed-form methods share the mean and covariance of the unit.
+    nn_method selects nearest_neighbors_metrics ('ball_tree'), its brute-force
+    equivalent ('brute'), or neither ('kd_tree': the nearest neighbor metrics are
+    computed for each neighborhood by calculate_neighborhood_nn_metrics, and NaN
+    is returned here).
+
+    Outputs:
+    --------
+    metrics : tuple (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate)
+        None if there are not enough spikes in this unit or its neighbors
+
+    """
+
+    rng = np.random.RandomState(cluster_id)
+
+    peak_channel = peak_channels[cluster_id]
+    
+    # calculate distances from all channels to peak channel
+    chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
+                        np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
 
 # OLDER calculatioon assuming linear array
-#        half_spread_down = peak_channel \
-#            if peak_channel < half_spread \
-#            else half_spread
+#    half_spread_down = peak_channel \
+#        if peak_channel < half_spread \
+#        else half_spread
 #
-#        half_spread_up = np.max(pc_feature_ind) - peak_channel \
-#            if peak_channel + half_spread > np.max(pc_feature_ind) \
-#            else half_spread
+#    half_spread_up = np.max(pc_feature_ind) - peak_channel \
+#        if peak_channel + half_spread > np.max(pc_feature_ind) \
+#        else half_spread
 
-        # which units have pcs on the peak channel of the current unit?
-        units_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
+    # which units have pcs on the peak channel of the current unit?
+    units_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
 
 # OLDER calculatioon assuming linear array        
-#        units_in_range = (peak_channels[units_for_channel] >= peak_channel - half_spread_down) * \
-#                       (peak_channels[units_for_channel] <= peak_channel + half_spread_up)
-                        
+#    units_in_range = (peak_channels[units_for_channel] >= peak_channel - half_spread_down) * \
+#                   (peak_channels[units_for_channel] <= peak_channel + half_spread_up)
+                    
+    
+    # of those units that have pc overlap, which have their peak channel 
+    # within range of the current unit?              
+    units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
+       
         
-        # of those units that have pc overlap, which have their peak channel 
-        # within range of the current unit?              
-        units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
-           
-            
-        # If there is at least one neighbor unit in range, compare pcs across 
-        # units for channels that overlap AND lie within maximum radius
+    # If there is at least one neighbor unit in range, compare pcs across 
+    # units for channels that overlap AND lie within maximum radius
+    
+    if len(units_in_range) > 1 :
+
+        units_for_channel = np.asarray(units_for_channel[units_in_range])
         
-        if len(units_in_range) > 1 :
+        channel_index = channel_index[units_in_range]
 
-            units_for_channel = np.asarray(units_for_channel[units_in_range])
-            
-            channel_index = channel_index[units_in_range]
-    
 # OLDER calculatioon assuming linear array
-#           channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
+#       channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
+        
+        channels_to_use = np.where(chan_dist < max_radius_um)[0]
+
+
+        spike_counts = spike_counts[units_for_channel]
             
-            channels_to_use = np.where(chan_dist < max_radius_um)[0]
-    
-    
-            spike_counts = np.zeros(units_for_channel.shape, dtype = 'int')
-    
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-                spike_counts[idx2] = np.sum(spike_clusters == cluster_id2)
-                
-            this_unit_idx = np.where(units_for_channel == cluster_id)[0]
-    
-            if spike_counts[this_unit_idx] > max_spikes_for_cluster:
-                relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
+        this_unit_idx = np.where(units_for_channel == cluster_id)[0]
+
+        if spike_counts[this_unit_idx] > max_spikes_for_cluster:
+            relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
+        else:
+            relative_counts = spike_counts
+            
+        all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
+        all_labels = np.zeros((0,), dtype = 'int')
+            
+        for idx2, cluster_id2 in enumerate(units_for_channel):
+
+            try:
+                channel_mask = make_channel_mask(cluster_id2, pc_feature_ind, channels_to_use)
+            except IndexError:
+                # Occurs when pc_feature_ind does not contain all channels of interest
+                # In that case, we will exclude this unit for the calculation
+                pass
             else:
-                relative_counts = spike_counts
-                
-            all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
-            all_labels = np.zeros((0,), dtype = 'int')
-                
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-    
-                try:
-                    channel_mask = make_channel_mask(cluster_id2, pc_feature_ind, channels_to_use)
-                except IndexError:
-                    # Occurs when pc_feature_ind does not contain all channels of interest
-                    # In that case, we will exclude this unit for the calculation
-                    pass
-                else:
-                    subsample = int(relative_counts[idx2])
-                    index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-                    pcs = get_unit_pcs(pc_features, index_mask, channel_mask)
-                    labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
-                    
-                    all_pcs = np.concatenate((all_pcs, pcs),0)
-                    all_labels = np.concatenate((all_labels, labels),0)
+                subsample = int(relative_counts[idx2])
+                index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample, rng = rng)
+                pcs = get_unit_pcs(pc_features, index_mask, channel_mask)
+                labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
                 
-            all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
-            
-            num_pcs = all_pcs.shape[0];
-#            num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
-#            print(num_pcs_str)
+                all_pcs = np.concatenate((all_pcs, pcs),0)
+                all_labels = np.concatenate((all_labels, labels),0)
             
-            pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
-            pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
-        
-        else:
-            # no near neighbor units to compare
-            num_pcs = 0
-            pcs_for_this_unit = 0
-            pcs_for_other_units = 0
+        all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
         
+        num_pcs = all_pcs.shape[0];
+#        num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
+#        print(num_pcs_str)
         
-        if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
+        pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
+        pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
+    
+    else:
+        # no near neighbor units to compare
+        num_pcs = 0
+        pcs_for_this_unit = 0
+        pcs_for_other_units = 0
+    
+    
+    if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
 
-            isolation_distances[cluster_id], l_ratios[cluster_id] = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
+        unit_moments = get_mean_and_covariance(all_pcs[all_labels == cluster_id,:])
 
-            d_primes[cluster_id] = lda_metrics(all_pcs, all_labels, cluster_id)
+        if mahalanobis_method == 'cholesky':
+            isolation_distance, l_ratio = mahalanobis_metrics_cholesky(all_pcs, all_labels, cluster_id, regularization, dtype, unit_moments)
+        else:
+            isolation_distance, l_ratio = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
 
-            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+        if lda_method == 'fisher':
+            d_prime = fisher_metrics(all_pcs, all_labels, cluster_id, regularization, unit_moments)
+        else:
+            d_prime = lda_metrics(all_pcs, all_labels, cluster_id)
 
+        if nn_method == 'ball_tree':
+            nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+        elif nn_method == 'brute':
+            nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics_brute(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
         else:
+            nn_hit_rate, nn_miss_rate = np.nan, np.nan
 
-            isolation_distances[cluster_id] = np.nan
-            d_primes[cluster_id] = np.nan
-            nn_hit_rates[cluster_id] = np.nan
-            nn_miss_rates[cluster_id] = np.nan
+        return isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate
 
+    else:
 
-    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+        return None
+
+
+def calculate_neighborhood_nn_metrics(cluster_index,
+                                      peak_channels,
+                                      pc_features,
+                                      pc_feature_ind,
+                                      channel_pos,
+                                      max_radius_um,
+                                      max_spikes_for_nn,
+                                      n_neighbors):
+
+    """ Nearest neighbor hit and miss rates, with one KD-tree per peak channel
+
+    The units that share a peak channel are compared against the same set of
+    neighbors (same channels and units as in calculate_unit_pc_metrics), so the
+    spikes of all those units are subsampled together, indexed in a single tree,
+    and queried once. Hit and miss rates are then read off the neighbor labels
+    for every unit with that peak channel.
+
+    Unlike nearest_neighbors_metrics, the subsample does not depend on the unit,
+    and each neighbor unit contributes spikes in proportion to its spike count.
+
+    Outputs:
+    --------
+    nn_hit_rates : numpy.ndarray (total_units x 0)
+    nn_miss_rates : numpy.ndarray (total_units x 0)
+        NaN for units without comparison spikes
+
+    """
+
+    total_units = peak_channels.size
+
+    nn_hit_rates = np.zeros((total_units,)) * np.nan
+    nn_miss_rates = np.zeros((total_units,)) * np.nan
+
+    cluster_ids = cluster_index.cluster_ids
+    unit_peak_channels = np.unique(peak_channels[cluster_ids])
+
+    for idx, peak_channel in enumerate(unit_peak_channels):
+
+        printProgressBar(idx + 1, len(unit_peak_channels))
+
+        chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
+                            np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
+
+        units_for_channel = np.where(np.any(pc_feature_ind == peak_channel, 1))[0]
+        units_for_channel = units_for_channel[chan_dist[peak_channels[units_for_channel]] < max_radius_um]
+
+        if len(units_for_channel) < 2:
+            continue
+
+        channels_to_use = np.where(chan_dist < max_radius_um)[0]
+
+        total_spikes = np.sum(cluster_index.counts[units_for_channel])
+        stride = np.max([total_spikes / max_spikes_for_nn, 1])
+
+        all_pcs = []
+        all_labels = []
+
+        for cluster_id2 in units_for_channel:
+
+            try:
+                channel_mask = make_channel_mask(cluster_id2, pc_feature_ind, channels_to_use)
+            except IndexError:
+                # pc_feature_ind does not contain all channels of interest
+                continue
+
+            spike_inds = cluster_index.indices(cluster_id2)
+            spike_inds = np.sort(spike_inds[np.arange(0, spike_inds.size, stride).astype('int')])
+
+            all_pcs.append(get_unit_pcs(pc_features, spike_inds, channel_mask))
+            all_labels.append(np.ones((spike_inds.size,), dtype = 'int') * cluster_id2)
+
+        if len(all_pcs) == 0:
+            continue
+
+        all_pcs = np.concatenate(all_pcs, 0)
+        all_labels = np.concatenate(all_labels)
+
+        if all_pcs.shape[0] <= n_neighbors:
+            continue
+
+        X = np.reshape(all_pcs, (all_pcs.shape[0], -1))
+
+        nbrs = NearestNeighbors(n_neighbors = n_neighbors, algorithm = 'kd_tree').fit(X)
+        distances, indices = nbrs.kneighbors(X)
+
+        neighbor_labels = all_labels[indices[:,1:]]
+
+        for cluster_id in cluster_ids[peak_channels[cluster_ids] == peak_channel]:
+
+            this_unit = all_labels == cluster_id
+
+            if np.sum(this_unit) > 0 and np.sum(this_unit) < this_unit.size:
+                nn_hit_rates[cluster_id] = np.mean(neighbor_labels[this_unit,:] == cluster_id)
+                nn_miss_rates[cluster_id] = np.mean(neighbor_labels[np.invert(this_unit),:] == cluster_id)
+
+    return nn_hit_rates, nn_miss_rates
+
+
+def parallel_pc_metrics(cluster_ids,
+                        spike_clusters,
+                        spike_counts,
+                        peak_channels,
+                        pc_features, 
+                        pc_feature_ind, 
+                        channel_pos,
+                        metric_params,
+                        num_workers):
+
+    """ Runs calculate_unit_pc_metrics for each unit in a process pool
+
+    The large per-spike arrays (pc_features, pc_feature_ind, spike_clusters) are
+    placed once in shared memory (or, for memory-mapped pc_features, opened from
+    their file), and each worker attaches to them instead of receiving a pickled copy.
+
+    Outputs:
+    --------
+    unit_metrics : list
+        Output of calculate_unit_pc_metrics for each unit in cluster_ids
+
+    """
+
+    shared_blocks = []
+    shared_specs = []
+
+    try:
+        for array in (spike_clusters, pc_features, pc_feature_ind):
+            shm, spec = share_array(array)
+            shared_blocks.append(shm)
+            shared_specs.append(spec)
+
+        num_workers = np.min([num_workers, multiprocessing.cpu_count(), len(cluster_ids)])
+
+        with multiprocessing.Pool(num_workers,
+                                  initializer = _init_pc_metrics_worker,
+                                  initargs = (shared_specs, spike_counts, peak_channels, channel_pos)) as pool:
+
+            unit_metrics = pool.map(partial(_pc_metrics_worker, metric_params = metric_params), cluster_ids, chunksize = 1)
+
+    finally:
+        for shm in shared_blocks:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return unit_metrics
+
+
+_worker_data = {}
+
+def _init_pc_metrics_worker(shared_specs, spike_counts, peak_channels, channel_pos):
+
+    """ Attaches a pool worker to the shared per-spike arrays """
+
+    shared_blocks = []
+    arrays = []
+
+    for spec in shared_specs:
+        shm, array = attach_shared_array(spec)
+        shared_blocks.append(shm)
+        arrays.append(array)
+
+    _worker_data['shared_blocks'] = shared_blocks  # keep the blocks open while the worker runs
+    _worker_data['spike_clusters'], _worker_data['pc_features'], _worker_data['pc_feature_ind'] = arrays
+    _worker_data['spike_counts'] = spike_counts
+    _worker_data['peak_channels'] = peak_channels
+    _worker_data['channel_pos'] = channel_pos
+
+
+def _pc_metrics_worker(cluster_id, metric_params):
+
+    return calculate_unit_pc_metrics(cluster_id, 
+                                     _worker_data['spike_clusters'],
+                                     _worker_data['spike_counts'],
+                                     _worker_data['peak_channels'],
+                                     _worker_data['pc_features'],
+                                     _worker_data['pc_feature_ind'],
+                                     _worker_data['channel_pos'],
+                                     **metric_params)
 
 
 def calculate_silhouette_score(spike_clusters, 
@@ -421,6 +855,155 @@ def calculate_silhouette_score(spike_clusters,
     return np.array([np.nanmin([a,b]) for a, b in zip(a,b)])
 
 
+def calculate_silhouette_score_fast(spike_clusters, 
+                                    total_units,
+                                    pc_features, 
+                                    pc_feature_ind,
+                                    total_spikes,
+                                    channel_pos,
+                                    max_radius_um = None,
+                                    block_size = 1000):
+
+    """ Faster version of calculate_silhouette_score
+
+    Uses the same spike subsample and PC matrix as calculate_silhouette_score, but:
+    - the PC matrix is built with one scatter per PC (as a sparse matrix)
+    - distances between sampled spikes are computed once, in blocks of rows (grouped
+      by cluster), and reduced to the summed distance from each spike to each cluster
+    - the silhouette score of every pair of clusters is derived from those sums,
+      optionally only for pairs whose peak channels are within max_radius_um; each
+      block of rows is then only compared to the spikes of clusters within that
+      radius of the block's clusters
+
+    With max_radius_um = None, the output matches calculate_silhouette_score.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    total_units : Int
+        Number of units (length of the output array)
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    total_spikes : Int
+        Number of spikes to sample
+    channel_pos : numpy.ndarray (num_channels x 2)
+        Channel positions in um
+    max_radius_um : float (optional)
+        Only score pairs of units whose peak channels are closer than this
+    block_size : Int
+        Number of spikes for which distances are held in memory at once
+
+    Outputs:
+    --------
+    silhouette_scores : numpy.ndarray (total_units x 0)
+        Minimum silhouette score of each unit against any other unit (NaN if no pairs)
+
+    """
+
+    random_spike_inds = np.random.permutation(spike_clusters.size)
+    random_spike_inds = random_spike_inds[:total_spikes]
+    num_pc_features = pc_features.shape[1]
+    max_channel = np.max(pc_feature_ind)
+
+    # group the sampled spikes by cluster, so each cluster is a contiguous block
+    cluster_labels = spike_clusters[random_spike_inds]
+    order = np.argsort(cluster_labels, kind = 'stable')
+    random_spike_inds = random_spike_inds[order]
+    cluster_labels = cluster_labels[order]
+
+    cluster_ids, starts, counts = np.unique(cluster_labels, return_index = True, return_counts = True)
+    num_clusters = cluster_ids.size
+    label_index = np.repeat(np.arange(num_clusters), counts)
+
+    silhouette_scores = np.empty((total_units,))
+    silhouette_scores[:] = np.nan
+
+    if num_clusters < 2:
+        return silhouette_scores
+
+    # scatter PCs into the same columns as the dense matrix of calculate_silhouette_score;
+    # where columns of different PCs collide, the later PC is kept, as in the original loop
+    spike_pcs = np.asarray(pc_features[random_spike_inds, :, :])
+    channels = pc_feature_ind[cluster_labels, :]
+
+    rows = np.tile(np.repeat(np.arange(total_spikes), channels.shape[1]), num_pc_features)
+    cols = np.concatenate([(channels + max_channel * j).flatten() for j in range(num_pc_features)])
+    values = np.concatenate([spike_pcs[:, j, :].flatten() for j in range(num_pc_features)]).astype('float64')
+
+    keys = rows * (max_channel * num_pc_features + 1) + cols
+    unique_keys, last = np.unique(keys[::-1], return_index = True)
+    keep = keys.size - 1 - last
+
+    all_pcs = csr_matrix((values[keep], (rows[keep], cols[keep])), 
+                         shape = (total_spikes, max_channel * num_pc_features + 1))
+
+    if max_radius_um is not None:
+
+        # peak channel of each unit, from the mean first PC of its sampled spikes
+        mean_first_pc = np.add.reduceat(spike_pcs[:, 0, :], starts, axis = 0) / counts[:, np.newaxis]
+        peak_channels = pc_feature_ind[cluster_ids, np.argmax(mean_first_pc, 1)]
+
+        peak_pos = channel_pos[peak_channels, :]
+        peak_dist = np.sqrt(np.sum(np.square(peak_pos[:, np.newaxis, :] - peak_pos[np.newaxis, :, :]), 2))
+
+        nearby = (peak_dist < max_radius_um) + np.eye(num_clusters, dtype = 'bool')
+
+    else:
+
+        nearby = np.ones((num_clusters, num_clusters), dtype = 'bool')
+
+    # summed distance from each spike to every nearby cluster (others are left at zero)
+    squared_norms = np.asarray(all_pcs.multiply(all_pcs).sum(1)).flatten()
+    distance_sums = np.zeros((total_spikes, num_clusters))
+
+    for block_start in range(0, total_spikes, block_size):
+
+        block = np.arange(block_start, np.min([block_start + block_size, total_spikes]))
+
+        # only the spikes of clusters near any cluster in the block
+        clusters_to_use = np.where(np.any(nearby[np.unique(label_index[block]), :], 0))[0]
+        columns = np.concatenate([np.arange(starts[i], starts[i] + counts[i]) for i in clusters_to_use])
+        column_starts = np.concatenate(([0], np.cumsum(counts[clusters_to_use])[:-1]))
+
+        squared_distances = squared_norms[block, np.newaxis] + squared_norms[np.newaxis, columns] \
+                            - 2 * (all_pcs[block, :] @ all_pcs[columns, :].T).toarray()
+        distances = np.sqrt(np.maximum(squared_distances, 0))
+        distances[np.arange(block.size), np.searchsorted(columns, block)] = 0
+
+        distance_sums[block[:, np.newaxis], clusters_to_use[np.newaxis, :]] = \
+            np.add.reduceat(distances, column_starts, axis = 1)
+
+    # silhouette of each spike relative to its own cluster and each other cluster
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        intra_dists = distance_sums[np.arange(total_spikes), label_index] / (counts[label_index] - 1)
+        inter_dists = distance_sums / counts[np.newaxis, :]
+
+        spike_silhouettes = (inter_dists - intra_dists[:, np.newaxis]) / \
+                            np.maximum(inter_dists, intra_dists[:, np.newaxis])
+
+    spike_silhouettes = np.nan_to_num(spike_silhouettes) # singleton clusters have a silhouette of 0
+
+    # score for each pair of clusters = mean over the spikes of both clusters
+    pair_sums = np.add.reduceat(spike_silhouettes, starts, axis = 0)
+    pair_counts = counts[:, np.newaxis] + counts[np.newaxis, :]
+
+    SS = (pair_sums + pair_sums.T) / pair_counts
+
+    invalid = np.eye(num_clusters, dtype = 'bool') + (pair_counts <= 2) + ~nearby
+
+    SS[invalid] = np.nan
+
+    with warnings.catch_warnings():
+      warnings.simplefilter("ignore")
+      silhouette_scores[cluster_ids] = np.nanmin(SS, 1)
+
+    return silhouette_scores
+
+
 def calculate_drift_metrics(spike_times,
                             spike_clusters,
                             total_units,
@@ -428,41 +1011,37 @@ def calculate_drift_metrics(spike_times,
                             pc_feature_ind,
                             channel_pos,
                             interval_length,
-                            min_spikes_per_interval):
+                            min_spikes_per_interval,
+                            cluster_index = None,
+                            spike_depths = None):
 
     max_drift = np.zeros((total_units,))
     cumulative_drift = np.zeros((total_units,))
 
-    depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
+    if spike_depths is None:
+        depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
+    else:
+        depths = spike_depths
     
     interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
     interval_ends = interval_starts + interval_length
 
-    cluster_ids = np.unique(spike_clusters)
-
-    for idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(idx+1, len(cluster_ids))
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-        in_cluster = spike_clusters == cluster_id
-        times_for_cluster = spike_times[in_cluster]
-        depths_for_cluster = depths[in_cluster]
+    cluster_ids = cluster_index.cluster_ids
 
-        median_depths = []
+    grouped_times = cluster_index.group(spike_times)
+    grouped_depths = cluster_index.group(depths)
+    grouped_units = np.repeat(np.arange(cluster_index.counts.size), cluster_index.counts)
 
-        for t1, t2 in zip(interval_starts, interval_ends):
+    # median depths for all (unit, interval) pairs at once
+    unit_max_drift, unit_cumulative_drift = batch_drift_metrics(grouped_times, grouped_depths, grouped_units, 
+                                                                cluster_index.counts.size, interval_starts, interval_ends, 
+                                                                min_spikes_per_interval)
 
-            in_range = (times_for_cluster > t1) * (times_for_cluster < t2)
-            
-            if np.sum(in_range) >= min_spikes_per_interval:
-                median_depths.append(np.median(depths_for_cluster[in_range]))
-            else:
-                median_depths.append(np.nan)
-            
-        median_depths = np.array(median_depths)
-            
-        max_drift[cluster_id] = np.around(np.nanmax(median_depths) - np.nanmin(median_depths),2)
-        cumulative_drift[cluster_id] = np.around(np.nansum(np.abs(np.diff(median_depths))),2)
+    max_drift[cluster_ids] = unit_max_drift[cluster_ids]
+    cumulative_drift[cluster_ids] = unit_cumulative_drift[cluster_ids]
 
     return max_drift, cumulative_drift
 
@@ -674,6 +1253,79 @@ def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
     return isolation_distance, l_ratio
 
 
+def mahalanobis_metrics_cholesky(all_pcs, all_labels, this_unit_id, regularization = 0.0, dtype = 'float64', unit_moments = None):
+
+    """ Calculates isolation distance and L-ratio (see mahalanobis_metrics)
+
+    Instead of inverting the covariance matrix and calling cdist, the covariance
+    of this unit is factored once (Cholesky), and the whitened coordinates of all
+    comparison spikes are obtained with a single matrix product with the inverse
+    of the triangular factor.
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    all_labels : numpy.ndarray (num_spikes x 0)
+        1D array of cluster labels for all spikes
+    this_unit_id : Int
+        number corresponding to unit for which these metrics will be calculated
+    regularization : float
+        Ridge added to the covariance, relative to its mean variance
+        (0 = none; singular covariances then return NaN)
+    dtype : str
+        Precision of the distance computation ('float64' or 'float32')
+    unit_moments : tuple (optional)
+        Mean and covariance of this unit's PCs, if already computed
+
+    Outputs:
+    --------
+    isolation_distance : float
+        Isolation distance of this unit
+    l_ratio : float
+        L-ratio for this unit
+
+    """
+
+    this_unit = all_labels == this_unit_id
+
+    pcs_for_this_unit = all_pcs[this_unit,:]
+    pcs_for_other_units = all_pcs[np.invert(this_unit),:]
+
+    if unit_moments is None:
+        unit_moments = get_mean_and_covariance(pcs_for_this_unit)
+
+    mean_value, covariance = unit_moments
+
+    try:
+        L = covariance_cholesky(covariance, regularization)
+    except np.linalg.LinAlgError: # case of singular matrix
+        return np.nan, np.nan
+
+    # whitening transform: |(x - mean) * W| = mahalanobis distance of x
+    W = np.ascontiguousarray(solve_triangular(L, np.eye(L.shape[0]), lower = True).T)
+
+    z = np.dot(pcs_for_other_units.astype(dtype, copy = False), W.astype(dtype))
+    z -= np.dot(mean_value, W).astype(dtype)
+
+    mahalanobis_other = np.sort(np.einsum('ij,ij->i', z, z).astype('float64'))
+
+    n = np.min([pcs_for_this_unit.shape[0], pcs_for_other_units.shape[0]]) # number of spikes
+
+    if n >= 2:
+
+        dof = pcs_for_this_unit.shape[1] # number of features
+
+        # squared distances follow a chi-square distribution
+        l_ratio = np.sum(chdtrc(dof, mahalanobis_other)) / mahalanobis_other.shape[0]
+        isolation_distance = mahalanobis_other[n-1]
+
+    else:
+        l_ratio = np.nan
+        isolation_distance = np.nan
+
+    return isolation_distance, l_ratio
+
 
 
 def lda_metrics(all_pcs, all_labels, this_unit_id):
@@ -718,6 +1370,67 @@ def lda_metrics(all_pcs, all_labels, this_unit_id):
 
 
 
+def fisher_metrics(all_pcs, all_labels, this_unit_id, regularization = 0.0, unit_moments = None):
+
+    """ Calculates d-prime from the closed-form Fisher linear discriminant
+
+    Same value as lda_metrics, without fitting an sklearn model: the discriminant
+    is w = inv(Sw) * (mean_this - mean_other), where Sw is the pooled within-class
+    covariance, and the means and variances of the projections follow from the
+    class means and covariances.
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    all_labels : numpy.ndarray (num_spikes x 0)
+        1D array of cluster labels for all spikes
+    this_unit_id : Int
+        number corresponding to unit for which these metrics will be calculated
+    regularization : float
+        Ridge added to the pooled covariance, relative to its mean variance
+        (0 = none; singular covariances then fall back to lda_metrics)
+    unit_moments : tuple (optional)
+        Mean and covariance of this unit's PCs, if already computed
+        (e.g. for mahalanobis_metrics_cholesky)
+
+    Outputs:
+    --------
+    d_prime : float
+        d-prime of this unit
+
+    """
+
+    this_unit = all_labels == this_unit_id
+
+    n_this = np.sum(this_unit)
+    n_other = all_labels.size - n_this
+
+    if unit_moments is None:
+        unit_moments = get_mean_and_covariance(all_pcs[this_unit,:])
+
+    mean_this, cov_this = unit_moments
+    mean_other, cov_other = get_mean_and_covariance(all_pcs[np.invert(this_unit),:])
+
+    pooled_cov = ((n_this - 1) * cov_this + (n_other - 1) * cov_other) / (n_this + n_other - 2)
+
+    try:
+        L = covariance_cholesky(pooled_cov, regularization)
+    except np.linalg.LinAlgError: # singular matrix: let sklearn reduce the rank
+        return lda_metrics(all_pcs, all_labels, this_unit_id)
+
+    mean_difference = mean_this - mean_other
+    w = cho_solve((L, True), mean_difference)
+
+    # variance of the projections, normalized by N as in np.std
+    var_this = np.dot(w, np.dot(cov_this, w)) * (n_this - 1) / n_this
+    var_other = np.dot(w, np.dot(cov_other, w)) * (n_other - 1) / n_other
+
+    d_prime = np.dot(w, mean_difference) / np.sqrt(0.5 * (var_this + var_other))
+
+    return d_prime
+
+
 def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_nn, n_neighbors):
 
     """ Calculates unit contamination based on NearestNeighbors search in PCA space
@@ -773,13 +1486,189 @@ def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_
     
     return hit_rate, miss_rate
 
+def nearest_neighbors_metrics_brute(all_pcs, all_labels, this_unit_id, max_spikes_for_nn, n_neighbors, block_size = 1000):
+
+    """ Calculates unit contamination based on NearestNeighbors search in PCA space
+
+    Same subsample, neighbor count and hit/miss definitions as nearest_neighbors_metrics,
+    but neighbors are found by computing all distances for blocks of spikes at a time
+    (as matrix products), instead of building and querying a ball tree.
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    all_labels : numpy.ndarray (num_spikes x 0)
+        1D array of cluster labels for all spikes
+    this_unit_id : Int
+        number corresponding to unit for which these metrics will be calculated
+    max_spikes_for_nn : Int
+        number of spikes to use
+    n_neighbors : Int
+        number of neighbors to use (including the spike itself)
+    block_size : Int
+        number of spikes for which distances are computed at once
+
+    Outputs:
+    --------
+    hit_rate : float
+        Fraction of neighbors for target cluster that are also in target cluster
+    miss_rate : float
+        Fraction of neighbors outside target cluster that are in target cluster
+
+    """
+
+    total_spikes = all_pcs.shape[0]
+    ratio = max_spikes_for_nn / total_spikes
+    this_unit = all_labels == this_unit_id
+
+    X = np.concatenate((all_pcs[this_unit,:], all_pcs[np.invert(this_unit),:]),0)
+
+    n = np.sum(this_unit)
+
+    if ratio < 1:
+        inds = np.arange(0,X.shape[0]-1,1/ratio).astype('int')
+        X = X[inds,:]
+        n = int(n * ratio)
+
+    indices = blocked_nearest_neighbors(X, n_neighbors - 1, block_size)
+
+    hit_rate = np.mean(indices[:n,:] < n)
+    miss_rate = np.mean(indices[n:,:] < n)
+
+    return hit_rate, miss_rate
+
 # ==========================================================
 
 # HELPER FUNCTIONS:
 
 # ==========================================================
 
-def make_index_mask(spike_clusters, unit_id, min_num, max_num):
+def get_epoch_index(spike_times, epoch, times_are_sorted):
+
+    """ Select the spikes that fall within an epoch
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    epoch : Epoch
+        Epoch with start and end times in seconds
+    times_are_sorted : bool
+        True if spike_times are in ascending order
+
+    Output:
+    -------
+    in_epoch : slice or numpy.ndarray (boolean)
+        Slice of the spikes within the epoch if spike_times are sorted, 
+        otherwise a boolean mask
+
+    """
+
+    if times_are_sorted:
+        start = np.searchsorted(spike_times, epoch.start_time, side = 'right')
+        end = np.searchsorted(spike_times, epoch.end_time, side = 'left')
+        return slice(start, max(start, end))
+    else:
+        return (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+
+
+def blocked_nearest_neighbors(X, n_neighbors, block_size = 1000):
+
+    """ Exact nearest neighbors of every point of X, excluding the point itself
+
+    Inputs:
+    -------
+    X : numpy.ndarray (num_points x num_features)
+        Points to search
+    n_neighbors : Int
+        Number of neighbors to return for each point
+    block_size : Int
+        Number of points for which distances are computed at once
+
+    Output:
+    -------
+    indices : numpy.ndarray (num_points x n_neighbors)
+        Indices of the neighbors of each point, nearest first
+
+    """
+
+    num_points = X.shape[0]
+    n_neighbors = np.min([n_neighbors, num_points - 1])
+
+    indices = np.zeros((num_points, n_neighbors), dtype = 'int')
+
+    if n_neighbors < 1:
+        return indices
+
+    squared_norms = np.sum(np.square(X), 1)
+
+    for start in range(0, num_points, block_size):
+
+        block = slice(start, np.min([start + block_size, num_points]))
+        rows = np.arange(block.stop - block.start)
+
+        # squared distances, minus the squared norm of each row (same ranking within a row)
+        distances = np.dot(X[block,:], X.T)
+        distances *= -2
+        distances += squared_norms
+        distances[rows, rows + start] = np.inf
+
+        # n_neighbors is small, so repeated minima are faster than a partition
+        for neighbor in range(n_neighbors):
+            nearest = np.argmin(distances, 1)
+            indices[block, neighbor] = nearest
+            distances[rows, nearest] = np.inf
+
+    return indices
+
+
+def get_mean_and_covariance(pcs):
+
+    """ Mean and (unbiased) covariance of a set of PCs (num_spikes x num_features) """
+
+    return np.mean(pcs,0), np.atleast_2d(np.cov(pcs.T))
+
+
+def covariance_cholesky(covariance, regularization = 0.0):
+
+    """ Lower-triangular Cholesky factor of a covariance matrix
+
+    Inputs:
+    -------
+    covariance : numpy.ndarray (num_features x num_features)
+        Covariance matrix
+    regularization : float
+        Ridge added to the diagonal, as a fraction of the mean variance
+
+    Outputs:
+    --------
+    L : numpy.ndarray (num_features x num_features)
+        Lower-triangular matrix such that L * L.T = covariance (+ ridge)
+
+    Raises numpy.linalg.LinAlgError if the (regularized) matrix is singular
+
+    """
+
+    covariance = np.atleast_2d(covariance)
+    num_features = covariance.shape[0]
+
+    if regularization > 0:
+        ridge = regularization * np.trace(covariance) / num_features
+        covariance = covariance + ridge * np.eye(num_features)
+
+    L = np.linalg.cholesky(covariance)
+
+    # rank-deficient matrices can factor with pivots at the level of rounding error
+    tolerance = num_features * np.finfo('float64').eps * np.max(np.diag(covariance))
+
+    if np.min(np.square(np.diag(L))) <= tolerance:
+        raise np.linalg.LinAlgError('Covariance matrix is singular')
+
+    return L
+
+
+def make_index_mask(spike_clusters, unit_id, min_num, max_num, rng = None):
 
     """ Create a mask for the spike index dimensions of the pc_features array  
 
@@ -793,6 +1682,8 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
         Minimum number of spikes to return; if there are not enough spikes for this unit, return all False
     max_num : Int
         Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+    rng : numpy.random.RandomState (optional)
+        Random generator for the subsample; uses the global numpy generator if not specified
 
     Output:
     -------
@@ -809,7 +1700,9 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
         index_mask = np.zeros((spike_clusters.size,), dtype='bool')
     else:
         index_mask = np.zeros((spike_clusters.size,), dtype='bool')
-        order = np.random.permutation(inds.size)
+        if rng is None:
+            rng = np.random
+        order = rng.permutation(inds.size)
         index_mask[inds[order[:max_num]]] = True
         
     return index_mask
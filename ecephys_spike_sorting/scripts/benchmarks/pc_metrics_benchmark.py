@@ -0,0 +1,93 @@
+"""
+Times the per-unit PC metric implementations on synthetic feature blocks
+of the size produced by calculate_pc_metrics
+
+python -m ecephys_spike_sorting.scripts.benchmarks.pc_metrics_benchmark --max_spikes_for_unit 500 2000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from ecephys_spike_sorting.modules.quality_metrics.metrics import mahalanobis_metrics, mahalanobis_metrics_cholesky, \
+    lda_metrics, fisher_metrics, nearest_neighbors_metrics, nearest_neighbors_metrics_brute
+
+
+def make_feature_block(max_spikes_for_unit, num_units, num_features, seed = 0):
+
+    """ Random PCs for one unit and its neighbors, each subsampled to max_spikes_for_unit """
+
+    rng = np.random.RandomState(seed)
+
+    all_pcs = np.concatenate([rng.randn(max_spikes_for_unit, num_features) * (1 + rng.rand()) + rng.randn(num_features) * 3
+                              for unit in range(num_units)], 0)
+    all_labels = np.repeat(np.arange(num_units), max_spikes_for_unit)
+
+    return all_pcs, all_labels
+
+
+def time_function(function, repeats, *args, **kwargs):
+
+    times = []
+
+    for i in range(repeats):
+        start = time.perf_counter()
+        output = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    return np.min(times), output
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmark for PC-based quality metrics')
+    parser.add_argument('--max_spikes_for_unit', type = int, nargs = '+', default = [500, 2000])
+    parser.add_argument('--num_units', type = int, default = 10, help = 'units sharing the peak channel neighborhood')
+    parser.add_argument('--num_features', type = int, default = 30, help = 'PCs x channels within max_radius_um')
+    parser.add_argument('--max_spikes_for_nn', type = int, default = 10000)
+    parser.add_argument('--n_neighbors', type = int, default = 4)
+    parser.add_argument('--repeats', type = int, default = 5)
+    args = parser.parse_args()
+
+    print('max_spikes_for_unit  method                 time (ms)  speedup')
+
+    for max_spikes in args.max_spikes_for_unit:
+
+        all_pcs, all_labels = make_feature_block(max_spikes, args.num_units, args.num_features)
+
+        reference, expected = time_function(mahalanobis_metrics, args.repeats, all_pcs, all_labels, 0)
+
+        print('%19d  %-21s  %9.2f  %7.2f' % (max_spikes, 'inverse + cdist', reference * 1000, 1.0))
+
+        for dtype in ('float64', 'float32'):
+
+            elapsed, output = time_function(mahalanobis_metrics_cholesky, args.repeats, all_pcs, all_labels, 0, dtype = dtype)
+
+            assert np.allclose(output, expected, rtol = 1e-3)
+
+            print('%19d  %-21s  %9.2f  %7.2f' % (max_spikes, 'cholesky ' + dtype, elapsed * 1000, reference / elapsed))
+
+        reference, expected = time_function(lda_metrics, args.repeats, all_pcs, all_labels, 0)
+
+        print('%19d  %-21s  %9.2f  %7.2f' % (max_spikes, 'sklearn LDA', reference * 1000, 1.0))
+
+        elapsed, output = time_function(fisher_metrics, args.repeats, all_pcs, all_labels, 0)
+
+        assert np.isclose(output, expected)
+
+        print('%19d  %-21s  %9.2f  %7.2f' % (max_spikes, 'closed-form Fisher', elapsed * 1000, reference / elapsed))
+
+        reference, expected = time_function(nearest_neighbors_metrics, 1, all_pcs, all_labels, 0, args.max_spikes_for_nn, args.n_neighbors)
+
+        print('%19d  %-21s  %9.2f  %7.2f' % (max_spikes, 'NN ball tree', reference * 1000, 1.0))
+
+        elapsed, output = time_function(nearest_neighbors_metrics_brute, 1, all_pcs, all_labels, 0, args.max_spikes_for_nn, args.n_neighbors)
+
+        assert np.allclose(output, expected)
+
+        print('%19d  %-21s  %9.2f  %7.2f' % (max_spikes, 'NN brute force', elapsed * 1000, reference / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Runs kilosort_postprocessing, noise_templates, mean_waveforms and quality_metrics
+on synthetic Kilosort outputs at several scales, and records the wall time and
+peak RSS of each module and of the whole pipeline as JSON
+
+python -m ecephys_spike_sorting.scripts.benchmarks.pipeline_benchmark /path/to/scratch --scales small medium --output_json results.json
+
+Each module runs in a fresh process, so the peak RSS of one stage does not
+include memory left over from the previous stages.
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from ecephys_spike_sorting.common.utils import get_repo_commit_date_and_hash
+from ecephys_spike_sorting.scripts.benchmarks.synthetic_data import make_kilosort_output
+
+SCALES = {'small' : {'num_spikes' : 50000, 'num_units' : 50, 'num_channels' : 64, 'duration' : 60.0},
+          'medium' : {'num_spikes' : 500000, 'num_units' : 200, 'num_channels' : 128, 'duration' : 300.0},
+          'large' : {'num_spikes' : 2000000, 'num_units' : 500, 'num_channels' : 384, 'duration' : 600.0}}
+
+# module, entry point and parameters section for each stage, in pipeline order
+STAGES = [('kilosort_postprocessing', 'run_postprocessing', 'ks_postprocessing_params'),
+          ('noise_templates', 'classify_noise_templates', 'noise_waveform_params'),
+          ('mean_waveforms', 'calculate_mean_waveforms', 'mean_waveform_params'),
+          ('quality_metrics', 'calculate_quality_metrics', 'quality_metrics_params')]
+
+
+def make_input_json(info, stage_params = None):
+
+    """ Module inputs for a synthetic dataset (see make_kilosort_output), shared by all stages """
+
+    kilosort_output_directory = info['kilosort_output_directory']
+
+    input_json = {
+        'directories' : {'kilosort_output_directory' : kilosort_output_directory},
+        'ephys_params' : {'sample_rate' : info['sample_rate'],
+                          'bit_volts' : info['bit_volts'],
+                          'num_channels' : info['num_channels'],
+                          'vertical_site_spacing' : 20e-6,
+                          'ap_band_file' : info['ap_band_file']},
+        'waveform_metrics' : {'waveform_metrics_file' : os.path.join(kilosort_output_directory, 'waveform_metrics.csv')},
+        'cluster_metrics' : {'cluster_metrics_file' : os.path.join(kilosort_output_directory, 'metrics.csv')},
+        'ks_postprocessing_params' : {},
+        'noise_waveform_params' : {'classifier_path' : os.path.join(os.path.dirname(importlib.util.find_spec(
+                                        'ecephys_spike_sorting.modules.noise_templates').origin), 'rf_classifier.pkl'),
+                                   'multiprocessing_worker_count' : 1},
+        'mean_waveform_params' : {'mean_waveforms_file' : os.path.join(kilosort_output_directory, 'mean_waveforms.npy')},
+        'quality_metrics_params' : {},
+    }
+
+    if stage_params is not None:
+        for section, params in stage_params.items():
+            input_json[section].update(params)
+
+    return input_json
+
+
+def get_peak_rss_mb():
+
+    """ 
+    Peak resident set size of this process and its (finished) children, in MB
+
+    On Linux, ru_maxrss of a new process starts from its parent's peak, so the
+    peak of this process is read from /proc instead.
+    """
+
+    peak_kb = [resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss]
+
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            peak_kb += [int(line.split()[1]) for line in f if line.startswith('VmHWM')]
+    else:
+        peak_kb.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    if sys.platform == 'darwin':
+        return max(peak_kb) / 1024 / 1024 # bytes on macOS
+    else:
+        return max(peak_kb) / 1024
+
+
+def run_stage(module_name, function_name, input_json, queue):
+
+    """ Runs one module in the current process and reports its timing through queue """
+
+    try:
+        module = importlib.import_module('ecephys_spike_sorting.modules.' + module_name + '.__main__')
+        schemas = importlib.import_module('ecephys_spike_sorting.modules.' + module_name + '._schemas')
+
+        from argschema import ArgSchemaParser
+
+        input_data = {key : value for key, value in input_json.items() if key in schemas.InputParameters().fields}
+
+        mod = ArgSchemaParser(input_data = input_data, schema_type = schemas.InputParameters, args = [])
+
+        start = time.perf_counter()
+        getattr(module, function_name)(mod.args)
+        wall_time = time.perf_counter() - start
+
+        queue.put({'status' : 'ok', 'wall_time_s' : wall_time, 'peak_rss_mb' : get_peak_rss_mb()})
+
+    except Exception as e:
+
+        queue.put({'status' : 'failed', 'error' : traceback.format_exception_only(type(e), e)[-1].strip(),
+                   'peak_rss_mb' : get_peak_rss_mb()})
+
+
+def run_pipeline(info, stages = None, stage_params = None):
+
+    """
+    Runs the modules in order on one dataset, each in a new process
+
+    Outputs:
+    --------
+    results : list of dict
+        One entry per stage (stage, status, wall_time_s, peak_rss_mb), followed by
+        an entry for the whole pipeline ('pipeline')
+
+    """
+
+    input_json = make_input_json(info, stage_params)
+    context = multiprocessing.get_context('spawn')
+
+    results = []
+    start = time.perf_counter()
+
+    for module_name, function_name, section in STAGES:
+
+        if stages is not None and module_name not in stages:
+            continue
+
+        print('Running ' + module_name + '...')
+
+        queue = context.Queue()
+        process = context.Process(target = run_stage, args = (module_name, function_name, input_json, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+
+        result.update({'stage' : module_name, 'params' : input_json[section]})
+        results.append(result)
+
+        print('   ' + result['status'] + ' ' + str(np.around(result.get('wall_time_s', np.nan), 2)) + ' s, ' + \
+              str(np.around(result['peak_rss_mb'], 1)) + ' MB' + ('' if result['status'] == 'ok' else ': ' + result['error']))
+
+    results.append({'stage' : 'pipeline',
+                    'status' : 'ok' if all([r['status'] == 'ok' for r in results]) else 'failed',
+                    'wall_time_s' : time.perf_counter() - start,
+                    'peak_rss_mb' : max([r['peak_rss_mb'] for r in results] + [0])})
+
+    return results
+
+
+def get_environment():
+
+    commit_date, commit_hash = get_repo_commit_date_and_hash(os.path.dirname(os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+
+    return {'date' : datetime.datetime.now().isoformat(),
+            'commit_hash' : commit_hash,
+            'commit_date' : commit_date,
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'platform' : platform.platform(),
+            'cpu_count' : multiprocessing.cpu_count()}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'End-to-end benchmark of the post-sorting modules on synthetic data')
+    parser.add_argument('scratch_directory', help = 'location for the synthetic datasets')
+    parser.add_argument('--scales', nargs = '+', default = ['small', 'medium'], choices = sorted(SCALES.keys()))
+    parser.add_argument('--stages', nargs = '+', default = None, choices = [stage[0] for stage in STAGES])
+    parser.add_argument('--stage_params', type = str, default = None,
+                        help = 'JSON with parameters for each section, e.g. {"quality_metrics_params": {"num_workers": 4}}')
+    parser.add_argument('--output_json', type = str, default = 'benchmark_results.json')
+    parser.add_argument('--keep_data', action = 'store_true', help = 'do not delete the synthetic datasets')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    stage_params = json.loads(args.stage_params) if args.stage_params is not None else None
+
+    output = {'environment' : get_environment(), 'results' : []}
+
+    for scale in args.scales:
+
+        data_directory = os.path.join(args.scratch_directory, 'synthetic_' + scale)
+
+        print('Generating ' + scale + ' dataset...')
+
+        start = time.perf_counter()
+        info = make_kilosort_output(data_directory, seed = args.seed, **SCALES[scale])
+        generation_time = time.perf_counter() - start
+
+        for result in run_pipeline(info, args.stages, stage_params):
+            result.update({'scale' : scale, 'dataset' : {key : info[key] for key in
+                          ('num_spikes', 'num_units', 'num_channels', 'duration')}})
+            output['results'].append(result)
+
+        output['results'][-1]['generation_time_s'] = generation_time
+
+        if not args.keep_data:
+            shutil.rmtree(data_directory)
+
+    with open(args.output_json, 'w') as f:
+        json.dump(output, f, indent = 2)
+
+    print('Saved results to ' + args.output_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+Writes a synthetic Kilosort/phy output folder and a matching int16 AP band
+binary, for running and benchmarking the modules without real recordings
+
+python -m ecephys_spike_sorting.scripts.benchmarks.synthetic_data /path/to/output --num_spikes 100000 --num_units 100
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+
+def make_channel_positions(num_channels, vertical_spacing = 20.0):
+
+    """ Neuropixels 1.0 layout: two sites per row, staggered across four columns """
+
+    channel_pos = np.zeros((num_channels, 2))
+    channel_pos[:, 0] = np.tile([43.0, 11.0, 59.0, 27.0], num_channels // 4 + 1)[:num_channels]
+    channel_pos[:, 1] = (np.arange(num_channels) // 2) * vertical_spacing + vertical_spacing
+
+    return channel_pos
+
+
+def make_templates(num_units, channel_pos, rng, samples_per_template = 82, template_zero_padding = 21, pre_samples = 20):
+
+    """
+    Biphasic waveforms with a Gaussian spatial footprint around a random peak channel
+
+    Outputs:
+    --------
+    templates : numpy.ndarray (num_units x samples_per_template x num_channels)
+        Peak-normalized waveforms, zero for the first template_zero_padding samples
+    peak_channels : numpy.ndarray (num_units,)
+
+    """
+
+    num_channels = channel_pos.shape[0]
+    t = np.arange(samples_per_template - template_zero_padding, dtype = 'float')
+    peak_time = pre_samples + rng.uniform(-1, 1, num_units)
+
+    trough_width = rng.uniform(2.0, 4.0, num_units)
+    peak_width = rng.uniform(4.0, 10.0, num_units)
+    peak_delay = rng.uniform(6.0, 16.0, num_units)
+    peak_ratio = rng.uniform(0.2, 0.6, num_units)
+
+    waveforms = -np.exp(-0.5 * ((t[np.newaxis, :] - peak_time[:, np.newaxis]) / trough_width[:, np.newaxis]) ** 2) + \
+        peak_ratio[:, np.newaxis] * np.exp(-0.5 * ((t[np.newaxis, :] - peak_time[:, np.newaxis] - peak_delay[:, np.newaxis]) / peak_width[:, np.newaxis]) ** 2)
+
+    peak_channels = rng.randint(0, num_channels, num_units)
+    footprint_um = rng.uniform(20.0, 40.0, num_units)
+
+    distance = np.sqrt(np.sum((channel_pos[peak_channels, np.newaxis, :] - channel_pos[np.newaxis, :, :]) ** 2, 2))
+    spatial = np.exp(-0.5 * (distance / footprint_um[:, np.newaxis]) ** 2)
+    spatial[distance > 4 * footprint_um[:, np.newaxis]] = 0
+
+    templates = np.zeros((num_units, samples_per_template, num_channels), dtype = 'float32')
+    templates[:, template_zero_padding:, :] = waveforms[:, :, np.newaxis] * spatial[:, np.newaxis, :]
+
+    return templates, peak_channels
+
+
+def make_spike_trains(num_spikes, num_units, duration, sample_rate, rng, duplicate_fraction = 0.005, margin = 100):
+
+    """
+    Spike times (in samples) for units with log-normally distributed firing rates
+
+    A small fraction of spikes is duplicated a few samples later, as Kilosort
+    sometimes does, so that kilosort_postprocessing has spikes to remove.
+
+    Outputs:
+    --------
+    spike_times : numpy.ndarray (num_spikes,), uint64, sorted
+    spike_clusters : numpy.ndarray (num_spikes,), int32
+
+    """
+
+    rates = rng.lognormal(0, 1, num_units)
+
+    num_duplicates = int(num_spikes * duplicate_fraction)
+    counts = rng.multinomial(num_spikes - num_duplicates, rates / np.sum(rates))
+
+    spike_clusters = np.repeat(np.arange(num_units), counts).astype('int32')
+    spike_times = rng.randint(margin, int(duration * sample_rate) - margin, spike_clusters.size).astype('int64')
+
+    duplicates = rng.choice(spike_clusters.size, num_duplicates, replace = False)
+    spike_times = np.concatenate((spike_times, spike_times[duplicates] + rng.randint(1, 4, num_duplicates)))
+    spike_clusters = np.concatenate((spike_clusters, spike_clusters[duplicates]))
+
+    order = np.argsort(spike_times, kind = 'stable')
+
+    return spike_times[order].astype('uint64'), spike_clusters[order]
+
+
+def get_feature_channels(peak_channels, channel_pos, num_feature_channels):
+
+    """ Nearest num_feature_channels channels to each unit's peak channel (as in pc_feature_ind.npy) """
+
+    distance = np.sqrt(np.sum((channel_pos[peak_channels, np.newaxis, :] - channel_pos[np.newaxis, :, :]) ** 2, 2))
+
+    return np.argsort(distance, 1, kind = 'stable')[:, :num_feature_channels].astype('uint32')
+
+
+def write_features(output_dir, spike_clusters, spike_scale, templates, pc_feature_ind, template_feature_ind, num_pcs, rng, chunk_size = 100000):
+
+    """
+    Writes pc_features.npy (spikes x PCs x channels) and template_features.npy (spikes x templates)
+    in blocks of spikes, so they can be larger than memory
+
+    The first PC follows the template energy on each feature channel; the other PCs and the
+    projections onto other templates are unit-specific offsets plus noise.
+    """
+
+    num_spikes = spike_clusters.size
+    num_units = templates.shape[0]
+
+    energy = np.sqrt(np.sum(templates ** 2, 1))
+    unit_pcs = rng.randn(num_units, num_pcs, pc_feature_ind.shape[1]).astype('float32')
+    unit_pcs[:, 0, :] = 10 * energy[np.arange(num_units)[:, np.newaxis], pc_feature_ind]
+
+    flat_templates = templates.reshape((num_units, -1))
+    flat_templates = flat_templates / np.linalg.norm(flat_templates, axis = 1)[:, np.newaxis]
+    similarity = np.dot(flat_templates, flat_templates.T)
+    unit_template_features = similarity[np.arange(num_units)[:, np.newaxis], template_feature_ind].astype('float32')
+
+    pc_features = np.lib.format.open_memmap(os.path.join(output_dir, 'pc_features.npy'), mode = 'w+', dtype = 'float32',
+                                            shape = (num_spikes, num_pcs, pc_feature_ind.shape[1]))
+    template_features = np.lib.format.open_memmap(os.path.join(output_dir, 'template_features.npy'), mode = 'w+', dtype = 'float32',
+                                                  shape = (num_spikes, template_feature_ind.shape[1]))
+
+    for start in range(0, num_spikes, chunk_size):
+
+        end = min(start + chunk_size, num_spikes)
+        units = spike_clusters[start:end]
+        scale = spike_scale[start:end, np.newaxis]
+
+        pc_features[start:end] = unit_pcs[units] * scale[:, :, np.newaxis] + rng.randn(end - start, *unit_pcs.shape[1:])
+        template_features[start:end] = unit_template_features[units] * scale * 20 + rng.randn(end - start, template_feature_ind.shape[1])
+
+    pc_features.flush()
+    template_features.flush()
+
+
+def write_binary(output_file, spike_times, spike_clusters, spike_scale, waveforms_uv, local_channels, num_channels,
+                 num_samples, bit_volts, noise_uv, pre_samples, rng, max_chunk_values = 5000000):
+
+    """
+    Writes an int16 binary (samples x channels) of Gaussian noise plus each spike's waveform
+
+    Inputs:
+    -------
+    waveforms_uv : numpy.ndarray (num_units x samples x local channels)
+        Waveform of each unit in microvolts, on the channels in local_channels
+    local_channels : numpy.ndarray (num_units x local channels)
+        Channels carrying each unit's waveform
+
+    """
+
+    data = np.memmap(output_file, dtype = 'int16', mode = 'w+', shape = (num_samples, num_channels))
+
+    samples_per_spike = waveforms_uv.shape[1]
+    values_per_spike = samples_per_spike * local_channels.shape[1]
+    batch_size = max(1, max_chunk_values // values_per_spike)
+    chunk_samples = max(samples_per_spike, max_chunk_values // num_channels)
+
+    spike_starts = spike_times.astype('int64') - pre_samples
+    offsets = np.arange(samples_per_spike)
+
+    for chunk_start in range(0, num_samples, chunk_samples):
+
+        chunk_end = min(chunk_start + chunk_samples, num_samples)
+        chunk = rng.normal(0, noise_uv, (chunk_end - chunk_start, num_channels)).ravel()
+
+        first = np.searchsorted(spike_starts, chunk_start - samples_per_spike)
+        last = np.searchsorted(spike_starts, chunk_end)
+
+        for batch_start in range(first, last, batch_size):
+
+            batch = np.arange(batch_start, min(batch_start + batch_size, last))
+            units = spike_clusters[batch]
+
+            rows = spike_starts[batch, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis] - chunk_start
+            flat_index = rows * num_channels + local_channels[units][:, np.newaxis, :]
+            values = waveforms_uv[units] * spike_scale[batch, np.newaxis, np.newaxis]
+
+            in_chunk = (rows >= 0) * (rows < chunk_end - chunk_start) * np.ones(flat_index.shape, dtype = 'bool')
+
+            chunk += np.bincount(flat_index[in_chunk], weights = values[in_chunk], minlength = chunk.size)
+
+        data[chunk_start:chunk_end, :] = np.clip(np.round(chunk / bit_volts), -32768, 32767).reshape((-1, num_channels))
+
+    data.flush()
+
+
+def make_kilosort_output(output_dir,
+                         num_spikes = 100000,
+                         num_units = 100,
+                         num_channels = 64,
+                         num_pcs = 3,
+                         num_feature_channels = 32,
+                         duration = None,
+                         sample_rate = 30000.0,
+                         bit_volts = 0.195,
+                         noise_uv = 10.0,
+                         samples_per_template = 82,
+                         template_zero_padding = 21,
+                         write_raw_data = True,
+                         seed = 0):
+
+    """
+    Writes a synthetic phy/Kilosort output folder
+
+    Inputs:
+    -------
+    output_dir : str
+        Location for the output files (created if necessary)
+    num_spikes : int
+        Total number of spikes
+    num_units : int
+        Number of units (= templates)
+    num_channels : int
+        Number of channels, all of them used for sorting
+    num_pcs : int
+        Number of PCs in pc_features.npy
+    num_feature_channels : int
+        Number of channels per unit in pc_features.npy and templates per spike in template_features.npy
+    duration : float
+        Recording length in seconds (default = 10 spikes/s per unit)
+    sample_rate : float
+        AP band sample rate in Hz
+    bit_volts : float
+        Microvolts per bit of the binary
+    noise_uv : float
+        Standard deviation of the background noise in the binary
+    write_raw_data : bool
+        Whether to write the int16 binary (continuous.dat)
+    seed : int
+        Random seed
+
+    Outputs:
+    --------
+    info : dict
+        'kilosort_output_directory', 'ap_band_file', 'sample_rate', 'bit_volts', 'num_channels',
+        'num_spikes', 'num_units', 'duration'
+
+    """
+
+    rng = np.random.RandomState(seed)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    if duration is None:
+        duration = num_spikes / (10.0 * num_units)
+
+    num_feature_channels = min(num_feature_channels, num_channels)
+    pre_samples = 20
+
+    channel_pos = make_channel_positions(num_channels)
+    channel_map = np.arange(num_channels, dtype = 'int32')
+
+    templates, peak_channels = make_templates(num_units, channel_pos, rng, samples_per_template, template_zero_padding, pre_samples)
+    spike_times, spike_clusters = make_spike_trains(num_spikes, num_units, duration, sample_rate, rng)
+
+    unit_peak_uv = rng.uniform(50, 300, num_units)
+    spike_scale = rng.lognormal(0, 0.15, spike_clusters.size).astype('float32')
+
+    amplitudes = (unit_peak_uv[spike_clusters] / 10.0 * spike_scale).astype('float64')
+
+    pc_feature_ind = get_feature_channels(peak_channels, channel_pos, num_feature_channels)
+    template_feature_ind = np.argsort(np.abs(peak_channels[:, np.newaxis] - peak_channels[np.newaxis, :]), 1,
+                                      kind = 'stable')[:, :min(num_feature_channels, num_units)].astype('uint32')
+
+    np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
+    np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
+    np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_clusters.copy())
+    np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
+    np.save(os.path.join(output_dir, 'templates.npy'), templates)
+    np.save(os.path.join(output_dir, 'templates_ind.npy'), np.tile(channel_map.astype('float64'), (num_units, 1)))
+    np.save(os.path.join(output_dir, 'whitening_mat.npy'), np.eye(num_channels))
+    np.save(os.path.join(output_dir, 'whitening_mat_inv.npy'), np.eye(num_channels))
+    np.save(os.path.join(output_dir, 'channel_map.npy'), channel_map)
+    np.save(os.path.join(output_dir, 'channel_positions.npy'), channel_pos)
+    np.save(os.path.join(output_dir, 'pc_feature_ind.npy'), pc_feature_ind)
+    np.save(os.path.join(output_dir, 'template_feature_ind.npy'), template_feature_ind)
+    np.save(os.path.join(output_dir, 'similar_templates.npy'), np.eye(num_units, dtype = 'float32'))
+
+    write_features(output_dir, spike_clusters, spike_scale, templates, pc_feature_ind, template_feature_ind, num_pcs, rng)
+
+    with open(os.path.join(output_dir, 'cluster_Amplitude.tsv'), 'w') as f:
+        f.write('cluster_id\tAmplitude\n')
+        for unit, amplitude in enumerate(unit_peak_uv / 10.0):
+            f.write('%d\t%.1f\n' % (unit, amplitude))
+
+    ap_band_file = os.path.join(output_dir, 'continuous.dat')
+
+    with open(os.path.join(output_dir, 'params.py'), 'w') as f:
+        f.write("dat_path = 'continuous.dat'\n")
+        f.write('n_channels_dat = %d\n' % num_channels)
+        f.write("dtype = 'int16'\n")
+        f.write('offset = 0\n')
+        f.write('sample_rate = %.1f\n' % sample_rate)
+        f.write('hp_filtered = True\n')
+
+    if write_raw_data:
+
+        local_channels = get_feature_channels(peak_channels, channel_pos, min(16, num_channels))
+        waveforms_uv = templates[np.arange(num_units)[:, np.newaxis], template_zero_padding:, local_channels]
+        waveforms_uv = np.transpose(waveforms_uv, (0, 2, 1)) * unit_peak_uv[:, np.newaxis, np.newaxis]
+
+        write_binary(ap_band_file, spike_times, spike_clusters, spike_scale, waveforms_uv.astype('float32'), local_channels,
+                     num_channels, int(duration * sample_rate), bit_volts, noise_uv, pre_samples, rng)
+
+    return {'kilosort_output_directory' : output_dir,
+            'ap_band_file' : ap_band_file,
+            'sample_rate' : sample_rate,
+            'bit_volts' : bit_volts,
+            'num_channels' : num_channels,
+            'num_spikes' : int(spike_clusters.size),
+            'num_units' : num_units,
+            'duration' : duration}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Write a synthetic Kilosort output folder')
+    parser.add_argument('output_dir')
+    parser.add_argument('--num_spikes', type = int, default = 100000)
+    parser.add_argument('--num_units', type = int, default = 100)
+    parser.add_argument('--num_channels', type = int, default = 64)
+    parser.add_argument('--num_pcs', type = int, default = 3)
+    parser.add_argument('--num_feature_channels', type = int, default = 32)
+    parser.add_argument('--duration', type = float, default = None, help = 'seconds (default = 10 spikes/s per unit)')
+    parser.add_argument('--no_raw_data', action = 'store_true', help = 'skip writing continuous.dat')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    info = make_kilosort_output(args.output_dir, args.num_spikes, args.num_units, args.num_channels, args.num_pcs,
+                                args.num_feature_channels, args.duration, write_raw_data = not args.no_raw_data, seed = args.seed)
+
+    print(info)
+
+
+if __name__ == "__main__":
+    main()
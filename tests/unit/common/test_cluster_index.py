@@ -0,0 +1,20 @@
+import numpy as np
+
+from ecephys_spike_sorting.common.cluster_index import ClusterIndex
+
+def test_cluster_index():
+
+	spike_clusters = np.array([3, 0, 3, 1, 0, 3])
+	spike_times = np.arange(6) * 0.1
+
+	cluster_index = ClusterIndex(spike_clusters, total_units = 5)
+
+	assert(np.array_equal(cluster_index.cluster_ids, np.unique(spike_clusters)))
+	assert(np.array_equal(cluster_index.counts, [2, 1, 0, 3, 0]))
+
+	grouped_times = cluster_index.group(spike_times)
+
+	for cluster_id in range(5):
+		in_cluster = spike_clusters == cluster_id
+		assert(np.array_equal(grouped_times[cluster_index.slice(cluster_id)], spike_times[in_cluster]))
+		assert(np.array_equal(cluster_index.indices(cluster_id), np.where(in_cluster)[0]))
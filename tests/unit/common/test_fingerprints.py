@@ -0,0 +1,44 @@
+import numpy as np
+
+from ecephys_spike_sorting.common.fingerprints import get_cluster_fingerprints, save_fingerprints, load_fingerprints, compare_fingerprints
+
+def test_compare_fingerprints():
+
+	spike_clusters = np.array([0, 1, 2, 0, 1, 2, 3, 3, 4])
+	params = {'isi_threshold' : 0.0015, 'incremental' : True}
+
+	previous = get_cluster_fingerprints(spike_clusters, params)
+
+	assert(np.array_equal(compare_fingerprints(previous, previous), []))
+
+	# merge 1 into 0, split 3 into 3 and 5, delete 4 (as noise, reassigned to 2)
+	curated = np.array([0, 0, 2, 0, 0, 2, 3, 5, 2])
+	current = get_cluster_fingerprints(curated, params)
+
+	assert(np.array_equal(compare_fingerprints(previous, current), [0, 1, 2, 3, 4, 5]))
+
+	# relabeling spikes within a cluster changes its hash, even with the same spike count
+	swapped = np.array([0, 1, 2, 0, 1, 3, 2, 3, 4])
+	assert(np.array_equal(compare_fingerprints(previous, get_cluster_fingerprints(swapped, params)), [2, 3]))
+
+	# the incremental flag does not invalidate the fingerprints, other parameters do
+	assert(compare_fingerprints(previous, get_cluster_fingerprints(spike_clusters, {'isi_threshold' : 0.0015})) is not None)
+	assert(compare_fingerprints(previous, get_cluster_fingerprints(spike_clusters, {'isi_threshold' : 0.002})) is None)
+	assert(compare_fingerprints(None, current) is None)
+
+
+def test_load_fingerprints(tmpdir):
+
+	output_file = str(tmpdir.join('metrics.csv'))
+
+	assert(load_fingerprints(output_file) is None)
+
+	fingerprints = get_cluster_fingerprints(np.array([0, 1, 1, 3]))
+	save_fingerprints(fingerprints, output_file)
+
+	# fingerprints are ignored if the output they describe is missing
+	assert(load_fingerprints(output_file) is None)
+
+	open(output_file, 'w').close()
+
+	assert(np.array_equal(compare_fingerprints(load_fingerprints(output_file), fingerprints), []))
@@ -0,0 +1,86 @@
+import pytest
+import os
+import numpy as np
+import pandas as pd
+
+from ecephys_spike_sorting.common.metrics_store import write_metrics_group, read_metrics_group, read_metrics, \
+	list_metrics_groups, export_metrics_csv, import_metrics_csv
+
+def make_metrics():
+
+	quality_metrics = pd.DataFrame({'cluster_id' : np.arange(4),
+									'firing_rate' : [1.0, 2.0, 3.0, 4.0],
+									'isi_viol' : [0.0, 0.1, 0.2, 0.3],
+									'epoch_name' : 'complete_session'})
+
+	waveform_metrics = pd.DataFrame({'cluster_id' : [0, 1, 3],
+									 'epoch_name' : 'complete_session',
+									 'snr' : [5.0, 6.0, 7.0],
+									 'duration' : [0.3, 0.4, 0.5]})
+
+	return quality_metrics, waveform_metrics
+
+
+def test_metrics_store(tmpdir):
+
+	store_directory = str(tmpdir.join('metrics_store'))
+	quality_metrics, waveform_metrics = make_metrics()
+
+	write_metrics_group(quality_metrics, 'quality_metrics', store_directory, 'pickle')
+	write_metrics_group(waveform_metrics, 'waveform_metrics', store_directory, 'pickle')
+
+	assert(list_metrics_groups(store_directory) == ['quality_metrics', 'waveform_metrics'])
+	assert(read_metrics_group('quality_metrics', store_directory).equals(quality_metrics))
+	assert(read_metrics_group('missing', store_directory) is None)
+
+	metrics = read_metrics(store_directory)
+
+	assert(metrics.shape == (4, 6))
+	assert(np.isnan(metrics.loc[metrics.cluster_id == 2, 'snr'].values[0]))
+
+	# only the requested columns (plus keys) are returned
+	metrics = read_metrics(store_directory, columns = ['snr'])
+
+	assert(list(metrics.columns) == ['cluster_id', 'epoch_name', 'snr'])
+
+	# rewriting one group leaves the others untouched
+	quality_metrics['firing_rate'] *= 2
+	write_metrics_group(quality_metrics, 'quality_metrics', store_directory, 'pickle')
+
+	assert(read_metrics_group('waveform_metrics', store_directory).equals(waveform_metrics))
+	assert(np.array_equal(read_metrics(store_directory)['firing_rate'], [2.0, 4.0, 6.0, 8.0]))
+
+	# a failed write keeps the stored metrics
+	class Unpicklable():
+		def __reduce__(self):
+			raise OSError('disk full')
+
+	with pytest.raises(OSError):
+		write_metrics_group(quality_metrics.assign(bad = Unpicklable()), 'quality_metrics', store_directory, 'pickle')
+
+	assert(np.array_equal(read_metrics(store_directory)['firing_rate'], [2.0, 4.0, 6.0, 8.0]))
+	assert(sorted(os.listdir(store_directory)) == ['quality_metrics.pkl', 'waveform_metrics.pkl'])
+
+
+def test_metrics_csv(tmpdir):
+
+	store_directory = str(tmpdir.join('metrics_store'))
+	cluster_metrics_file = str(tmpdir.join('metrics.csv'))
+	quality_metrics, waveform_metrics = make_metrics()
+
+	legacy = quality_metrics.merge(waveform_metrics, on='cluster_id', suffixes=('_quality_metrics','_waveform_metrics'))
+	legacy.to_csv(cluster_metrics_file)
+
+	imported = import_metrics_csv(cluster_metrics_file, waveform_metrics)
+
+	# (the legacy merge drops clusters without waveform metrics)
+	assert(imported.equals(quality_metrics.iloc[[0, 1, 3]].reset_index(drop = True)))
+
+	write_metrics_group(imported, 'quality_metrics', store_directory, 'pickle')
+	write_metrics_group(waveform_metrics, 'waveform_metrics', store_directory, 'pickle')
+
+	# exporting repeatedly does not accumulate columns
+	export_metrics_csv(store_directory, cluster_metrics_file)
+	export_metrics_csv(store_directory, cluster_metrics_file)
+
+	assert(pd.read_csv(cluster_metrics_file, index_col=0).equals(legacy))
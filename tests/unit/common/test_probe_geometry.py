@@ -0,0 +1,57 @@
+import numpy as np
+
+from ecephys_spike_sorting.common.probe_geometry import ProbeGeometry
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import find_sites_to_sample, calculate_2D_features
+
+def get_layouts():
+
+	channels = np.arange(384)
+
+	# Neuropixels 1.0 (staggered, four columns), and a four-shank 2.0 probe (two columns per shank)
+	np1 = (np.array([43.0, 11.0, 59.0, 27.0])[channels % 4], (channels // 2) * 20.0)
+	np2 = ((channels // 96) * 250.0 + (channels % 2) * 32.0, ((channels % 96) // 2) * 15.0)
+
+	return [np1, np2]
+
+def test_probe_geometry():
+
+	rng = np.random.RandomState(0)
+
+	for site_x, site_y in get_layouts():
+
+		geometry = ProbeGeometry(site_x, site_y, site_range = 16)
+
+		waveforms = rng.normal(0, 1, (site_x.size, 10))
+
+		for peak_channel in range(site_x.size):
+
+			expected = find_sites_to_sample(waveforms, peak_channel, site_x, site_y, 16)
+
+			x_nn = geometry.get_x_nn(np.array([peak_channel]), waveforms[np.newaxis, :, :])[0]
+			sites = geometry.get_sampled_sites(peak_channel, x_nn)
+
+			assert(np.array_equal(sites[sites >= 0], expected))
+
+def test_calculate_2D_features_with_geometry():
+
+	rng = np.random.RandomState(1)
+	timestamps = np.linspace(0, 82 / 30000.0, 200)
+
+	for site_x, site_y in get_layouts():
+
+		geometry = ProbeGeometry(site_x, site_y, site_range = 16)
+
+		for peak_channel in rng.choice(site_x.size, 20, replace = False):
+
+			decay = np.exp(-np.sqrt((site_x - site_x[peak_channel]) ** 2 + (site_y - site_y[peak_channel]) ** 2) / 40.0)
+			waveform = -decay[:, np.newaxis] * np.exp(-0.5 * ((np.arange(82) - 20 - decay[:, np.newaxis] * 3) / 3.0) ** 2) * 100
+
+			# no signal on the nearest sites at a different depth, so that the
+			# second column is not the one in the precomputed table
+			if peak_channel % 2 == 0:
+				waveform[geometry.nn_candidates[peak_channel][geometry.nn_candidates[peak_channel] >= 0]] = 0
+
+			expected = calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, 0.12, 16)
+			result = calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, 0.12, 16, geometry)
+
+			assert(np.allclose(expected, result, equal_nan = True))
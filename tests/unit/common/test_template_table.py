@@ -0,0 +1,93 @@
+import numpy as np
+import os
+
+from ecephys_spike_sorting.common.utils import load_unwhitened_templates, load_template_table, getSortResults
+
+def write_templates(folder, templates, whitening_mat_inv, timestamp):
+
+	np.save(os.path.join(folder, 'templates.npy'), templates)
+	np.save(os.path.join(folder, 'whitening_mat_inv.npy'), whitening_mat_inv)
+
+	for filename in ('templates.npy', 'whitening_mat_inv.npy'):
+		os.utime(os.path.join(folder, filename), (timestamp, timestamp))
+
+def test_load_template_table(tmp_path):
+
+	folder = str(tmp_path)
+
+	rng = np.random.RandomState(0)
+
+	num_templates, num_samples, num_channels = 5, 82, 12
+
+	templates = np.zeros((num_templates, num_samples, num_channels), dtype = 'float32')
+	templates[:, 21:, :] = rng.normal(0, 1, (num_templates, num_samples - 21, num_channels))
+	whitening_mat_inv = np.eye(num_channels) + rng.uniform(0, 0.1, (num_channels, num_channels))
+
+	channel_map = np.arange(num_channels) + 100
+	channel_pos = np.stack(((np.arange(num_channels) % 2) * 32.0, (np.arange(num_channels) // 2) * 20.0), 1)
+
+	np.save(os.path.join(folder, 'channel_map.npy'), channel_map)
+	np.save(os.path.join(folder, 'channel_positions.npy'), channel_pos)
+	np.save(os.path.join(folder, 'spike_clusters.npy'), np.array([0, 1, 1, 3]))
+
+	write_templates(folder, templates, whitening_mat_inv, 1000)
+
+	expected = np.zeros(templates.shape)
+	for idx in range(num_templates):
+		expected[idx] = np.dot(templates[idx], whitening_mat_inv)
+
+	unwhitened = load_unwhitened_templates(folder)
+
+	assert(os.path.exists(os.path.join(folder, 'templates_unwhitened.npy')))
+	assert(np.allclose(unwhitened, expected[:, 21:, :]))
+
+	template_table = load_template_table(folder)
+
+	peak_to_peak = np.max(expected[:, 21:, :], 1) - np.min(expected[:, 21:, :], 1)
+
+	assert(np.array_equal(template_table['peak_channel'].values, channel_map[np.argmax(peak_to_peak, 1)]))
+	assert(np.allclose(template_table['amplitude'].values, np.max(peak_to_peak, 1)))
+
+	nTemplate, nTot = getSortResults(folder)
+	clus_Table = np.load(os.path.join(folder, 'clus_Table.npy'))
+
+	assert(nTemplate == num_templates and nTot == 4)
+	assert(np.array_equal(clus_Table[:, 0], [1, 2, 0, 1, 0]))
+	assert(np.array_equal(clus_Table[:, 1], template_table['peak_channel'].values))
+
+	# the cached files are used until the templates change
+	write_templates(folder, -templates[::-1], whitening_mat_inv, 0)
+
+	assert(np.allclose(load_unwhitened_templates(folder), expected[:, 21:, :]))
+	assert(load_template_table(folder).equals(template_table))
+
+	write_templates(folder, -templates[::-1], whitening_mat_inv, os.path.getmtime(os.path.join(folder, 'template_table.csv')) + 10)
+
+	assert(np.allclose(load_unwhitened_templates(folder), -expected[::-1, 21:, :]))
+	assert(np.array_equal(load_template_table(folder)['peak_channel'].values, template_table['peak_channel'].values[::-1]))
+
+def test_load_template_table_read_only(tmp_path, monkeypatch):
+
+	folder = str(tmp_path)
+
+	rng = np.random.RandomState(1)
+
+	templates = rng.normal(0, 1, (4, 82, 8)).astype('float32')
+	whitening_mat_inv = np.eye(8) + rng.uniform(0, 0.1, (8, 8))
+
+	np.save(os.path.join(folder, 'channel_map.npy'), np.arange(8))
+	write_templates(folder, templates, whitening_mat_inv, 1000)
+
+	def read_only(source, destination):
+		raise PermissionError('read-only folder')
+
+	monkeypatch.setattr(os, 'replace', read_only)
+
+	unwhitened = load_unwhitened_templates(folder)
+	template_table = load_template_table(folder)
+
+	# the values are calculated, but no cache (or partial file) is left in the folder
+	assert(unwhitened.dtype == np.float32)
+	assert(np.allclose(unwhitened, np.dot(templates, whitening_mat_inv)[:, 21:, :], atol = 1e-5))
+	assert(template_table.shape[0] == 4)
+	assert(sorted(os.listdir(folder)) == ['channel_map.npy', 'templates.npy', 'whitening_mat_inv.npy'])
@@ -1,6 +1,7 @@
 import pytest
 import numpy as np
 import os
+import time
 
 import ecephys_spike_sorting.common.utils as utils
 
@@ -46,3 +47,79 @@ def test_find_range():
 	output = utils.find_range(data, 20, 30)
 
 	assert(np.array_equal(output, np.arange(20,31)))
+
+def test_share_array(tmpdir):
+
+	data = np.random.rand(1000, 3, 8).astype('float32')
+
+	filename = os.path.join(str(tmpdir), 'pc_features.npy')
+	np.save(filename, data)
+	memmapped = np.load(filename, mmap_mode = 'r')
+
+	for array, expected in [(memmapped[250:600], data[250:600]), (data, data)]:
+
+		shm, spec = utils.share_array(array)
+		shm2, shared = utils.attach_shared_array(spec)
+
+		assert(np.array_equal(shared, expected))
+
+		if shm is not None:
+			del shared
+			shm2.close()
+			shm.close()
+			shm.unlink()
+
+def test_share_array_without_shared_memory(monkeypatch):
+
+	import multiprocessing
+	import sys
+
+	# as before Python 3.8
+	monkeypatch.delattr(multiprocessing, 'shared_memory', raising = False)
+	monkeypatch.setitem(sys.modules, 'multiprocessing.shared_memory', None)
+
+	data = np.random.rand(100, 8)
+
+	shm, spec = utils.share_array(data)
+	shm2, shared = utils.attach_shared_array(spec)
+
+	assert(shm is None and shm2 is None)
+	assert(np.array_equal(shared, data))
+
+def test_get_spike_depths(tmpdir):
+
+	np.random.seed(0)
+
+	num_spikes = 2500
+	spike_clusters = np.random.randint(0, 10, num_spikes)
+	pc_features = np.random.randn(num_spikes, 3, 12).astype('float32')
+	pc_feature_ind = np.random.randint(0, 32, (10, 12))
+	channel_pos = np.stack((np.tile([11, 43], 16), np.repeat(np.arange(16) * 20, 2)), 1).astype('float')
+
+	# original full-array implementation
+	pc_power = np.clip(pc_features[:, 0, :].astype('float64'), 0, None) ** 2
+	expected = np.sum(channel_pos[pc_feature_ind[spike_clusters, :], 1] * pc_power, 1) / np.sum(pc_power, 1)
+
+	spike_depths = utils.get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos, chunk_size = 1000)
+
+	assert(spike_depths.dtype == np.float32)
+	assert(np.allclose(spike_depths, expected, rtol = 1e-5, equal_nan = True))
+
+	# saved depths are reused, until the spike clusters change
+	folder = str(tmpdir)
+	np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+
+	assert(np.array_equal(utils.load_spike_depths(folder, spike_clusters, pc_features, pc_feature_ind, channel_pos), spike_depths, equal_nan = True))
+	assert(os.path.exists(os.path.join(folder, 'spike_depths.npy')))
+
+	np.save(os.path.join(folder, 'spike_depths.npy'), np.zeros((num_spikes,), dtype = 'float32'))
+	assert(np.all(utils.load_spike_depths(folder, spike_clusters, pc_features, pc_feature_ind, channel_pos) == 0))
+
+	os.utime(os.path.join(folder, 'spike_clusters.npy'), (time.time() + 10, time.time() + 10))
+	assert(np.array_equal(utils.load_spike_depths(folder, spike_clusters, pc_features, pc_feature_ind, channel_pos), spike_depths, equal_nan = True))
+
+	# the depths also depend on the channels of the features
+	np.save(os.path.join(folder, 'spike_depths.npy'), np.zeros((num_spikes,), dtype = 'float32'))
+	np.save(os.path.join(folder, 'channel_positions.npy'), channel_pos)
+	os.utime(os.path.join(folder, 'channel_positions.npy'), (time.time() + 20, time.time() + 20))
+	assert(np.array_equal(utils.load_spike_depths(folder, spike_clusters, pc_features, pc_feature_ind, channel_pos), spike_depths, equal_nan = True))
@@ -0,0 +1,157 @@
+import pytest
+import numpy as np
+import os
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import remove_double_counted_spikes, \
+    find_within_unit_overlaps, find_within_unit_overlap, find_double_counted_spikes, remove_spikes_from_file, \
+    compact_spikes_file
+
+
+def make_sorting(num_units, num_channels, num_spikes, seed = 0):
+
+    """ Spikes with within-unit and between-unit duplicates, and units on a two-column probe """
+
+    rng = np.random.RandomState(seed)
+
+    # no two spikes at the same time, where the order of the original pairwise sort is arbitrary
+    spike_times = np.sort(rng.choice(30000, num_spikes, replace = False)) * 10
+    spike_clusters = rng.randint(0, num_units, num_spikes)
+
+    # duplicates of random spikes, in the same unit or in a unit with a nearby peak channel
+    copies = rng.choice(num_spikes, num_spikes // 4, replace = False)
+    copy_times = spike_times[copies] + rng.randint(1, 5, copies.size)
+    copy_clusters = np.where(rng.rand(copies.size) < 0.3, spike_clusters[copies],
+                             np.clip(spike_clusters[copies] + rng.randint(-2, 3, copies.size), 0, num_units - 1))
+
+    spike_times = np.concatenate((spike_times, copy_times))
+    spike_clusters = np.concatenate((spike_clusters, copy_clusters))
+
+    order = np.argsort(spike_times, kind = 'stable')
+    spike_times = spike_times[order].astype('uint64')
+    spike_clusters = spike_clusters[order]
+
+    templates = np.zeros((num_units, 61, num_channels), dtype = 'float32')
+    peak_channels = rng.randint(0, num_channels, num_units)
+    templates[np.arange(num_units), 20, peak_channels] = -rng.uniform(10, 50, num_units)
+
+    channel_map = np.arange(num_channels)
+    channel_pos = np.stack(((channel_map % 2) * 32.0, (channel_map // 2) * 20.0), 1)
+
+    cluster_amplitude = np.round(rng.uniform(50, 200, num_units), -1)
+
+    return spike_times, spike_clusters, templates, channel_map, channel_pos, cluster_amplitude
+
+
+def test_find_within_unit_overlaps():
+
+    spike_times, spike_clusters, templates, channel_map, channel_pos, cluster_amplitude = make_sorting(10, 32, 2000)
+
+    spikes_to_remove, removed_per_unit = find_within_unit_overlaps(spike_times, spike_clusters, 10, 5)
+
+    for unit in range(10):
+        for_unit = np.where(spike_clusters == unit)[0]
+        expected = for_unit[find_within_unit_overlap(spike_times[for_unit], 5)]
+
+        assert np.array_equal(np.intersect1d(spikes_to_remove, for_unit), expected)
+        assert removed_per_unit[unit] == len(expected)
+
+
+def test_remove_double_counted_spikes_single_sweep():
+
+    num_units = 12
+    sample_rate = 30000.0
+
+    spike_times, spike_clusters, templates, channel_map, channel_pos, cluster_amplitude = make_sorting(num_units, 32, 5000)
+
+    amplitudes = np.random.RandomState(1).rand(spike_times.size)
+    pc_features = np.random.RandomState(2).rand(spike_times.size, 3, 4).astype('float32')
+    template_features = np.random.RandomState(3).rand(spike_times.size, 5).astype('float32')
+
+    for deletion_mode in ('lowAmpCluster', 'deleteFirst'):
+
+        params = {'within_unit_overlap_window' : 0.000166, 'between_unit_overlap_window' : 0.000166,
+                  'between_unit_dist_um' : 50, 'deletion_mode' : deletion_mode, 'include_pcs' : True}
+
+        outputs = []
+
+        for single_sweep in (False, True):
+
+            params['single_sweep'] = single_sweep
+
+            outputs.append(remove_double_counted_spikes(spike_times, spike_clusters, spike_clusters, amplitudes,
+                                                        channel_map, channel_pos, templates, pc_features, None,
+                                                        template_features, cluster_amplitude, sample_rate, params))
+
+        expected, result = outputs
+
+        assert result[0].size < spike_times.size
+
+        for idx in range(6):
+            assert np.array_equal(expected[idx], result[idx])
+
+        assert np.array_equal(expected[6], result[6].toarray())
+        assert np.array_equal(expected[7], result[7])
+
+
+def test_remove_spikes_from_file(tmp_path):
+
+    spike_times, spike_clusters, templates, channel_map, channel_pos, cluster_amplitude = make_sorting(12, 32, 5000)
+
+    params = {'within_unit_overlap_window' : 0.000166, 'between_unit_overlap_window' : 0.000166,
+              'between_unit_dist_um' : 50, 'deletion_mode' : 'lowAmpCluster', 'include_pcs' : True,
+              'single_sweep' : True}
+
+    pc_features = np.random.RandomState(2).rand(spike_times.size, 3, 4).astype('float32')
+    template_features = np.random.RandomState(3).rand(spike_times.size, 5).astype('float32')
+
+    expected = remove_double_counted_spikes(spike_times, spike_clusters, spike_clusters, spike_times, channel_map,
+                                            channel_pos, templates, pc_features, None, template_features,
+                                            cluster_amplitude, 30000.0, params)
+
+    keep = find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, templates,
+                                      cluster_amplitude, 30000.0, params)[0]
+
+    for features, result in ((pc_features, expected[4]), (template_features, expected[5])):
+
+        npy_file = os.path.join(str(tmp_path), 'features.npy')
+        np.save(npy_file, features)
+
+        remove_spikes_from_file(npy_file, keep, 1000)
+
+        assert np.array_equal(np.load(npy_file), result)
+        assert not os.path.exists(npy_file + '.tmp')
+
+    # a file with the wrong number of spikes is left as it is
+    np.save(npy_file, pc_features[1:])
+
+    with pytest.raises(ValueError):
+        compact_spikes_file(npy_file, keep, 1000)
+
+    assert np.array_equal(np.load(npy_file), pc_features[1:])
+    assert not os.path.exists(npy_file + '.tmp')
+
+
+def test_remove_double_counted_spikes_no_spikes():
+
+    spike_times, spike_clusters, templates, channel_map, channel_pos, cluster_amplitude = make_sorting(4, 32, 100)
+
+    params = {'within_unit_overlap_window' : 0.000166, 'between_unit_overlap_window' : 0.000166,
+              'between_unit_dist_um' : 50, 'deletion_mode' : 'lowAmpCluster', 'include_pcs' : False}
+
+    empty = np.zeros((0,), dtype = 'int')
+
+    outputs = []
+
+    for single_sweep in (False, True):
+
+        params['single_sweep'] = single_sweep
+
+        outputs.append(remove_double_counted_spikes(empty.astype('uint64'), empty, empty, empty.astype('float'),
+                                                    channel_map, channel_pos, templates, [], None, [],
+                                                    cluster_amplitude, 30000.0, params))
+
+    expected, result = outputs
+
+    assert result[0].size == 0
+    assert np.array_equal(expected[6], result[6].toarray())
+    assert np.array_equal(expected[7], result[7])
@@ -0,0 +1,45 @@
+import pytest
+import numpy as np
+
+
+def _make_recording(num_units, num_channels, num_samples, num_spikes, unit_spacing, seed = 0):
+
+    """
+    Noise with spikes of one template per unit, each centered unit_spacing channels 
+    further along the probe
+
+    Outputs:
+    --------
+    raw_data : numpy.ndarray (num_samples x num_channels), int16
+    spike_times : numpy.ndarray (num_spikes), uint64
+    spike_clusters : numpy.ndarray (num_spikes)
+    templates : numpy.ndarray (num_units x 82 x num_channels)
+
+    """
+
+    rng = np.random.RandomState(seed)
+
+    spike_times = np.sort(rng.randint(0, num_samples, num_spikes)).astype('uint64')
+    spike_clusters = rng.randint(0, num_units, num_spikes)
+
+    # spatially decaying spike shape centered on a different channel for each unit
+    shape = -np.exp(-0.5 * ((np.arange(82) - 20) / 3.0) ** 2) + 0.3 * np.exp(-0.5 * ((np.arange(82) - 35) / 8.0) ** 2)
+    templates = np.zeros((num_units, 82, num_channels), dtype='float32')
+    for unit in range(num_units):
+        templates[unit] = shape[:, np.newaxis] * \
+            np.exp(-np.abs(np.arange(num_channels) - unit * unit_spacing) / 3.0)[np.newaxis, :]
+
+    raw_data = rng.normal(0, 10, (num_samples, num_channels))
+    for spike_time, unit in zip(spike_times.astype('int'), spike_clusters):
+        if spike_time >= 20 and spike_time + 62 <= num_samples:
+            raw_data[spike_time - 20:spike_time + 62] += 500 * templates[unit]
+
+    return raw_data.astype('int16'), spike_times, spike_clusters, templates
+
+
+@pytest.fixture
+def make_recording():
+
+    """ Synthetic raw data and sorting for the waveform extraction tests (see _make_recording) """
+
+    return _make_recording
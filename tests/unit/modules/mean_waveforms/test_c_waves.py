@@ -0,0 +1,100 @@
+import numpy as np
+import os
+
+from ecephys_spike_sorting.modules.mean_waveforms.c_waves import calculate_c_waves, select_uniform_spikes
+from ecephys_spike_sorting.modules.mean_waveforms.metrics_from_file import metrics_from_file
+
+
+def test_select_uniform_spikes():
+
+    spike_times = np.arange(20) * 10
+    spike_clusters = np.array([0, 1] * 10)
+
+    spike_samples, spike_units = select_uniform_spikes(spike_times, spike_clusters, 3, 4)
+
+    assert np.array_equal(spike_units, [0, 0, 0, 0, 1, 1, 1, 1])
+    assert np.array_equal(spike_samples, [0, 40, 100, 140, 10, 50, 110, 150])
+
+
+def test_calculate_c_waves(tmp_path):
+
+    num_channels = 17 # 16 sites and a sync channel
+    num_clusters = 4
+    samples_per_spike = 30
+    pre_samples = 10
+    bit_volts = 0.195
+
+    rng = np.random.RandomState(0)
+
+    raw_data = rng.randint(-20, 20, (20000, num_channels)).astype('int16')
+    spike_times = np.sort(rng.choice(np.arange(5, 19995), 400, replace = False)).astype('uint64')
+    spike_clusters = rng.randint(0, num_clusters - 1, 400).astype('uint32') # last cluster has no spikes
+
+    for spike_time, cluster in zip(spike_times.astype('int'), spike_clusters):
+        raw_data[spike_time, cluster * 4] -= 200
+
+    raw_data.tofile(os.path.join(tmp_path, 'continuous.bin'))
+
+    peak_channels = np.array([0, 4, 8, 12])
+    clus_table = np.zeros((num_clusters, 2), dtype = 'uint32')
+    clus_table[:, 0] = np.bincount(spike_clusters, minlength = num_clusters)
+    clus_table[:, 1] = peak_channels
+
+    np.save(os.path.join(tmp_path, 'clus_Table.npy'), clus_table)
+    np.save(os.path.join(tmp_path, 'spike_times.npy'), spike_times)
+    np.save(os.path.join(tmp_path, 'spike_clusters.npy'), spike_clusters)
+
+    site_x = np.tile([0.0, 32.0], 8)
+    site_y = np.repeat(np.arange(8) * 20.0, 2)
+
+    mean_waveforms_file, snr_file = calculate_c_waves(os.path.join(tmp_path, 'continuous.bin'),
+                                                      os.path.join(tmp_path, 'clus_Table.npy'),
+                                                      os.path.join(tmp_path, 'spike_times.npy'),
+                                                      os.path.join(tmp_path, 'spike_clusters.npy'),
+                                                      str(tmp_path), samples_per_spike, pre_samples, 50, 1,
+                                                      num_channels, bit_volts, site_x, site_y, 20e-6,
+                                                      chunk_samples = 1000)
+
+    mean_waveforms = np.load(mean_waveforms_file)
+    cluster_snr = np.load(snr_file)
+
+    assert mean_waveforms.shape == (num_clusters, 16, samples_per_spike)
+    assert cluster_snr.shape == (num_clusters, 2)
+
+    for cluster in range(num_clusters - 1):
+
+        times = spike_times[spike_clusters == cluster].astype('int')
+        times = times[(np.arange(50) * times.size) // 50]
+        times = times[(times >= pre_samples) * (times - pre_samples + samples_per_spike <= 20000)]
+
+        waveforms = np.array([raw_data[t - pre_samples:t - pre_samples + samples_per_spike, :16].T
+                              for t in times]) * bit_volts
+        mean_waveform = np.mean(waveforms, 0)
+
+        # sites within one site spacing (snr_radius = 1) of the peak site
+        peak = peak_channels[cluster]
+        disk = np.where(np.sqrt((site_x - site_x[peak]) ** 2 + (site_y - site_y[peak]) ** 2) <= 20.0)[0]
+
+        residuals = waveforms[:, disk, :15] - mean_waveform[disk, :15]
+        variance = np.sum(residuals ** 2) / ((times.size - 1) * disk.size * 15)
+        peak_waveform = mean_waveform[peak]
+        snr = (np.max(peak_waveform) - np.min(peak_waveform)) / (2 * np.sqrt(variance))
+
+        assert np.allclose(mean_waveforms[cluster], mean_waveform, atol = 1e-4)
+        assert np.isclose(cluster_snr[cluster, 0], snr, rtol = 1e-5)
+        assert cluster_snr[cluster, 1] == times.size
+
+    assert np.all(cluster_snr[-1] == 0)
+    assert np.all(mean_waveforms[-1] == 0)
+
+    templates = np.zeros((num_clusters, samples_per_spike, 16), dtype = 'float32')
+    templates[np.arange(num_clusters), pre_samples, peak_channels] = -1.0
+
+    params = {'samples_per_spike' : samples_per_spike, 'pre_samples' : pre_samples, 'spikes_per_epoch' : 50,
+              'upsampling_factor' : 200/82, 'spread_threshold' : 0.12, 'site_range' : 4}
+
+    metrics = metrics_from_file(mean_waveforms_file, snr_file, spike_times, spike_clusters, templates, np.arange(16),
+                                bit_volts, 30000.0, 20e-6, site_x, site_y, params)
+
+    assert np.array_equal(metrics['cluster_id'].values, [0, 1, 2])
+    assert np.allclose(metrics['snr'].values, cluster_snr[:3, 0])
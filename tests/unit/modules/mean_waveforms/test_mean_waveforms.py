@@ -1,8 +1,12 @@
 import pytest
 import numpy as np
 import os
+import multiprocessing
 
-from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms, extract_waveforms_single_pass, \
+    accumulate_waveforms_in_shards, get_sparse_channels
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_stats import get_mean_and_std
+from ecephys_spike_sorting.common.epoch import Epoch
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -29,4 +33,104 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+
+def test_extract_waveforms_single_pass(make_recording):
+
+    sample_rate = 30000.0
+    num_channels = 32
+    num_units = 6
+
+    params = {}
+    params['samples_per_spike'] = 82
+    params['pre_samples'] = 20
+    params['num_epochs'] = 1
+    params['spikes_per_epoch'] = 20
+    params['upsampling_factor'] = 200/82
+    params['spread_threshold'] = 0.12
+    params['site_range'] = 16
+    params['chunk_samples'] = 5000
+    params['num_workers'] = 1
+    params['worker_memory_mb'] = 64.0
+
+    raw_data, spike_times, spike_clusters, templates = make_recording(num_units, num_channels, 60000, 1500, 5)
+
+    channel_map = np.arange(num_channels)
+    channel_pos = np.zeros((num_channels, 2))
+    channel_pos[:, 0] = (channel_map % 2) * 32.0
+    channel_pos[:, 1] = (channel_map // 2) * 20.0
+
+    epochs = [Epoch('first_half', 0, 1), Epoch('complete_session', 0, np.inf)]
+
+    outputs = []
+
+    for function in (extract_waveforms, extract_waveforms_single_pass):
+        np.random.seed(1)
+        outputs.append(function(raw_data, spike_times, spike_clusters, templates, channel_map,
+                                0.195, sample_rate, 20e-6, params, epochs = epochs, channel_pos = channel_pos))
+
+    expected, result = outputs
+
+    assert np.allclose(expected[0], result[0], equal_nan = True)
+    assert np.array_equal(expected[1], result[1])
+    assert np.allclose(expected[4].select_dtypes('number').values,
+                       result[4].select_dtypes('number').values, equal_nan = True)
+
+    # the metrics only use the 2 x site_range channels nearest the peak
+    unit_channels = get_sparse_channels(templates, channel_map, channel_pos, 20e-6, 2 * params['site_range'])
+
+    assert unit_channels.shape == (num_units, 32)
+    assert np.all(np.any(unit_channels == np.arange(num_units)[:, np.newaxis] * 5, 1))
+
+    for function in (extract_waveforms, extract_waveforms_single_pass):
+        np.random.seed(1)
+        sparse = function(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195, sample_rate, 
+                          20e-6, params, epochs = epochs, channel_pos = channel_pos, unit_channels = unit_channels)
+
+        assert sparse[0].shape == (num_units, 2, 2, 32, 82)
+
+        for unit in range(num_units):
+            assert np.allclose(expected[0][unit][:, :, unit_channels[unit]], sparse[0][unit], equal_nan = True)
+
+        assert np.allclose(expected[4].select_dtypes('number').values,
+                           sparse[4].select_dtypes('number').values, equal_nan = True)
+
+    unit_channels = get_sparse_channels(templates, channel_map, channel_pos, 20e-6, 8)
+
+    np.random.seed(1)
+    sparse = extract_waveforms_single_pass(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195, 
+                                           sample_rate, 20e-6, params, epochs = epochs, channel_pos = channel_pos, 
+                                           unit_channels = unit_channels)
+
+    assert sparse[0].shape == (num_units, 2, 2, 8, 82)
+    assert np.allclose(expected[4]['snr'].values, sparse[4]['snr'].values)
+
+
+def test_accumulate_waveforms_in_shards(monkeypatch):
+
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 4)
+
+    rng = np.random.RandomState(0)
+
+    raw_data = rng.randint(-500, 500, (20000, 8)).astype('int16')
+    starts = np.sort(rng.randint(0, 20000 - 40, 600))
+    slot_index = rng.randint(0, 5, 600)
+
+    expected = get_mean_and_std(accumulate_waveforms_in_shards(raw_data, starts, slot_index, 6, 40, 0.195, 
+                                                               1000, 64.0, num_workers = 1))
+
+    # three workers, and blocks limited by the memory cap
+    result = get_mean_and_std(accumulate_waveforms_in_shards(raw_data, starts, slot_index, 6, 40, 0.195, 
+                                                             1000, 0.05, num_workers = 3))
+
+    for e, r in zip(expected, result):
+        assert np.allclose(e, r, equal_nan = True)
+
+    # accumulators larger than the memory cap: the slots are read in batches
+    for num_workers in (1, 3):
+        result = get_mean_and_std(accumulate_waveforms_in_shards(raw_data, starts, slot_index, 6, 40, 0.195, 
+                                                                 1000, 0.006, num_workers = num_workers))
+
+        for e, r in zip(expected, result):
+            assert np.allclose(e, r, equal_nan = True)
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import calculate_waveform_metrics_batch, \
+                                                                         calculate_waveform_metrics_from_mean
+from ecephys_spike_sorting.common.probe_geometry import ProbeGeometry
+
+
+def make_mean_waveforms(num_units, num_channels, num_samples, seed = 0):
+
+    """ Spatially decaying spikes, some inverted, with noise """
+
+    rng = np.random.RandomState(seed)
+
+    t = np.arange(num_samples)
+    waveforms = np.zeros((num_units, num_channels, num_samples))
+    peak_channels = rng.randint(0, num_channels, num_units)
+
+    for unit in range(num_units):
+        width = rng.uniform(2, 5)
+        shape = -np.exp(-0.5 * ((t - 20) / width) ** 2) + rng.uniform(0.1, 0.5) * np.exp(-0.5 * ((t - 35) / 8.0) ** 2)
+        if unit % 4 == 3:
+            shape = -shape
+        decay = np.exp(-np.abs(np.arange(num_channels) - peak_channels[unit]) / rng.uniform(2, 6))
+        waveforms[unit] = 100 * shape[np.newaxis, :] * decay[:, np.newaxis] + rng.normal(0, 2, (num_channels, num_samples))
+
+    return waveforms, peak_channels
+
+
+def test_calculate_waveform_metrics_batch():
+
+    num_units = 24
+    num_channels = 48
+    sample_rate = 30000.0
+
+    waveforms, peak_channels = make_mean_waveforms(num_units, num_channels, 82)
+    snr = np.arange(num_units) * 0.5
+
+    channel_map = np.arange(num_channels)
+
+    for site_x, site_y in ((None, None), ((channel_map % 2) * 32.0, (channel_map // 2) * 20.0)):
+
+        result = calculate_waveform_metrics_batch(waveforms, snr, np.arange(num_units) + 10, peak_channels,
+                                                  channel_map, sample_rate, 200/82, 0.12, 16, 20e-6,
+                                                  'complete_session', site_x, site_y)
+
+        expected = pd.concat([calculate_waveform_metrics_from_mean(waveforms[unit], snr[unit], unit + 10,
+                                                                   peak_channels[unit], channel_map, sample_rate,
+                                                                   200/82, 0.12, 16, 20e-6, 'complete_session',
+                                                                   site_x, site_y)
+                              for unit in range(num_units)])
+
+        assert list(result.columns) == list(expected.columns)
+        assert np.array_equal(result['epoch_name'].values, expected['epoch_name'].values)
+        assert np.allclose(result.select_dtypes('number').values.astype('float'),
+                           expected.select_dtypes('number').values.astype('float'), equal_nan = True)
+
+        # same sites for the 2D features from the precomputed tables
+        if site_x is not None:
+            geometry = ProbeGeometry(site_x, site_y, 16)
+            with_geometry = calculate_waveform_metrics_batch(waveforms, snr, np.arange(num_units) + 10, peak_channels,
+                                                             channel_map, sample_rate, 200/82, 0.12, 16, 20e-6,
+                                                             'complete_session', geometry = geometry)
+
+            assert with_geometry.equals(result)
+
+    # a different set of channels for each unit, including its peak channel
+    unit_channels = np.zeros((num_units, 24), dtype = 'int')
+    for unit in range(num_units):
+        others = np.delete(channel_map, peak_channels[unit])
+        unit_channels[unit] = np.sort(np.append(np.random.RandomState(unit).choice(others, 23, replace = False),
+                                                peak_channels[unit]))
+
+    sparse = np.stack([waveforms[unit][unit_channels[unit]] for unit in range(num_units)])
+
+    result = calculate_waveform_metrics_batch(sparse, snr, np.arange(num_units), peak_channels, unit_channels,
+                                              sample_rate, 200/82, 0.12, 16, 20e-6, 'complete_session')
+
+    for unit in range(num_units):
+
+        expected = calculate_waveform_metrics_from_mean(sparse[unit], snr[unit], unit, peak_channels[unit],
+                                                        unit_channels[unit], sample_rate, 200/82, 0.12, 16, 20e-6,
+                                                        'complete_session')
+
+        assert np.allclose(result.select_dtypes('number').values[unit].astype('float'),
+                           expected.select_dtypes('number').values[0].astype('float'), equal_nan = True)
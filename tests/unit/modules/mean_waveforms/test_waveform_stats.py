@@ -0,0 +1,61 @@
+import numpy as np
+
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_stats import new_waveform_accumulator, add_waveform, \
+    update_waveform_accumulator, merge_waveform_accumulators, get_mean_and_std
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import calculate_snr, calculate_snr_from_stats
+
+
+def test_update_waveform_accumulator():
+
+    rng = np.random.RandomState(0)
+
+    waveforms = rng.randint(-1000, 1000, (200, 4, 30)).astype('int16') * 0.195
+    slots = rng.randint(0, 3, 200)
+
+    accumulator = new_waveform_accumulator(5, 4, 30)
+
+    for batch in np.array_split(np.arange(200), 7):
+        update_waveform_accumulator(accumulator, slots[batch], waveforms[batch])
+
+    means, stds = get_mean_and_std(accumulator)
+
+    for slot in range(3):
+        assert np.allclose(means[slot], np.mean(waveforms[slots == slot], 0))
+        assert np.allclose(stds[slot], np.std(waveforms[slots == slot], 0))
+
+    assert np.array_equal(accumulator[0], np.bincount(slots, minlength = 5))
+    assert np.all(np.isnan(means[3:]))
+
+
+def test_merge_waveform_accumulators():
+
+    rng = np.random.RandomState(1)
+
+    waveforms = rng.normal(50.0, 10.0, (100, 2, 20))
+    slots = rng.randint(0, 2, 100)
+
+    first = new_waveform_accumulator(2, 2, 20)
+    second = new_waveform_accumulator(2, 2, 20)
+    combined = new_waveform_accumulator(2, 2, 20)
+
+    for idx in range(60):
+        add_waveform(first, slots[idx], waveforms[idx])
+
+    update_waveform_accumulator(second, slots[60:], waveforms[60:])
+    update_waveform_accumulator(combined, slots, waveforms)
+
+    merge_waveform_accumulators(first, second)
+
+    for expected, result in zip(get_mean_and_std(combined), get_mean_and_std(first)):
+        assert np.allclose(expected, result)
+
+
+def test_calculate_snr_from_stats():
+
+    rng = np.random.RandomState(2)
+
+    waveforms = rng.normal(0.0, 5.0, (50, 40))
+    waveforms[:, 10:15] -= 40.0
+
+    assert np.isclose(calculate_snr(waveforms),
+                      calculate_snr_from_stats(np.mean(waveforms, 0), np.std(waveforms, 0)))
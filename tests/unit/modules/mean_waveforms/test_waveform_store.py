@@ -0,0 +1,95 @@
+import numpy as np
+import os
+
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms, extract_waveforms_single_pass
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_store import create_waveform_store, close_waveform_store, \
+                                                                        read_unit_waveforms, get_waveform_store_file
+from ecephys_spike_sorting.common.epoch import Epoch
+
+
+def test_extract_waveforms_to_store(tmp_path, make_recording):
+
+    num_units = 5
+    num_channels = 16
+    sample_rate = 30000.0
+
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 20,
+              'upsampling_factor' : 200/82, 'spread_threshold' : 0.12, 'site_range' : 16,
+              'chunk_samples' : 5000, 'num_workers' : 1, 'worker_memory_mb' : 64.0}
+
+    raw_data, spike_times, spike_clusters, templates = make_recording(num_units, num_channels, 30000, 600, 3)
+
+    channel_map = np.arange(num_channels)
+    epochs = [Epoch('first_half', 0, 0.5), Epoch('complete_session', 0, np.inf)]
+
+    store_file = get_waveform_store_file(os.path.join(str(tmp_path), 'mean_waveforms.npy'))
+
+    for function in (extract_waveforms, extract_waveforms_single_pass):
+
+        np.random.seed(1)
+        expected = function(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195, sample_rate,
+                            20e-6, params, epochs = epochs)
+
+        np.random.seed(1)
+        result = function(raw_data, spike_times, spike_clusters, templates, channel_map, 0.195, sample_rate,
+                          20e-6, params, epochs = epochs, waveform_store_file = store_file)
+
+        assert result[0].shape == expected[0].shape
+        assert np.array_equal(result[0][:, -1, 0, :, :], expected[0][:, -1, 0, :, :])
+        assert result[4].equals(expected[4])
+
+        for unit in range(num_units):
+            waveforms, spike_count, channels = read_unit_waveforms(store_file, unit)
+
+            assert np.array_equal(waveforms, expected[0][unit])
+            assert np.array_equal(spike_count, expected[1][unit])
+            assert channels is None
+
+        result[0].file.close()
+
+
+def test_incremental_waveform_store(tmp_path):
+
+    store_file = os.path.join(str(tmp_path), 'mean_waveforms_store.h5')
+
+    waveforms = np.random.RandomState(0).normal(0, 1, (4, 1, 2, 3, 10))
+    spike_count = np.arange(8).reshape((4, 2))
+
+    store = create_waveform_store(store_file, np.arange(4), ['complete_session'], 3, 10, 2, 30000.0)
+    store['waveforms'][...] = waveforms
+    close_waveform_store(store, spike_count).file.close()
+
+    # unit 1 changed and a new unit 4 was added
+    store = create_waveform_store(store_file, np.arange(5), ['complete_session'], 3, 10, 2, 30000.0,
+                                  units_to_update = np.array([1, 4]))
+    store['waveforms'][1] = -waveforms[1]
+    store['waveforms'][4] = waveforms[0]
+    close_waveform_store(store, np.ones((5, 2), dtype = 'int'), np.array([1, 4])).file.close()
+
+    assert not os.path.exists(store_file + '.tmp')
+
+    for unit, expected in ((0, waveforms[0]), (1, -waveforms[1]), (3, waveforms[3]), (4, waveforms[0])):
+        assert np.array_equal(read_unit_waveforms(store_file, unit)[0], expected)
+
+    assert np.array_equal(read_unit_waveforms(store_file, 2)[1], spike_count[2])
+    assert np.array_equal(read_unit_waveforms(store_file, 4)[1], [1, 1])
+
+
+def test_failed_run_keeps_waveform_store(tmp_path):
+
+    store_file = os.path.join(str(tmp_path), 'mean_waveforms_store.h5')
+
+    waveforms = np.random.RandomState(0).normal(0, 1, (3, 1, 2, 3, 10))
+
+    store = create_waveform_store(store_file, np.arange(3), ['complete_session'], 3, 10, 2, 30000.0)
+    store['waveforms'][...] = waveforms
+    close_waveform_store(store, np.ones((3, 2), dtype = 'int')).file.close()
+
+    # a run that stops before the store is closed
+    store = create_waveform_store(store_file, np.arange(3), ['complete_session'], 3, 10, 2, 30000.0,
+                                  units_to_update = np.array([1]))
+    store['waveforms'][1] = -waveforms[1]
+    store.close()
+
+    for unit in range(3):
+        assert np.array_equal(read_unit_waveforms(store_file, unit)[0], waveforms[unit])
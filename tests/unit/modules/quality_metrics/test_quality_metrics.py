@@ -31,6 +31,255 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+
+def make_spike_trains(num_spikes = 20000, num_units = 25, seed = 0):
+
+	rng = np.random.RandomState(seed)
+
+	spike_times = np.sort(rng.uniform(0, 600, num_spikes))
+	spike_clusters = rng.choice(num_units, num_spikes, p = rng.dirichlet(np.ones(num_units)))
+	amplitudes = rng.gamma(5, 3, num_spikes)
+
+	# add duplicate spikes, a single-spike unit and an empty unit
+	spike_times[100:110] = spike_times[99]
+	spike_clusters[100:110] = spike_clusters[99]
+	spike_clusters[spike_clusters == num_units - 1] = 0
+	spike_clusters[5000] = num_units - 1
+
+	return spike_times, spike_clusters, amplitudes, num_units + 1
+
+
+def test_spike_train_metrics():
+
+	from ecephys_spike_sorting.modules.quality_metrics.batch_metrics import calculate_spike_train_metrics
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import isi_violations, presence_ratio, firing_rate, amplitude_cutoff
+
+	spike_times, spike_clusters, amplitudes, total_units = make_spike_trains()
+	min_time = np.min(spike_times)
+	max_time = np.max(spike_times)
+
+	for min_isi in [0, 0.0005]:
+
+		firing_rates, presence_ratios, isi_viol, amplitude_cutoffs = \
+			calculate_spike_train_metrics(spike_times, spike_clusters, amplitudes, total_units, 0.0015, min_isi)
+
+		for unit in range(total_units):
+
+			in_unit = spike_clusters == unit
+
+			if np.sum(in_unit) == 0:
+				assert(firing_rates[unit] == 0 and presence_ratios[unit] == 0)
+				assert(isi_viol[unit] == 0 and amplitude_cutoffs[unit] == 0)
+				continue
+
+			assert(np.isclose(firing_rates[unit], firing_rate(spike_times[in_unit], min_time, max_time)))
+			assert(np.isclose(presence_ratios[unit], presence_ratio(spike_times[in_unit], min_time, max_time)))
+			assert(np.isclose(isi_viol[unit], isi_violations(spike_times[in_unit], min_time, max_time, 0.0015, min_isi)[0]))
+			assert(np.isclose(amplitude_cutoffs[unit], amplitude_cutoff(amplitudes[in_unit])))
+
+
+def make_pc_features(num_spikes = 6000, num_units = 10, num_channels = 32, num_pc_channels = 16, seed = 0):
+
+	rng = np.random.RandomState(seed)
+
+	# two-column probe with 20 um vertical spacing
+	channel_pos = np.zeros((num_channels, 2))
+	channel_pos[:,0] = np.tile([11, 43], num_channels // 2)
+	channel_pos[:,1] = np.repeat(np.arange(num_channels // 2) * 20, 2)
+
+	peak_channels = rng.randint(0, num_channels, num_units)
+	first_channels = np.clip(peak_channels - num_pc_channels // 2, 0, num_channels - num_pc_channels)
+	pc_feature_ind = first_channels[:, np.newaxis] + np.arange(num_pc_channels)
+
+	spike_times = np.sort(rng.uniform(0, 600, num_spikes))
+	spike_clusters = rng.randint(0, num_units, num_spikes)
+
+	pc_features = rng.randn(num_spikes, 3, num_pc_channels).astype('float32')
+	for unit in range(num_units):
+		in_unit = spike_clusters == unit
+		peak = peak_channels[unit] - first_channels[unit]
+		pc_features[in_unit, 0, :] += 5 * np.exp(-0.5 * ((np.arange(num_pc_channels) - peak) / 2.0) ** 2)
+
+	return spike_times, spike_clusters, pc_features, pc_feature_ind, channel_pos, num_units
+
+
+def test_parallel_pc_metrics():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_pc_metrics
+
+	spike_times, spike_clusters, pc_features, pc_feature_ind, channel_pos, total_units = make_pc_features()
+
+	serial = calculate_pc_metrics(spike_clusters, total_units, pc_features, pc_feature_ind, channel_pos,
+								  50, 200, 2000, 4, num_workers = 1)
+	parallel = calculate_pc_metrics(spike_clusters, total_units, pc_features, pc_feature_ind, channel_pos,
+									50, 200, 2000, 4, num_workers = 2)
+
+	for a, b in zip(serial, parallel):
+		assert(np.array_equal(a, b, equal_nan = True))
+
+
+def test_fast_silhouette_score():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_silhouette_score, calculate_silhouette_score_fast
+
+	# second case: every unit has PCs on all channels, so PC columns collide
+	for num_channels, num_pc_channels in [(32, 16), (16, 16)]:
+
+		spike_times, spike_clusters, pc_features, pc_feature_ind, channel_pos, total_units = \
+			make_pc_features(num_channels = num_channels, num_pc_channels = num_pc_channels)
+
+		np.random.seed(0)
+		expected = calculate_silhouette_score(spike_clusters, total_units, pc_features, pc_feature_ind, 2000)
+
+		np.random.seed(0)
+		output = calculate_silhouette_score_fast(spike_clusters, total_units, pc_features, pc_feature_ind, 2000, 
+												 channel_pos, max_radius_um = None, block_size = 300)
+
+		assert(np.allclose(output, expected, equal_nan = True))
+
+		# with a radius, each unit is scored against fewer units, whatever the blocks of rows
+		for block_size in (97, 300):
+
+			np.random.seed(0)
+			nearby = calculate_silhouette_score_fast(spike_clusters, total_units, pc_features, pc_feature_ind, 2000, 
+													 channel_pos, max_radius_um = 60, block_size = block_size)
+
+			scored = ~np.isnan(nearby)
+
+			assert(np.any(scored))
+			assert(np.all(nearby[scored] >= output[scored] - 1e-12))
+
+		np.random.seed(0)
+		everything = calculate_silhouette_score_fast(spike_clusters, total_units, pc_features, pc_feature_ind, 2000, 
+													 channel_pos, max_radius_um = 1e6, block_size = 300)
+
+		assert(np.array_equal(everything, output, equal_nan = True))
+
+
+def test_mahalanobis_metrics_cholesky():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import mahalanobis_metrics, mahalanobis_metrics_cholesky
+
+	rng = np.random.RandomState(0)
+
+	all_pcs = np.concatenate((rng.randn(300, 12), rng.randn(700, 12) * 2 + 1), 0)
+	all_labels = np.concatenate((np.zeros((300,), dtype = 'int'), np.ones((700,), dtype = 'int')))
+
+	expected = mahalanobis_metrics(all_pcs, all_labels, 0)
+
+	assert(np.allclose(mahalanobis_metrics_cholesky(all_pcs, all_labels, 0), expected))
+	assert(np.allclose(mahalanobis_metrics_cholesky(all_pcs, all_labels, 0, dtype = 'float32'), expected, rtol = 1e-4))
+
+	# singular covariance: NaN, unless regularized
+	all_pcs[:, -1] = all_pcs[:, 0]
+
+	assert(np.all(np.isnan(mahalanobis_metrics_cholesky(all_pcs, all_labels, 0))))
+	assert(np.all(np.isfinite(mahalanobis_metrics_cholesky(all_pcs, all_labels, 0, regularization = 1e-3))))
+
+
+def test_fisher_metrics():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import lda_metrics, fisher_metrics, get_mean_and_covariance
+
+	rng = np.random.RandomState(0)
+
+	all_pcs = np.concatenate((rng.randn(300, 12) + 0.5, rng.randn(700, 12) * rng.rand(12) * 2), 0)
+	all_labels = np.concatenate((np.zeros((300,), dtype = 'int'), np.ones((700,), dtype = 'int')))
+
+	unit_moments = get_mean_and_covariance(all_pcs[all_labels == 0,:])
+
+	assert(np.isclose(fisher_metrics(all_pcs, all_labels, 0), lda_metrics(all_pcs, all_labels, 0)))
+	assert(np.isclose(fisher_metrics(all_pcs, all_labels, 1), lda_metrics(all_pcs, all_labels, 1)))
+	assert(np.isclose(fisher_metrics(all_pcs, all_labels, 0, unit_moments = unit_moments), lda_metrics(all_pcs, all_labels, 0)))
+
+
+def test_nearest_neighbors_methods():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_pc_metrics
+
+	spike_times, spike_clusters, pc_features, pc_feature_ind, channel_pos, total_units = make_pc_features()
+
+	expected = calculate_pc_metrics(spike_clusters, total_units, pc_features, pc_feature_ind, channel_pos,
+									50, 200, 1000, 4, nn_method = 'ball_tree')
+	brute = calculate_pc_metrics(spike_clusters, total_units, pc_features, pc_feature_ind, channel_pos,
+								 50, 200, 1000, 4, nn_method = 'brute')
+	shared = calculate_pc_metrics(spike_clusters, total_units, pc_features, pc_feature_ind, channel_pos,
+								  50, 200, 1000, 4, nn_method = 'kd_tree')
+
+	for a, b in zip(expected, brute):
+		assert(np.array_equal(a, b, equal_nan = True))
+
+	# shared trees use a different subsample, but are only computed for the same units
+	for a, b in zip(expected[3:], shared[3:]):
+		assert(np.array_equal(np.isnan(a), np.isnan(b)))
+		assert(np.all((b[np.isfinite(b)] >= 0) * (b[np.isfinite(b)] <= 1)))
+
+
+def test_drift_metrics():
+
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_drift_metrics
+	from ecephys_spike_sorting.common.utils import get_spike_depths
+
+	spike_times, spike_clusters, pc_features, pc_feature_ind, channel_pos, total_units = make_pc_features()
+
+	interval_length = 37
+	min_spikes_per_interval = 40 # drops some of the intervals
+
+	max_drift, cumulative_drift = calculate_drift_metrics(spike_times, spike_clusters, total_units, pc_features, pc_feature_ind,
+														  channel_pos, interval_length, min_spikes_per_interval)
+
+	depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
+	interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
+
+	for cluster_id in range(total_units):
+
+		median_depths = []
+
+		for t1 in interval_starts:
+			in_range = (spike_clusters == cluster_id) * (spike_times > t1) * (spike_times < t1 + interval_length)
+			median_depths.append(np.median(depths[in_range]) if np.sum(in_range) >= min_spikes_per_interval else np.nan)
+
+		assert(max_drift[cluster_id] == np.around(np.nanmax(median_depths) - np.nanmin(median_depths), 2))
+		assert(cumulative_drift[cluster_id] == np.around(np.nansum(np.abs(np.diff(median_depths))), 2))
+
+
+def test_epoch_spike_train_metrics():
+
+	from ecephys_spike_sorting.modules.quality_metrics.batch_metrics import calculate_spike_train_metrics, calculate_epoch_spike_train_metrics
+	from ecephys_spike_sorting.modules.quality_metrics.metrics import get_epoch_index
+	from ecephys_spike_sorting.common.epoch import Epoch
+
+	spike_times, spike_clusters, amplitudes, total_units = make_spike_trains()
+
+	# near-duplicate pair, followed by an ISI violation
+	spike_clusters[200:202] = spike_clusters[199]
+	spike_times[200:202] = spike_times[199] + np.array([0.0002, 0.0012])
+	assert(np.all(np.diff(spike_times) >= 0))
+
+	# epochs that overlap, start between near-duplicate spikes, and end on a spike
+	epochs = [Epoch('complete_session', 0, np.inf),
+			  Epoch('first', 0, spike_times[5000]),
+			  Epoch('second', spike_times[5000], 400),
+			  Epoch('duplicates', spike_times[199] + 0.0001, 300)]
+
+	epoch_slices = [get_epoch_index(spike_times, epoch, True) for epoch in epochs]
+
+	for min_isi in [0, 0.0005]:
+
+		epoch_indexes, epoch_metrics = calculate_epoch_spike_train_metrics(spike_times, spike_clusters, amplitudes, total_units,
+																		   epoch_slices, 0.0015, min_isi)
+
+		for in_epoch, cluster_index, metrics in zip(epoch_slices, epoch_indexes, epoch_metrics):
+
+			expected = calculate_spike_train_metrics(spike_times[in_epoch], spike_clusters[in_epoch], amplitudes[in_epoch],
+													 total_units, 0.0015, min_isi)
+
+			for a, b in zip(metrics, expected):
+				assert(np.allclose(a, b))
+
+			assert(np.array_equal(cluster_index.order, np.argsort(spike_clusters[in_epoch], kind = 'stable')))
+
+
 if __name__ == "__main__":
     #test_quality_metrics()
-    pass
\ No newline at end of file
+    pass